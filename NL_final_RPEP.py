@@ -27,6 +27,19 @@ Reward Presentations differ per block, with reward size fluctuating within block
 
 To escape the experiment at any time press ctrl+q  
 
+To prepare a session beforehand (participant check and schedule, see rpep_setup) and start it without the dialog:
+    python rpep_setup.py --participant 12 --name Jan --gender Male
+    python NL_final_RPEP.py --session DATA/subject_12/subject_12_data_session.npz
+
+To run several stations at once with a collector that hands out the participant numbers (see rpep_collector):
+    python NL_final_RPEP.py --collector 192.168.1.10:8765 --station pc-03
+
+To follow the data quality of a session on the experimenter's terminal or a local web page (see rpep_monitor):
+    python NL_final_RPEP.py --monitor --monitor-port 8000
+
+To run the whole experiment without a display or participant (simulated responses):
+    python NL_final_RPEP.py --headless --participant 101 --model data_long.csv
+
 
 """
 # # # # # # #
@@ -36,36 +49,58 @@ To escape the experiment at any time press ctrl+q
 
 #imports
 from __future__ import division
-from psychopy import data, visual, core, event,gui
-import os, time, pandas, random, platform
-import numpy as np
+import os, platform, sys
+import rpep_headless
+from rpep_setup import session_argument, session_suffix
+#a session prepared by rpep_setup (python NL_final_RPEP.py --session FILE) needs no participant dialog
+session_file = session_argument(sys.argv)
+#headless mode (python NL_final_RPEP.py --headless): no display and a simulated participant, see rpep_headless
+if rpep_headless.requested():
+    from rpep_headless import data, visual, core, event, gui, keyboard
+else:
+    from psychopy import data, visual, core, event
+    from psychopy.hardware import keyboard
+    if session_file is None:
+        from psychopy import gui
+from rpep_design import session_schedule, build_schedule, schedule_trial_lists, export_schedule, load_session
+import rpep_design
+from rpep_trial_log import TrialLog, read_completed_blocks
+from rpep_frame_timing import FrameLog
+from rpep_performance import RunningStats
+from rpep_trial_store import TrialStore
+from rpep_collector import CollectorClient, collector_arguments
+from rpep_monitor import Monitor, monitor_arguments
 
 """ """ """ """ """ """ """ 
 CORE PARAMETERS
 
-The section below is for adjusting specific parameters:
-the number of trials, blocks, repetitions,loops AND 
+The number of trials, blocks, repetitions, the bins, scale types, keys AND 
 the timing of certain processes (fixation cross  , messages,etc.)
+are set in the experiment config (rpep_config.json, or the file in RPEP_CONFIG, see rpep_design).
+A session prepared by rpep_setup runs the design it was prepared with.
 
 """ """ """ """ """ """ """
-#Trials and Blocks #
+session = None
+if session_file is not None:
+    session = load_session(session_file)
+    design = session["design"]
+else:
+    design = rpep_design.design
 
-n_trials = 140 #per block
-n_conditions = 10
-n_trial_rep = 7 #n_trials/n_conditions
+#Trials and Blocks #
 
-n_blocks = 9  # block 0 is a practice block
-n_practice_trials = 4
-n_test_trials = 4
+n_trials = int(design["block_trials"][-1]) #per block
+n_blocks = design["n_blocks"]  # block 0 is a practice block
+n_practice_trials = design["n_practice_trials"]
 
 
 # Time settings #
 
-t_fix_cross = .30
-t_blank_screen =0.2
-response_deadline = 0.4
-t_reward_announcement = 1.2
-t_feedback = .6
+t_fix_cross = design["timing"]["fixation"]
+t_blank_screen = design["timing"]["blank"]
+response_deadline = design["deadline"]["initial"]
+t_reward_announcement = design["timing"]["reward"]
+t_feedback = design["timing"]["feedback"]
 
 #Giving an estimate of how long the experiment will last
 total_time = ((t_reward_announcement+t_fix_cross+response_deadline+t_feedback)*(((n_blocks-1)*n_trials)+n_practice_trials))/60
@@ -73,35 +108,64 @@ print("The total time of the experiment, excluding, breaks and instructions is a
 
 #Response Keys
 
-left_key = 'k'
-right_key = 'm'
+left_key, right_key = design["keys"]
 
-#Upper limit noise of reward scale (measure for how far the reward fluctuates from the bin)
-noise_upper_limit = 3
+#Response collection
+# 'keyboard': key presses are time stamped by psychopy.hardware.keyboard, relative to the flip of the target
+# 'event'   : the old event.waitKeys + experiment_timer combination
+response_backend = 'keyboard'
 
 # Setting up other intial variables and objects
 ##   The Timer
 experiment_timer = core.Clock()
 experiment_times = []
+##   The Keyboard (its clock is reset on the flip of every target)
+kb = keyboard.Keyboard()
 
 # Initialising the Window
 win = visual.Window(fullscr = True, color = 'black', allowGUI = True)
 
+# Measuring the refresh rate of the monitor, every phase of a trial is counted in frames of this rate
+frame_rate = win.getActualFrameRate(nIdentical = 10, nMaxFrames = 120, nWarmUpFrames = 10)
+if frame_rate is None:
+    # the measurement was unstable, falling back on the nominal rate
+    frame_rate = 60.0
+frame_duration = 1.0/frame_rate
+print("The measured refresh rate of the monitor is {0} Hz".format(round(frame_rate,2)))
+
 
 ##   Text objects
 # Empty instruction text object
 instructions = visual.TextStim(win, text = "")
 fix_cross = visual.TextStim(win, text = '+')
 block_completed = visual.TextStim(win, text = "")
-# Empty reward and accuracy counter
-acc_counter = []
-reward_counter = []
+# Running reward and accuracy totals of the experimental trials (O(1) per trial, see rpep_performance),
+# with the accuracy of the last trials and per ScaleType X Bins tallies for the feedback screens and the deadline
+# (used when the performance section of the config asks for them)
+performance = RunningStats(window = design["performance"]["window"], n_scale_types = len(design["scale_types"]), n_bins = len(design["bins"]))
+# Trial log (every trial is streamed to disk), opened once the participant is known
+trial_log = None
+# Collector of a multi-station lab (participant numbers and a merged copy of the trials), optional
+collector_address, station = collector_arguments(sys.argv)
+collector = None
+if collector_address:
+    collector = CollectorClient(collector_address, station)
+# Data-quality monitor for the experimenter (terminal and/or local web page), optional
+monitor_terminal, monitor_port = monitor_arguments(sys.argv)
+monitor = None
+if monitor_terminal or monitor_port:
+    monitor = Monitor(terminal = sys.stderr if monitor_terminal else None, port = monitor_port, design = design)
 
 """ " """ """ """ """
 Below is a short description of the used functions in the script:
 
 
-directory_set() : calls up a gui, creates a unique data file and intializes the TrialHandler
+directory_set() : calls up a gui, creates a unique data file and intializes the TrialHandler,
+                  offers to resume a session that crashed (from its trial log)
+
+prepared_directory_set(): the same for a session prepared by rpep_setup, without the gui
+
+quit_experiment(): syncs the trial log to disk (and the collector) and quits
 
 wait_for_keypress(): simply halts the script until relevant keys are pressed 
                      and stops the script if the escape key is pressed
@@ -112,18 +176,28 @@ do_they_get it(): makes sure the participant understands instructions
 
 instructions_per_block(): adjust instructions depending on the experimental block
 
-counterbalance(): counterbalances the block order between participants
-
-randomize(): creates the dataFram, transforms into a randomized list
-             that has all the relevant information. If the user sets the object 
+session_schedule() (rpep_design): counterbalances the block order between participants and
+             creates the randomized trial list of the whole session at once, with all the relevant information. If the user sets the object 
              'testrun' to 1, this list is a lot shorter and data isn't logged
 
-create_reward_stimulus(): creates the relevant reward description 
+randomize(): hands the trials of a block from the session schedule to a TrialHandler
 
-create_trial_stimulus(): creates the relevant target flanker stimulus
+build_stimulus_pool(): creates all text objects of the trial loop once per session
+
+create_reward_stimulus(): picks the relevant reward description from the pool
+
+create_trial_stimulus(): picks the relevant target flanker stimulus from the pool
 
 performance_processing(): takes the results of the trial and spits out
                           the accuracy, the earned reward and relevant feedback
+
+frames_for(): converts a duration in seconds into a number of screen refreshes
+
+show_phase(): presents stimuli for an exact number of frames and logs
+              the intended and actual onset of that phase (every flip goes into the frame log)
+
+collect_response(): waits for the response to the target and returns the key,
+                    the RT relative to the flip and the RT of the old timer
 """ """ """ """ """ """ """
 
 ####################################################
@@ -131,8 +205,19 @@ performance_processing(): takes the results of the trial and spits out
 ####################################################
 
 
+# Syncs the trial log to disk before quitting, so no finished trial is lost
+def quit_experiment():
+    if trial_log is not None:
+        trial_log.close()
+    if collector is not None:
+        #the session stays open at the collector, so it can be resumed
+        collector.close(finished = False)
+    if monitor is not None:
+        monitor.close()
+    core.quit()
+
 # Global event key (with modifier) to quit the experiment ("shutdown key").
-event.globalKeys.add(key='q', modifiers=['ctrl'], func=core.quit)
+event.globalKeys.add(key='q', modifiers=['ctrl'], func=quit_experiment)
 
 
 # Creating a file for the participant and their data
@@ -162,6 +247,17 @@ def directory_set():
         #GUI object
         myDlg = gui.DlgFromDict(dictionary = info, title = "Response Conflict Experiment",show = False)
         myDlg.show()
+        #with a collector the number and its counterbalancing assignment are claimed for this station first
+        #(an empty number takes the next free one), a number refused by the checks below is released again
+        assignment = None
+        if collector is not None:
+            assignment = collector.claim(info["Participant number"], groups = len(design["block_scales"]))
+            if assignment is None:
+                myDlg2 = gui.Dlg(title = "Error")
+                myDlg2.addText("Try another participant number ({0})".format(collector.error))
+                myDlg2.show()
+                continue
+            info["Participant number"] = str(assignment["participant"])
         #Creating a folder for the participant
         # WARNING !!! make sure to create a folder with the name 'DATA' in the same location as the script
         directory_to_write_to = my_directory + slash + "DATA" +slash + "subject_"+info["Participant number"]
@@ -173,10 +269,23 @@ def directory_set():
         filename = directory_to_write_to + slash +"subject_" + str(info["Participant number"]) + "_data"
 
         #checking if file already exists or not
+        completed_blocks = {}
         if info["Participant number"].isdigit() == True:
+            #a session of this participant that didn't finish can be resumed after its last completed block
+            completed_blocks = read_completed_blocks(filename + "_trials.jsonl")
+            if completed_blocks and max(completed_blocks) < n_blocks - 1:
+                myDlg3 = gui.Dlg(title = "Resume")
+                myDlg3.addText("Participant {0} completed block {1}, resume the session from block {2}?".format(info["Participant number"], max(completed_blocks), max(completed_blocks) + 1))
+                myDlg3.show()
+                if myDlg3.OK:
+                    already_exists = False
+                    continue
+                completed_blocks = {}
             if not os.path.isfile(filename+".csv"):
                     already_exists = False
             else:
+                if assignment is not None:
+                    collector.release()
                 myDlg2 = gui.Dlg(title = "Error")
                 myDlg2.addText("Try another participant number")
                 myDlg2.show()
@@ -188,10 +297,32 @@ def directory_set():
     #creating an ExperimentHandler object (in the correct location ! yay !)
     thisExp = data.ExperimentHandler(dataFileName=filename)
     
-    #returning the relevant variables
-    return thisExp, info
-
-
+    #returning the relevant variables (the completed blocks of a resumed session and the assignment of the collector)
+    return thisExp, info, completed_blocks, assignment
+
+
+## The data file of a session prepared by rpep_setup lives next to its session file,
+## the participant info and the resume decision come from the session
+def prepared_directory_set(session):
+    filename = session_file[:-len(session_suffix)]
+    if os.path.isfile(filename + ".csv"):
+        raise RuntimeError("{0}.csv already exists, prepare the session again with rpep_setup.py".format(filename))
+    #the collector records the assignment the session was prepared with (its counterbalancing or allocation)
+    assignment = None
+    if collector is not None:
+        assignment = collector.claim(session["info"]["Participant number"], groups = len(design["block_scales"]),
+                                     assignment = {"c_b": session["c_b"], "seed": session["seed"], "key mapping": None})
+        if assignment is None:
+            raise RuntimeError("The collector refused the participant number: {0}".format(collector.error))
+        if (assignment["c_b"], assignment["seed"]) != (session["c_b"], session["seed"]):
+            raise RuntimeError("The collector assigned participant {0} another counterbalancing than the prepared session".format(
+                assignment["participant"]))
+
+    completed_blocks = {}
+    if session["resume"]:
+        completed_blocks = read_completed_blocks(filename + "_trials.jsonl")
+    thisExp = data.ExperimentHandler(dataFileName=filename)
+    return thisExp, session["info"], completed_blocks, assignment
 
 
 #waits for key to be pressed returns list with key pressed
@@ -199,7 +330,7 @@ def wait_for_keypress():
     keys = event.waitKeys(keyList = ['space','b','escape'])
     if keys[0] == 'escape':
         win.close()
-        core.quit()
+        quit_experiment()
     else:
         return keys
 
@@ -289,131 +420,61 @@ def do_they_get_it():
     return
 
 
-#counterbalancing the subjects for block design
-def counterbalance(participant_number):
-    if participant_number%2 == 0:
-        c_b = 1 
-    else:
-        c_b = 0
+# RANDOMIZATION: the trials of every block are created (and randomized) at the start of the session
+# by build_schedule(), this only hands the trials of the block over to a TrialHandler
+def randomize(block):
+    trials = data.TrialHandler(trialList = block_trial_lists[block], nReps = 1, method = 'sequential')
+    # the practice block isn't logged
+    if block != 0:
+        thisExp.addLoop(trials)
     
-    return c_b
+    return trials
 
 
-# RANDOMIZATION: creates the list of trials and their info, randomizes them according to block
-# if the option testrun is set to '1' in the GUI then this list is significantly shortened
-def randomize(c_b, block):
-    
-    # Variables and their Parameters
-    bins = ['Bin_1','Bin_2','Bin_3','Bin_4','Bin_5']
-    scaleType = ['Prob','Det']
-    congruency = ['L_Con','R_Con','L_Incon','R_Incon']
-    
-    # Inserting the parameters into the block design
- 
-    if block !=0:
-        if block%2 == c_b:
-            Design = data.createFactorialTrialList({"Bins": bins, "Congruency": congruency})
-            dataFrame = pandas.DataFrame.from_dict(Design)
-            dataFrame["ScaleType"] = "Prob"
-        else:
-            Design = data.createFactorialTrialList({"Bins": bins, "Congruency": congruency})
-            dataFrame = pandas.DataFrame.from_dict(Design)
-            dataFrame["ScaleType"] = "Det"
-    else:
-        Design = data.createFactorialTrialList({"ScaleType": scaleType,"Bins": bins, "Congruency": congruency})
-        dataFrame = pandas.DataFrame.from_dict(Design)
 
-    # Adding in index tags and correct response column via DataFrame()
-    
-    ##adding in index tags
-    dataFrame["Tag"] = range(len(dataFrame))
-    
-    ##adding in correct responses 
-    dataFrame['CorAns'] = dataFrame["Congruency"]
-    dataFrame['CorAns'].replace(['L_Con','R_Con','L_Incon','R_Incon'],[left_key,right_key,left_key,right_key],inplace = True)
+# Scale type kind ('probabilistic' or 'deterministic') per scale type name
+scale_kind_names = dict(zip(design["scale_types"], [rpep_design.scale_kinds[kind] for kind in design["scale_kind"]]))
+# Bin and scale type codes per name
+bin_codes = dict((bin_name, code) for code, bin_name in enumerate(design["bins"]))
+scale_codes = dict((scale_name, code) for code, scale_name in enumerate(design["scale_types"]))
 
-    ##adding in reward magnitude
-    dataFrame['BinSize'] =  dataFrame['Bins']
-    dataFrame['BinSize'].replace(['Bin_1','Bin_2','Bin_3','Bin_4','Bin_5'],[0,20,50,80,100],inplace = True)
+# Builds every text object used inside the trial loop once per session,
+# so no TextStim has to be created (and no glyphs rendered) between fixation and target
+def build_stimulus_pool():
+    pool = {"flanker": {}, "reward": {}, "announcement": {}, "feedback": {}}
 
-    
-    
-    #Convert dataframe back to list of dictionaries
-    trial_list = pandas.DataFrame.to_dict(dataFrame, orient = "records")
-    
+    ## target flanker stimuli
+    for congruency, flanker in zip(design["congruencies"], design["flankers"]):
+        pool["flanker"][congruency] = visual.TextStim(win, text = flanker, units = 'norm', height = .12)
 
+    ## reward announcements and every possible reward size for every scale type
+    max_reward = int(design["bin_sizes"].max()) + design["noise_upper_limit"]
+    for scale_type in design["config"]["scale_types"]:
+        pool["announcement"][scale_type["name"]] = visual.TextStim(win, text = scale_type["announcement"], pos = [0,0.2])
+        for reward_size in range(max_reward + 1):
+            pool["reward"][(scale_type["name"], reward_size)] = visual.TextStim(win, text = scale_type["format"].format(reward_size), color = [0,0.7,1])
 
+    ## feedback
+    pool["feedback"]["practice"] = visual.TextStim(win, text = "Blijf oefenen!")
+    pool["feedback"]["too slow"] = visual.TextStim(win, text = "Te traag!")
+    for earned_reward in range(max(max_reward, design["probabilistic_reward"]) + 1):
+        pool["feedback"][earned_reward] = visual.TextStim(win, text = "+{0}".format(earned_reward))
 
-    # TESTRUN
-    # If the experimenter wishes to test-run option, reduced amount of trials are given
-    if int(info["testrun"]) == 1:
-        
-        ## including a practice block
-        if block == 0:
-            trials = data.TrialHandler(trialList = random.sample(trial_list,n_practice_trials),  nReps = 1, method = "random")
-        else: 
-            trials = data.TrialHandler(trialList = random.sample(trial_list,n_test_trials), nReps=1, method='random')
-            thisExp.addLoop(trials)   
-    else:
-        if block == 0:
-            trials = data.TrialHandler(trialList = random.sample(trial_list,n_practice_trials), nReps=1, method='random')
-        else:
-            trials = data.TrialHandler(trialList = trial_list, nReps=n_trial_rep, method='random')
-            thisExp.addLoop(trials)
-    
-    return trials
-
-
+    return pool
 
 # Creates the description of the type of reward of each trial
 def create_reward_stimulus(trial):
-    reward_announcement = visual.TextStim(win, text = "")
-    reward_size_text = visual.TextStim(win, text = "")
-    rand_noise  = noise_upper_limit + 1
-
-    while abs(rand_noise) > noise_upper_limit:
+    #the reward size (bin size and noise) is drawn in advance for the whole session (see build_schedule)
+    reward_size = trial["Reward Size"]
 
-        rand_noise = round(int(np.random.normal(0,5,1)),2)
-        
-    if trial["Bins"] == "Bin_1":
-        reward_size = int(trial['BinSize'])
-    elif trial["Bins"] == "Bin_2":
-        reward_size = int(trial['BinSize']  + rand_noise)
-    elif trial["Bins"] == "Bin_3":
-        reward_size = int(trial['BinSize']  + rand_noise)
-    elif trial["Bins"] == "Bin_4":
-        reward_size = int(trial['BinSize']  + rand_noise)
-    else:
-        reward_size = int(trial['BinSize']  - abs(rand_noise))
-
-
-    if trial["ScaleType"] == "Prob":
-    	reward_announcement.text = "The chance of a reward is:"
-        reward_size_text.text = "{0} %".format(reward_size)
-        reward_size_text.color = [0,0.7,1]
-    else:
-    	reward_announcement.text = "The size of the reward is:"
-        reward_size_text.text = "{0}".format(reward_size)
-        reward_size_text.color = [0,0.7,1]
+    reward_announcement = stimulus_pool["announcement"][trial["ScaleType"]]
+    reward_size_text = stimulus_pool["reward"][(trial["ScaleType"], reward_size)]
 
-
-
-    reward_announcement.pos = [0,0.2] 
     return reward_size, reward_announcement, reward_size_text
 
-# Creates the relevant target stimulus depending on the trial
+# Returns the relevant target stimulus depending on the trial
 def create_trial_stimulus(trial):
-    trial_stimulus = visual.TextStim(win, text = '',units = 'norm', height = .12)
-    if trial["Congruency"] == "L_Con":
-        trial_stimulus.text = "<<<<<"
-    elif trial["Congruency"] == "R_Con":
-        trial_stimulus.text = ">>>>>"
-    elif trial["Congruency"] == "L_Incon":
-        trial_stimulus.text = ">><>>"
-    else:
-        trial_stimulus.text = "<<><<"
-    
-    return trial_stimulus 
+    return stimulus_pool["flanker"][trial["Congruency"]]
 
 # Processes how the participant answered the relevant trial
 def performance_processing(block, trial, rt, key_press, reward_size,response_deadline):
@@ -431,48 +492,51 @@ def performance_processing(block, trial, rt, key_press, reward_size,response_dea
             
     
     # giving the participant the reward they deserve
-    if accuracy == 1 and trial["ScaleType"] == "Det":
+    if accuracy == 1 and scale_kind_names[trial["ScaleType"]] == "deterministic":
         earned_reward = reward_size
-    elif accuracy == 1 and trial["ScaleType"] == "Prob":
-        earned_it = np.random.choice([True,False],p = [(reward_size/100),(1-(reward_size/100))])
-        if earned_it == True:
-            earned_reward = 100
+    elif accuracy == 1 and scale_kind_names[trial["ScaleType"]] == "probabilistic":
+        #the outcome is drawn in advance for the whole session (see build_schedule)
+        if trial["Prob Outcome"]:
+            earned_reward = design["probabilistic_reward"]
         else:
             earned_reward = 0   
     else:
         earned_reward = 0
     
     if block == 0:
-        feedback_text = visual.TextStim(win, text = "Blijf oefenen!")
+        feedback_text = stimulus_pool["feedback"]["practice"]
         total_reward = 0
         total_accuracy = 0
     else:
 
-        reward_counter.append(earned_reward)
-        acc_counter.append(accuracy)
-        total_accuracy = round((sum(acc_counter)/len(acc_counter))*100,1)
-        total_reward = sum(reward_counter)
+        performance.add(accuracy, earned_reward, scale_codes[trial["ScaleType"]], bin_codes[trial["Bins"]])
+        total_accuracy = performance.accuracy_percent()
+        total_reward = performance.total_reward
 
         if rt > response_deadline:
-            feedback_text = visual.TextStim(win, text = "Te traag!")
+            feedback_text = stimulus_pool["feedback"]["too slow"]
         else:
-            feedback_text = visual.TextStim(win, text = "+{0}".format(earned_reward))
+            feedback_text = stimulus_pool["feedback"][earned_reward]
         
 
     return feedback_text, total_reward, earned_reward, accuracy, total_accuracy
 
 #adjusting response deadline relative to performance  
-
-def update_deadline(acc_counter,response_deadline):
+#with an accuracy target (performance section of the config) the deadline only gets shorter
+#while the accuracy of the last trials reaches the target
+def update_deadline(accuracy,response_deadline):
     
-    lower_limit = 0.42  
-    upper_limit = 0.82
+    lower_limit = design["deadline"]["lower"]
+    upper_limit = design["deadline"]["upper"]
+    accuracy_target = design["performance"]["accuracy_target"]
 
     if lower_limit <= response_deadline <= upper_limit:
         if accuracy == 1:
-            response_deadline = response_deadline - 0.01
+            rolling_accuracy = performance.rolling_accuracy()
+            if accuracy_target is None or rolling_accuracy is None or rolling_accuracy >= accuracy_target:
+                response_deadline = response_deadline - design["deadline"]["step_correct"]
         else:  
-            response_deadline = response_deadline + 0.08
+            response_deadline = response_deadline + design["deadline"]["step_error"]
     else: 
         if response_deadline < lower_limit:
             response_deadline = lower_limit
@@ -481,6 +545,66 @@ def update_deadline(acc_counter,response_deadline):
     return round(response_deadline,2)
     
 
+# converts a duration (in seconds) into a whole number of screen refreshes
+def frames_for(duration):
+    return max(1, int(round(duration*frame_rate)))
+
+# Presents the stimuli for the number of frames that matches the duration (frame-locked),
+# the intended and actual onset of the phase are stored in phase_times.
+# Returns the intended onset of the next phase
+def show_phase(stimuli, duration, phase, intended_onset, phase_times):
+    n_frames = frames_for(duration)
+    for frame in range(n_frames):
+        for stimulus in stimuli:
+            stimulus.draw()
+        flip_time = win.flip()
+        if frame == 0:
+            actual_onset = flip_time
+            #the first phase of a block has no preceding phase to be scheduled on
+            if intended_onset is None:
+                intended_onset = actual_onset
+            frame_log.add_flip(phase, flip_time, intended_onset)
+        else:
+            frame_log.add_flip(phase, flip_time)
+    phase_times[phase + " Onset Intended"] = intended_onset
+    phase_times[phase + " Onset Actual"] = actual_onset
+
+    return actual_onset + n_frames*frame_duration
+
+
+# Waits for a response to the target that was just flipped on screen.
+# Returns the response, the RT relative to the flip of the target and the RT of the old experiment_timer
+def collect_response(response_deadline):
+    if response_backend == 'keyboard':
+        #the deadline counts from the flip of the target, not from this call
+        keys = kb.waitKeys(maxWait = response_deadline - kb.clock.getTime(), keyList = [left_key,right_key,'escape'], waitRelease = False, clear = False)
+        rt_timer = experiment_timer.getTime()
+        if keys:
+            #the key press itself is stamped, not the moment the loop wakes up
+            response = [keys[0].name]
+            rt = keys[0].rt
+        else:
+            response = None
+            rt = kb.clock.getTime()
+    else:
+        response = event.waitKeys(keyList = [left_key,right_key,'escape'], maxWait = response_deadline)
+        rt_timer = experiment_timer.getTime()
+        rt = rt_timer
+
+    return response, rt, rt_timer
+
+
+#the accuracy of the last trials and per scale type for the block feedback (when the config asks for it)
+def performance_feedback():
+    if not design["performance"]["feedback"] or performance.rolling_accuracy() is None:
+        return ""
+    lines = ["Je laatste {0} antwoorden waren {1}% juist".format(min(performance.window, performance.n), int(round(performance.rolling_accuracy()*100)))]
+    for code, scale_name in enumerate(design["scale_types"]):
+        condition = performance.condition(code)
+        if condition["n"]:
+            lines.append("{0}: {1}% juist".format(scale_name, int(round(condition["accuracy"]*100))))
+    return "\n\n" + "\n".join(lines)
+
 #adjust instructions per block when needed
 def instructions_per_block(c_b, block, total_reward):
     
@@ -488,19 +612,21 @@ def instructions_per_block(c_b, block, total_reward):
             instructions.text = "Ga aan de slag met de oefenronde\n\nDruk de spatiebalk om te beginnen"
             block_completed.text = "Laten we beginnen met het echte experiment!\n\nDruk de spatiebalk om verder te gaan"   
     else: 
-        if block%2 == c_b:
-            instructions.text = "Voor elke reeks is er een bepaalde kans om 100 punten te verdienen na een juist antwoord\nEr verschijnt telkens een percentage in het blauw die toont wat die kans is\n\nDruk de spatiebalk om de ronde te beginnen!"
+        #the scale type of the block comes from the design matrix of the counterbalancing group
+        block_scale = design["block_scales"][c_b, block]
+        if rpep_design.scale_kinds[design["scale_kind"][block_scale]] == "probabilistic":
+            instructions.text = "Voor elke reeks is er een bepaalde kans om {0} punten te verdienen na een juist antwoord\nEr verschijnt telkens een percentage in het blauw die toont wat die kans is\n\nDruk de spatiebalk om de ronde te beginnen!".format(design["probabilistic_reward"])
             
             if block == n_blocks:
                 block_completed.text = "Dat was de laatste ronde ! \n\nDruk de spatiebalk om verder te gaan"
             else:
-                block_completed.text = "Tot nu heb je al {0} Punten of {1} euro! \n\nDruk de spatiebalk om verder te gaan".format(total_reward,round((total_reward/16000),2))
+                block_completed.text = "Tot nu heb je al {0} Punten of {1} euro!{2} \n\nDruk de spatiebalk om verder te gaan".format(total_reward,round((total_reward/16000),2),performance_feedback())
 
         else:
             if block == n_blocks:
                 block_completed.text = "Dat was de laatste ronde ! \n\nDruk de spatiebalk om verder te gaan"
             else:
-                block_completed.text = "Tot nu heb je al {0} Punten of {1} euro! \n\nDruk de spatiebalk om verder te gaan".format(total_reward,round((total_reward/16000),2))
+                block_completed.text = "Tot nu heb je al {0} Punten of {1} euro!{2} \n\nDruk de spatiebalk om verder te gaan".format(total_reward,round((total_reward/16000),2),performance_feedback())
            
             instructions.text = "Voor elke reeks komt er een cijfer in het blauw dat aantoont hoeveel punten je precies kan verdienen als je een reeks correct beantwoordt\n\nDruk de spatiebalk om verder te gaan"
 
@@ -515,29 +641,79 @@ def instructions_per_block(c_b, block, total_reward):
 ## as well as create the ExperimentHandler object and file location.
 ## The participants information is saved in the 'info' dictionary 
 ## and the ExperimentHandler object in 'thisExp'.
-win.fullscr = False
-thisExp ,info = directory_set()
-win.fullscr = True
-
-
-
-
-#Welcome message and explanation
-experiment_init_instructions()
-
-#Making sure the subjects have understood the instructions
-do_they_get_it()
-
-#counterbalancing between participants for blocked design
-c_b = counterbalance(int(info['Participant number']))
+if session_file is None:
+    win.fullscr = False
+    thisExp ,info, completed_blocks, assignment = directory_set()
+    win.fullscr = True
+    #an allocation of the collector can swap the keys of the config
+    if assignment is not None and assignment["key mapping"] == 1:
+        design = rpep_design.compile_design(dict(design["config"], keys = {"left": design["config"]["keys"]["right"], "right": design["config"]["keys"]["left"]}))
+        left_key, right_key = design["keys"]
+else:
+    thisExp ,info, completed_blocks, assignment = prepared_directory_set(session)
+
+#resuming a session: the rows of the completed blocks go back into the data file and the counters
+first_block = 0
+if completed_blocks:
+    first_block = max(completed_blocks) + 1
+    for completed_block in sorted(completed_blocks):
+        for row in completed_blocks[completed_block]:
+            for name in row:
+                thisExp.addData(name, row[name])
+            thisExp.nextEntry()
+            if completed_block != 0:
+                performance.add(row["Accurate Response"], row["Earned Reward"], scale_codes.get(row["ScaleType"]), bin_codes.get(row["Bins"]))
+            #the deadline continues from the last completed trial
+            if "Response Deadline" in row:
+                response_deadline = update_deadline(row["Accurate Response"], row["Response Deadline"])
+
+#every trial is streamed to this log as soon as it is done, by a writer thread
+#(the trial loop only queues the rows, the disk is never waited for between two flips).
+#The writer also keeps the trials in a compact column store, saved after every block
+trial_store = TrialStore(capacity = int(sum(design["block_trials"])), subject = "Subj_{0}".format(info["Participant number"]), design = design)
+for completed_block in sorted(completed_blocks):
+    for row in completed_blocks[completed_block]:
+        trial_store.append(row)
+trial_log = TrialLog(thisExp.dataFileName + "_trials.jsonl", first_block = first_block, background = True,
+                     store = trial_store, store_file = thisExp.dataFileName + "_trials.npz")
+#every flip of the trial loop is recorded, the dropped frames per phase are summarised per block
+frame_log = FrameLog(frame_duration, thisExp.dataFileName + "_flips.csv", thisExp.dataFileName + "_timing.csv")
+
+#creating every trial text object before the first trial
+stimulus_pool = build_stimulus_pool()
+
+
+
+#a resumed session skips the introduction and the practice
+if first_block == 0:
+    #Welcome message and explanation
+    experiment_init_instructions()
+
+    #Making sure the subjects have understood the instructions
+    do_they_get_it()
+
+#counterbalancing between participants for blocked design and the trial schedule of the whole session (all blocks)
+#all randomness of the session comes from its seed, so a session can be replayed exactly
+if session_file is None:
+    #creating the schedule and saving it next to the data, with the counterbalancing assigned by the collector if there is one
+    if assignment is not None:
+        c_b, seed = assignment["c_b"], assignment["seed"]
+        schedule = build_schedule(c_b, testrun = info["testrun"], seed = seed, design = design)
+    else:
+        c_b, seed, schedule = session_schedule(info['Participant number'], testrun = info["testrun"], design = design)
+    export_schedule(schedule, thisExp.dataFileName + "_schedule.csv", design)
+else:
+    #precomputed (and exported) by rpep_setup
+    c_b, seed, schedule = session["c_b"], session["seed"], session["schedule"]
+block_trial_lists = schedule_trial_lists(schedule, design = design)
 
-total_reward = sum(reward_counter)
+total_reward = performance.total_reward
 
 #blockloop
-for  block in range(n_blocks):
+for  block in range(first_block, n_blocks):
     
-    ##randomizing the trials
-    trials = randomize(c_b, block)
+    ##the (randomized) trials of this block
+    trials = randomize(block)
     
     ##giving the instructions
     instructions_per_block(c_b, block,total_reward)
@@ -546,62 +722,89 @@ for  block in range(n_blocks):
     wait_for_keypress()
 
 
+    #intended onset of the next phase (frame-locked), none at the start of a block
+    next_onset = None
+    frame_log.start_block(block)
+
     #trail loop !
     for trial in trials: 
+        phase_times = {}
         
         # initiate the reward description
         reward_size, reward_announcement, reward_size_text = create_reward_stimulus(trial)
         #reward_announcement.draw()
-        reward_size_text.draw()
-        win.flip()
-        time.sleep(t_reward_announcement)
+        next_onset = show_phase([reward_size_text], t_reward_announcement, "Reward", next_onset, phase_times)
         
         ## Fixation cross
-        fix_cross.draw()
-        win.flip()
-        time.sleep(t_fix_cross)
+        next_onset = show_phase([fix_cross], t_fix_cross, "Fixation", next_onset, phase_times)
         
         ##Initializing a trial
         trial_stimulus = create_trial_stimulus(trial)
         event.clearEvents()
         trial_stimulus.draw()
-        win.flip()
+        #the keyboard clock starts at the flip of the target
+        win.callOnFlip(kb.clock.reset)
+        win.callOnFlip(kb.clearEvents, eventType = 'keyboard')
+        target_onset = win.flip()
+        frame_log.add_flip("Target", target_onset, next_onset)
+        phase_times["Target Onset Intended"] = next_onset
+        phase_times["Target Onset Actual"] = target_onset
 
         experiment_timer.reset()
+        #gap between the flip and the reset of the old timer
+        timer_reset_delay = core.getTime() - target_onset
 
         ##wait for response + escape function
-        response = event.waitKeys(keyList = [left_key,right_key,'escape'], maxWait = response_deadline)
-        #get the reaction time
-        rt = experiment_timer.getTime()
+        response, rt, rt_timer = collect_response(response_deadline)
         experiment_times.append(rt)
-        #logging a non-response
-        if rt >= response_deadline:
+        #logging a non-response (no key before the deadline)
+        if response is None or rt >= response_deadline:
             response = "None"
         #escape option
         if response[0] == 'escape':
-            core.quit()
+            quit_experiment()
             win.close()      
 
         # Feedback based on conditions and performance
         feedback_text, total_reward, earned_reward, accuracy, total_accuracy = performance_processing(block, trial, rt, response, reward_size,response_deadline)
+        # the deadline that was in effect on this trial
+        trial_deadline = response_deadline
         # Updating response deadline relative to total accuracy
         response_deadline = update_deadline(accuracy,response_deadline)
         
-        feedback_text.draw()
-        win.flip()
-        time.sleep(t_feedback)
-        win.flip()
-        time.sleep(t_blank_screen)
-
-        ## logging the data onto the csv file
-        trials.addData("Accurate Response",accuracy)
-        trials.addData('response', response[0])
-        trials.addData('RT',rt)
-        trials.addData('Block',block)
-        trials.addData('Reward Size', reward_size)
-        trials.addData("Earned Reward", earned_reward)
+        #feedback follows the response, so it is scheduled on the first frame after it
+        next_onset = show_phase([feedback_text], t_feedback, "Feedback", None, phase_times)
+        next_onset = show_phase([], t_blank_screen, "Blank", next_onset, phase_times)
+
+        ## logging the data onto the csv file (and streaming it to the trial log)
+        trial_record = {"Accurate Response": accuracy,
+                        'response': response[0],
+                        'RT': rt,
+                        'RT Timer': rt_timer,
+                        'RT Timer Flip': rt_timer + timer_reset_delay,
+                        'Block': block,
+                        'Response Deadline': trial_deadline,
+                        'Reward Size': reward_size,
+                        "Earned Reward": earned_reward,
+                        "Seed": seed,
+                        "Frame Rate": frame_rate}
+        trial_record.update(phase_times)
+        for name in trial_record:
+            trials.addData(name, trial_record[name])
         thisExp.nextEntry()
+        trial_record.update(trial)
+        trial_log.write(trial_record)
+        if collector is not None:
+            #sent by a background thread, the display loop doesn't wait for the network
+            collector.stream(trial_record)
+        if monitor is not None:
+            #handed over to the monitor thread, never waited for
+            monitor.put(trial_record)
     
+    trial_log.end_block(block)
+    if monitor is not None:
+        monitor.end_block(block)
+    frame_log.end_block()
     instructions_per_block(c_b, block,total_reward)
 
     block_completed.draw()
@@ -614,7 +817,7 @@ thisExp.addData("total_reward",total_reward)
 
 monetary_reward = round((total_reward/16000),2)
 
-instructions.text = "Bedankt voor uw deelname. In totaal heb je {0} punten ofwel {1} euro!!\n Je antwoord was juist {2}% van de tijd".format(total_reward,monetary_reward,total_accuracy)
+instructions.text = "Bedankt voor uw deelname. In totaal heb je {0} punten ofwel {1} euro!!\n Je antwoord was juist {2}% van de tijd".format(total_reward,monetary_reward,performance.accuracy_percent())
 instructions.draw()
 win.flip()
 wait_for_keypress()
@@ -622,6 +825,11 @@ instructions.text = "Informeer de proefleider dat het experiment is afgerond"
 instructions.draw()
 win.flip()
 wait_for_keypress()
+trial_log.close()
+if collector is not None:
+    collector.close()
+if monitor is not None:
+    monitor.close()
 win.close()
 core.quit()
         
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+
+Incremental aggregation of the participant data files
+
+directory_set() writes one DATA/subject_N/subject_N_data.csv per participant.
+This script merges them into one long format dataset (same columns as data_long.csv)
+plus the cell summary and design tables of rpep_analysis. A manifest keeps the size,
+modification time and hash of every subject file, so only new or changed files are parsed:
+new participants are appended, a changed or removed file rebuilds the dataset from the
+stored per-subject parts (without parsing the other subject files again).
+
+Usage:
+    python rpep_aggregate.py DATA --output DATA/data_long.csv
+
+find_subject_files(): all subject data files in the DATA tree
+
+subject_long_format(): converts one subject data file into the long format
+
+aggregate(): updates the merged dataset, its summary tables and the manifest
+
+"""
+from __future__ import division
+import argparse, json, os, re, shutil
+import pandas
+
+from rpep_analysis import long_dtypes, file_hash, cell_summary, design_table
+from rpep_design import design
+
+
+long_columns = list(long_dtypes)
+
+subject_file_pattern = re.compile(r'subject_(\d+)_data\.csv$')
+
+
+# All subject data files in the DATA tree, as {path relative to the tree: participant number}
+def find_subject_files(data_directory = "DATA"):
+    subject_files = {}
+    for root, directories, files in os.walk(data_directory):
+        for name in files:
+            match = subject_file_pattern.match(name)
+            if match:
+                path = os.path.relpath(os.path.join(root, name), data_directory)
+                subject_files[path] = int(match.group(1))
+    return subject_files
+
+
+# congruency condition of every congruency of the design (L_Con and R_Con are both Con)
+congruency_conditions = dict(zip(design["congruencies"], [design["conditions"][code] for code in design["congruency_condition"]]))
+
+
+# Converts the data file of one participant into the long format of data_long.csv:
+# only the experimental blocks, left and right conditions merged into Con/Incon
+def subject_long_format(filename, participant_number):
+    subject_data = pandas.read_csv(filename)
+    experimental = subject_data["Bins"].notna() & (subject_data["Block"].fillna(0) > 0)
+    subject_data = subject_data[experimental]
+
+    long_data = pandas.DataFrame({
+        "Accurate Response": subject_data["Accurate Response"],
+        "BinSize": subject_data["BinSize"],
+        "Bins": subject_data["Bins"],
+        "Congruency": subject_data["Congruency"].map(congruency_conditions),
+        "RT": subject_data["RT"],
+        "Reward Size": subject_data["Reward Size"],
+        "ScaleType": subject_data["ScaleType"],
+        "Subject": "Subj_{0}".format(participant_number),
+        # a non-response is logged as 'N' ("None"), which pandas may read as missing
+        "response": subject_data["response"].fillna("N").astype(str).str[0]})
+    return long_data[long_columns].reset_index(drop = True)
+
+
+# Cell summary (see rpep_analysis) of the long format data of one participant
+def _subject_cells(long_data):
+    typed = long_data.astype({name: dtype for name, dtype in long_dtypes.items() if name != "Subject"})
+    typed["Subject"] = typed["Subject"].astype("category")
+    return cell_summary(typed)
+
+
+# state of a file: size, modification time and hash
+def _file_state(filename):
+    file_stat = os.stat(filename)
+    return {"size": file_stat.st_size, "mtime": file_stat.st_mtime, "sha1": None}
+
+
+# writes a DataFrame as csv text, with or without header (appending)
+def _write_csv(frame, filename, append = False):
+    frame.to_csv(filename, mode = 'a' if append else 'w', header = not append, index = False)
+
+
+# concatenates csv part files (same header) into one file, without parsing them
+def _concatenate_parts(part_files, filename):
+    with open(filename, 'w') as merged:
+        for i, part_file in enumerate(part_files):
+            with open(part_file) as part:
+                header = part.readline()
+                if i == 0:
+                    merged.write(header)
+                shutil.copyfileobj(part, merged)
+
+
+# Updates the merged long format dataset, its cell summary (<output>_cells.csv), design table
+# (<output>_design.csv) and manifest (<output>.manifest.json) with the subject files in the DATA tree.
+# Returns which subject files were added, changed, removed and left unchanged
+def aggregate(data_directory = "DATA", output = None):
+    if output is None:
+        output = os.path.join(data_directory, "data_long.csv")
+    output_base = os.path.splitext(output)[0]
+    cells_output = output_base + "_cells.csv"
+    design_output = output_base + "_design.csv"
+    manifest_file = output + ".manifest.json"
+    parts_directory = output + ".parts"
+    if not os.path.isdir(parts_directory):
+        os.mkdir(parts_directory)
+
+    manifest = {"files": {}}
+    if os.path.isfile(manifest_file) and os.path.isfile(output):
+        with open(manifest_file) as manifest_in:
+            manifest = json.load(manifest_in)
+    known = manifest["files"]
+
+    ## which subject files are new, changed or removed
+    report = {"added": [], "changed": [], "removed": [], "unchanged": []}
+    subject_files = find_subject_files(data_directory)
+    for path in sorted(subject_files, key = lambda path: subject_files[path]):
+        state = _file_state(os.path.join(data_directory, path))
+        if path not in known:
+            report["added"].append(path)
+        elif state["size"] == known[path]["size"] and state["mtime"] == known[path]["mtime"]:
+            report["unchanged"].append(path)
+        else:
+            state["sha1"] = file_hash(os.path.join(data_directory, path))
+            if state["sha1"] == known[path]["sha1"]:
+                known[path]["mtime"] = state["mtime"]
+                report["unchanged"].append(path)
+            else:
+                report["changed"].append(path)
+    report["removed"] = [path for path in known if path not in subject_files]
+
+    ## parsing only the new and changed files
+    new_parts = []
+    for path in report["added"] + report["changed"]:
+        filename = os.path.join(data_directory, path)
+        participant_number = subject_files[path]
+        long_data = subject_long_format(filename, participant_number)
+        cells = _subject_cells(long_data)
+
+        part_name = "subject_{0}".format(participant_number)
+        _write_csv(long_data, os.path.join(parts_directory, part_name + "_long.csv"))
+        _write_csv(cells, os.path.join(parts_directory, part_name + "_cells.csv"))
+        new_parts.append((long_data, cells))
+
+        state = _file_state(filename)
+        state["sha1"] = file_hash(filename)
+        state["subject"] = participant_number
+        state["part"] = part_name
+        state["rows"] = len(long_data)
+        known[path] = state
+
+    for path in report["removed"]:
+        for suffix in ("_long.csv", "_cells.csv"):
+            part_file = os.path.join(parts_directory, known[path]["part"] + suffix)
+            if os.path.isfile(part_file):
+                os.remove(part_file)
+        del known[path]
+
+    ## new participants only: appending, otherwise rebuilding from the stored parts
+    if not report["changed"] and not report["removed"] and os.path.isfile(output) and os.path.isfile(cells_output):
+        for long_data, cells in new_parts:
+            _write_csv(long_data, output, append = True)
+            _write_csv(cells, cells_output, append = True)
+    else:
+        parts = [known[path]["part"] for path in sorted(known, key = lambda path: known[path]["subject"])]
+        _concatenate_parts([os.path.join(parts_directory, part + "_long.csv") for part in parts], output)
+        _concatenate_parts([os.path.join(parts_directory, part + "_cells.csv") for part in parts], cells_output)
+
+    ## the design table only needs the (small) cell summary
+    if known:
+        _write_csv(design_table(pandas.read_csv(cells_output)), design_output)
+
+    with open(manifest_file, 'w') as manifest_out:
+        json.dump(manifest, manifest_out, indent = 1)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Merges the participant data files into one long format dataset")
+    parser.add_argument("data_directory", nargs = '?', default = "DATA", help = "the DATA tree of the experiment")
+    parser.add_argument("--output", default = None, help = "merged long format dataset (default: DATA/data_long.csv)")
+    arguments = parser.parse_args()
+
+    report = aggregate(arguments.data_directory, arguments.output)
+    for status in ("added", "changed", "removed", "unchanged"):
+        print("{0}: {1}".format(status, len(report[status])))
+
+
+if __name__ == '__main__':
+    main()
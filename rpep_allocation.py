@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+
+Participant allocation tables
+
+counterbalance() takes the block order from the parity of the participant number, so dropouts and
+participant numbers spread over sites leave the groups unbalanced. An allocation table is computed
+once, before recruitment: a sequence of allocation cells (block order X key mapping X schedule variant),
+either in permuted blocks (every block of the sequence holds every cell once, in random order) or following
+a Latin square (the blocks are the rows of a randomised cyclic Latin square, so every cell also takes every
+position within a block equally often). The table is saved as an indexed .npz file, the allocations
+are appended to a record next to it (<table>.record.jsonl) as they happen: assigned, completed, dropped.
+
+A new participant takes one of the next free slots of the sequence at its site, the one whose cell
+has the fewest active (assigned or completed) sessions at that site, so the cells of dropped sessions are
+refilled first (ahead of their turn in the sequence). Looking up the allocation of a participant is a dictionary lookup.
+
+Usage:
+    python rpep_allocation.py create allocation.npz --slots 400 --method latin
+    python rpep_setup.py --participant 12 --allocation allocation.npz --site Ghent
+    python rpep_allocation.py sync allocation.npz --data DATA     (sessions with a data file are completed)
+    python rpep_allocation.py drop allocation.npz --participant 12
+    python rpep_allocation.py status allocation.npz
+
+allocation_cells(): the allocation cells of a design
+
+build_sequence(): a balanced sequence of allocation cells (permuted blocks or Latin square)
+
+create_table(): creates an allocation table file
+
+AllocationTable: the table with its record, assign(), lookup(), complete() and drop()
+
+allocated_session(): the design (key mapping), counterbalancing group and seed of an allocation
+
+allocation_seed(): the schedule seed of an allocation
+
+"""
+from __future__ import print_function
+import argparse, copy, itertools, json, os, sys, time
+import numpy as np
+
+from rpep_design import design, compile_design, session_seed
+
+
+factor_names = ["block order", "key mapping", "schedule variant"]
+record_suffix = ".record.jsonl"
+
+
+# The allocation cells of a design: every counterbalancing group (row of block_scales) X key mapping
+# (0: the keys of the config, 1: swapped) X schedule variant, as an n_cells X 3 array
+def allocation_cells(design = design, schedule_variants = 1):
+    n_groups = design["block_scales"].shape[0]
+    return np.array(list(itertools.product(range(n_groups), range(2), range(schedule_variants))), dtype = np.int16)
+
+
+# A sequence of n_slots cell indices in which every block of n_cells slots holds every cell once:
+# "blocked" shuffles every block, "latin" uses the rows of a cyclic Latin square (rows and cells in random order)
+def build_sequence(n_cells, n_slots, method = "blocked", seed = 0):
+    rng = np.random.default_rng(seed)
+    n_blocks = -(-n_slots//n_cells)
+    if method == "blocked":
+        blocks = np.argsort(rng.random((n_blocks, n_cells)), axis = 1)
+    elif method == "latin":
+        labels = rng.permutation(n_cells)
+        square = labels[(np.arange(n_cells)[:, None] + np.arange(n_cells)[None, :])%n_cells]
+        rows = np.concatenate([rng.permutation(n_cells) for i in range(-(-n_blocks//n_cells))])[:n_blocks]
+        blocks = square[rows]
+    else:
+        raise ValueError("Unknown allocation method: {0}".format(method))
+    return blocks.ravel()[:n_slots].astype(np.int16)
+
+
+# Creates an allocation table file (.npz) for the design and returns it as an AllocationTable
+def create_table(filename, n_slots = 400, design = design, schedule_variants = 1, method = "blocked", seed = 0):
+    if os.path.isfile(filename):
+        raise ValueError("{0} already exists".format(filename))
+    cells = allocation_cells(design, schedule_variants)
+    meta = {"method": method, "seed": seed, "schedule_variants": schedule_variants, "n_slots": n_slots,
+            "config": design["config"], "created": time.strftime("%Y-%m-%d %H:%M:%S")}
+    with open(filename, 'wb') as table_file:
+        np.savez(table_file, cells = cells, sequence = build_sequence(len(cells), n_slots, method, seed),
+                 meta = np.array(json.dumps(meta)))
+    return AllocationTable(filename)
+
+
+class AllocationTable(object):
+    # filename: the table file of create_table(), the record is <filename>.record.jsonl
+    def __init__(self, filename):
+        self.filename = filename
+        self.record_file = filename + record_suffix
+        with np.load(filename) as table:
+            self.cells = table["cells"]
+            self.sequence = table["sequence"]
+            self.meta = json.loads(str(table["meta"]))
+        self.n_cells = len(self.cells)
+        # participant: its allocation, per site: active sessions per cell, taken positions and the first free position
+        self.allocations = {}
+        self._counts = {}
+        self._taken = {}
+        self._first_free = {}
+        if os.path.isfile(self.record_file):
+            with open(self.record_file) as record:
+                for line in record:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        # a line cut off by a crash
+                        continue
+
+    def _site(self, site):
+        if site not in self._counts:
+            self._counts[site] = np.zeros(self.n_cells, dtype = np.int64)
+            self._taken[site] = set()
+            self._first_free[site] = 0
+        return self._counts[site]
+
+    # applies one record entry to the state of the table
+    def _apply(self, entry):
+        participant = str(entry["participant"])
+        if entry["status"] == "assigned":
+            counts = self._site(entry["site"])
+            counts[entry["cell"]] += 1
+            self._taken[entry["site"]].add(entry["position"])
+            while self._first_free[entry["site"]] in self._taken[entry["site"]]:
+                self._first_free[entry["site"]] += 1
+            self.allocations[participant] = dict(entry, participant = participant)
+        else:
+            allocation = self.allocations[participant]
+            if allocation["status"] != "dropped" and entry["status"] == "dropped":
+                self._counts[allocation["site"]][allocation["cell"]] -= 1
+            allocation["status"] = entry["status"]
+
+    def _record(self, entry):
+        with open(self.record_file, 'a') as record:
+            record.write(json.dumps(entry) + "\n")
+            record.flush()
+            os.fsync(record.fileno())
+        self._apply(entry)
+
+    # The allocation of a participant (a dictionary with "cell", "block order", "key mapping", "schedule variant",
+    # "site", "position" and "status"), None if the participant has none
+    def lookup(self, participant):
+        return self.allocations.get(str(participant))
+
+    # Allocates a participant at a site (or returns its allocation if it has one): of the next free slots of the sequence
+    # of the site, the one whose cell has the fewest active sessions at the site (the earliest of equal ones)
+    def assign(self, participant, site = ""):
+        allocation = self.lookup(participant)
+        if allocation is not None:
+            return allocation
+        counts = self._site(site)
+        # the next n_cells free slots: every cell is among them, a cell behind on the others is taken ahead of its turn
+        candidates = []
+        position = self._first_free[site]
+        while len(candidates) < self.n_cells and position < len(self.sequence):
+            if position not in self._taken[site]:
+                candidates.append(position)
+            position += 1
+        if not candidates:
+            raise ValueError("The allocation table {0} is full at site '{1}', create a larger one".format(self.filename, site))
+        position = min(candidates, key = lambda position: (counts[self.sequence[position]], position))
+        cell = int(self.sequence[position])
+        entry = {"participant": str(participant), "site": site, "position": position, "cell": cell, "status": "assigned",
+                 "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+        entry.update(zip(factor_names, [int(value) for value in self.cells[cell]]))
+        self._record(entry)
+        return self.lookup(participant)
+
+    def complete(self, participant):
+        self._set_status(participant, "completed")
+
+    # a dropped session no longer counts for its cell, the next participants refill it
+    def drop(self, participant):
+        self._set_status(participant, "dropped")
+
+    def _set_status(self, participant, status):
+        if self.lookup(participant) is None:
+            raise ValueError("Participant {0} has no allocation".format(participant))
+        self._record({"participant": str(participant), "status": status, "time": time.strftime("%Y-%m-%d %H:%M:%S")})
+
+    # Marks the assigned sessions with a data file (DATA/subject_<n>/subject_<n>_data.csv) as completed,
+    # returns their participant numbers
+    def record_completed(self, data_directory = "DATA"):
+        completed = []
+        for participant, allocation in list(self.allocations.items()):
+            data_file = os.path.join(data_directory, "subject_" + participant, "subject_" + participant + "_data.csv")
+            if allocation["status"] == "assigned" and os.path.isfile(data_file):
+                self.complete(participant)
+                completed.append(participant)
+        return completed
+
+    # Raises a ValueError when the design isn't the one of the config the table was created with
+    # (its allocation cells, e.g. the block orders, belong to that config)
+    def check_design(self, design):
+        if design["config"] != self.meta["config"]:
+            raise ValueError("The allocation table {0} was created with another experiment config".format(self.filename))
+
+    # Active (assigned or completed) sessions per site and cell
+    def balance(self):
+        return dict((site, counts.copy()) for site, counts in self._counts.items())
+
+
+# The design, counterbalancing group and schedule seed of the session of an allocation, from the config
+# the table was created with (a ValueError when design is another one):
+# the key mapping swaps the keys of the config, the schedule variant replaces the participant's own seed
+# (every participant of a variant gets the same trial order) when the table has more than one
+def allocated_session(allocation, participant_number, table, design = design):
+    table.check_design(design)
+    config = copy.deepcopy(table.meta["config"])
+    if allocation["key mapping"] == 1:
+        config["keys"] = {"left": config["keys"]["right"], "right": config["keys"]["left"]}
+    return compile_design(config), allocation["block order"], allocation_seed(allocation, participant_number, table)
+
+
+# The schedule seed of an allocation: the participant's own seed, or the seed of its schedule variant
+# when the table has more than one
+def allocation_seed(allocation, participant_number, table):
+    if table.meta["schedule_variants"] > 1:
+        return int(np.random.SeedSequence([table.meta["seed"], allocation["schedule variant"]]).generate_state(1)[0])
+    return session_seed(participant_number)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Participant allocation tables of the reward scale experiment")
+    parser.add_argument("command", choices = ["create", "status", "sync", "complete", "drop"])
+    parser.add_argument("table", help = "the allocation table file (.npz)")
+    parser.add_argument("--slots", type = int, default = 400, help = "create: number of participants the table holds")
+    parser.add_argument("--method", default = "blocked", choices = ["blocked", "latin"])
+    parser.add_argument("--variants", type = int, default = 1, help = "create: number of schedule variants")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--config", default = None, help = "create: experiment config (default: RPEP_CONFIG or rpep_config.json)")
+    parser.add_argument("--participant", default = None, help = "complete/drop: participant number")
+    parser.add_argument("--data", default = "DATA", help = "sync: the DATA folder")
+    arguments = parser.parse_args()
+
+    try:
+        if arguments.command == "create":
+            from rpep_design import load_design
+            table_design = load_design(arguments.config) if arguments.config else design
+            table = create_table(arguments.table, arguments.slots, table_design, arguments.variants, arguments.method, arguments.seed)
+        else:
+            table = AllocationTable(arguments.table)
+        if arguments.command == "sync":
+            print("Completed: {0}".format(", ".join(table.record_completed(arguments.data)) or "none"))
+        elif arguments.command in ("complete", "drop"):
+            getattr(table, arguments.command)(arguments.participant)
+    except ValueError as error:
+        print(error, file = sys.stderr)
+        sys.exit(1)
+
+    print("{0}: {1} cells ({2}), {3} slots, {4}".format(arguments.table, table.n_cells, " X ".join(factor_names),
+                                                        len(table.sequence), table.meta["method"]))
+    for site, counts in sorted(table.balance().items()):
+        print("site '{0}': active sessions per cell {1}".format(site, counts.tolist()))
+
+
+if __name__ == '__main__':
+    main()
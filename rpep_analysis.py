@@ -0,0 +1,383 @@
+"""
+
+Analysis of the accumulated long format dataset (data_long.csv)
+
+Every trial of the dataset belongs to one design cell of a subject:
+2 (Congruency) X 2 (ScaleType) X 5 (Bins). The summaries below are computed on
+integer cell codes with np.bincount (and one sort for the medians) instead of
+pandas groupby, so the whole dataset is summarised in one pass.
+
+load_long(): loads the long format dataset with explicit (categorical) dtypes,
+             through a binary columnar cache next to the csv file
+
+load_columns(): the columns of the dataset as (memory-mapped) arrays, from the cache
+
+load_store(): the dataset as a compact TrialStore (int8 factor codes, float32 RT)
+
+build_cache(): converts the csv file into the columnar cache
+
+cell_codes(): the design cell of every trial (per subject)
+
+cell_summary(): accuracy, mean and median RT per subject X Congruency X ScaleType X Bins
+
+congruency_effects(): the congruency (flanker) effect per subject X ScaleType X Bins
+
+design_table(): the 2X2X5 design cell table, averaged over subjects
+
+replay_deadlines(): reconstructs the adaptive response deadline of every trial
+
+add_deadlines(): adds the reconstructed deadline and the censoring (non-responses) to the dataset
+
+"""
+from __future__ import division
+import hashlib, json, os, re, warnings
+import numpy as np
+import pandas
+
+from rpep_design import design
+from rpep_design import (deadline_lower_limit, deadline_upper_limit,
+                         deadline_step_correct, deadline_step_error)
+
+
+# Factor levels of the long format dataset (of the design in rpep_config.json or RPEP_CONFIG, see rpep_design)
+congruency_levels = list(design["conditions"])
+scale_levels = list(design["scale_types"])
+bin_levels = list(design["bins"])
+response_levels = list(design["keys"]) + ['N']
+
+n_cells = design["n_cells"]
+
+long_dtypes = {"Accurate Response": np.int8,
+               "BinSize": np.int16,
+               "Bins": pandas.CategoricalDtype(bin_levels),
+               "Congruency": pandas.CategoricalDtype(congruency_levels),
+               "RT": np.float64,
+               "Reward Size": np.int16,
+               "ScaleType": pandas.CategoricalDtype(scale_levels),
+               "Subject": str,
+               "response": pandas.CategoricalDtype(response_levels)}
+
+
+# sorts subject labels on their number ('Subj_2' before 'Subj_10')
+def _subject_order(subject):
+    number = re.findall(r'\d+', subject)
+    if number:
+        return (0, int(number[-1]), subject)
+    return (1, 0, subject)
+
+
+# Reads the csv file itself, factors become categoricals with a fixed level order
+def read_long_csv(filename = "data_long.csv"):
+    long_data = pandas.read_csv(filename, dtype = long_dtypes)
+    subjects = sorted(long_data["Subject"].unique(), key = _subject_order)
+    long_data["Subject"] = long_data["Subject"].astype(pandas.CategoricalDtype(subjects))
+    return long_data
+
+
+## Columnar cache
+# The csv file is converted once into a folder next to it (data_long.csv.cache) with one .npy file
+# per column: string columns as integer codes (+ their levels), numeric columns as small dtypes.
+# The cache is rebuilt when the size, modification time and hash of the csv file no longer match.
+
+cache_dtypes = {"Accurate Response": np.int8,
+                "BinSize": np.int16,
+                "Reward Size": np.int16,
+                "RT": np.float32}
+
+cache_version = 1
+
+
+# folder of the cache of a csv file
+def cache_directory(filename):
+    return filename + ".cache"
+
+
+# sha1 of a file, read in chunks (also used to track the participant data files)
+def file_hash(filename):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as source:
+        for chunk in iter(lambda: source.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# smallest integer dtype that holds the codes of the levels
+def _code_dtype(n_levels):
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_levels <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+# Converts the csv file into the columnar cache and returns its description
+def build_cache(filename = "data_long.csv"):
+    directory = cache_directory(filename)
+    meta_file = os.path.join(directory, "meta.json")
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+    # the cache is invalid while it is being written
+    if os.path.isfile(meta_file):
+        os.remove(meta_file)
+
+    source_stat = os.stat(filename)
+    long_data = read_long_csv(filename)
+    columns = {}
+    for i, name in enumerate(long_data.columns):
+        column = long_data[name]
+        if isinstance(column.dtype, pandas.CategoricalDtype):
+            levels = [str(level) for level in column.cat.categories]
+            values = column.cat.codes.to_numpy().astype(_code_dtype(len(levels)))
+            columns[name] = {"file": "column_{0}.npy".format(i), "levels": levels}
+        else:
+            values = column.to_numpy().astype(cache_dtypes.get(name, np.float32))
+            columns[name] = {"file": "column_{0}.npy".format(i)}
+        np.save(os.path.join(directory, columns[name]["file"]), values)
+
+    meta = {"version": cache_version,
+            "size": source_stat.st_size,
+            "mtime": source_stat.st_mtime,
+            "sha1": file_hash(filename),
+            "columns": columns,
+            "order": list(long_data.columns)}
+    with open(meta_file, 'w') as meta_out:
+        json.dump(meta, meta_out)
+    return meta
+
+
+# Description of a valid cache of the csv file, None if the cache has to be (re)built
+def _valid_cache(filename):
+    meta_file = os.path.join(cache_directory(filename), "meta.json")
+    if not os.path.isfile(meta_file):
+        return None
+    with open(meta_file) as meta_in:
+        meta = json.load(meta_in)
+    if meta.get("version") != cache_version:
+        return None
+    # a cache built under another design (see rpep_design) has other factor levels
+    for name, column in meta["columns"].items():
+        dtype = long_dtypes.get(name)
+        if isinstance(dtype, pandas.CategoricalDtype) and column.get("levels") != [str(level) for level in dtype.categories]:
+            return None
+
+    source_stat = os.stat(filename)
+    if source_stat.st_size == meta["size"] and source_stat.st_mtime == meta["mtime"]:
+        return meta
+    # touched but possibly unchanged: only the hash decides
+    if source_stat.st_size == meta["size"] and file_hash(filename) == meta["sha1"]:
+        meta["mtime"] = source_stat.st_mtime
+        with open(meta_file, 'w') as meta_out:
+            json.dump(meta, meta_out)
+        return meta
+    return None
+
+
+# The columns of the dataset as arrays, memory-mapped from the cache (built when needed).
+# Returns the arrays and the levels of the coded (string) columns
+def load_columns(filename = "data_long.csv"):
+    meta = _valid_cache(filename)
+    if meta is None:
+        meta = build_cache(filename)
+
+    directory = cache_directory(filename)
+    arrays = {}
+    levels = {}
+    for name in meta["order"]:
+        column = meta["columns"][name]
+        arrays[name] = np.load(os.path.join(directory, column["file"]), mmap_mode = 'r')
+        if "levels" in column:
+            levels[name] = column["levels"]
+    return arrays, levels
+
+
+# Loads the long format dataset, factors become categoricals with a fixed level order.
+# With cache = True the data come from the columnar cache instead of the csv text
+def load_long(filename = "data_long.csv", cache = True):
+    if not cache:
+        return read_long_csv(filename)
+
+    arrays, levels = load_columns(filename)
+    long_data = {}
+    for name in arrays:
+        if name in levels:
+            long_data[name] = pandas.Categorical.from_codes(arrays[name], categories = levels[name])
+        else:
+            long_data[name] = arrays[name]
+    return pandas.DataFrame(long_data)
+
+
+# The dataset as a compact TrialStore (see rpep_trial_store), filled from the columnar cache
+def load_store(filename = "data_long.csv"):
+    from rpep_trial_store import TrialStore
+    arrays, levels = load_columns(filename)
+    store = TrialStore(capacity = len(arrays["RT"]))
+    store.extend(arrays, levels)
+    return store
+
+
+# Design cell of every trial within its subject: Congruency X ScaleType X Bins (0 - 19),
+# the codes follow the level order of congruency_levels, scale_levels and bin_levels
+def cell_codes(long_data):
+    congruency = long_data["Congruency"].cat.codes.to_numpy().astype(np.int64)
+    scale = long_data["ScaleType"].cat.codes.to_numpy().astype(np.int64)
+    bin_code = long_data["Bins"].cat.codes.to_numpy().astype(np.int64)
+    return (congruency*len(scale_levels) + scale)*len(bin_levels) + bin_code
+
+
+# Subject X design cell code of every trial, plus the number of subjects
+def subject_cell_codes(long_data):
+    subject = long_data["Subject"].cat.codes.to_numpy().astype(np.int64)
+    n_subjects = len(long_data["Subject"].cat.categories)
+    return subject*n_cells + cell_codes(long_data), n_subjects
+
+
+# Medians of values per group, with one sort instead of a groupby (NaN for empty groups)
+def grouped_median(groups, values, n_groups):
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    counts = np.bincount(groups, minlength = n_groups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    medians = np.full(n_groups, np.nan)
+    filled = counts > 0
+    lower = starts[filled] + (counts[filled] - 1)//2
+    upper = starts[filled] + counts[filled]//2
+    medians[filled] = (sorted_values[lower] + sorted_values[upper])/2
+    return medians
+
+
+# The design cells (one row per subject X Congruency X ScaleType X Bins) as a DataFrame
+def _cell_frame(subjects):
+    n_subjects = len(subjects)
+    cells = np.arange(n_subjects*n_cells)
+    within = cells%n_cells
+    return pandas.DataFrame({
+        "Subject": pandas.Categorical.from_codes(cells//n_cells, categories = subjects),
+        "Congruency": pandas.Categorical.from_codes(within//(len(scale_levels)*len(bin_levels)), categories = congruency_levels),
+        "ScaleType": pandas.Categorical.from_codes((within//len(bin_levels))%len(scale_levels), categories = scale_levels),
+        "Bins": pandas.Categorical.from_codes(within%len(bin_levels), categories = bin_levels)})
+
+
+# Accuracy, mean and median RT per subject X Congruency X ScaleType X Bins.
+# Accuracy is computed over all trials, the RTs only over the correct responses
+def cell_summary(long_data):
+    groups, n_subjects = subject_cell_codes(long_data)
+    n_groups = n_subjects*n_cells
+    accurate = long_data["Accurate Response"].to_numpy().astype(np.float64)
+    rt = long_data["RT"].to_numpy().astype(np.float64)
+    correct = accurate == 1
+
+    n_trials = np.bincount(groups, minlength = n_groups)
+    n_correct = np.bincount(groups, weights = accurate, minlength = n_groups)
+    rt_sum = np.bincount(groups[correct], weights = rt[correct], minlength = n_groups)
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        summary = _cell_frame(long_data["Subject"].cat.categories)
+        summary["n"] = n_trials
+        summary["Accuracy"] = n_correct/n_trials
+        summary["Mean RT"] = rt_sum/n_correct
+    summary["Median RT"] = grouped_median(groups[correct], rt[correct], n_groups)
+    return summary
+
+
+# Congruency (flanker) effect per subject X ScaleType X Bins: Incon - Con,
+# for RT (positive = slower on incongruent trials) and accuracy (negative = less accurate)
+def congruency_effects(summary):
+    n_half = len(summary)//len(congruency_levels)
+    # the rows of a subject are ordered Con (first half) then Incon (second half)
+    measures = summary[["Accuracy", "Mean RT", "Median RT"]].to_numpy()
+    measures = measures.reshape(-1, len(congruency_levels), n_cells//len(congruency_levels), 3)
+    effects = (measures[:, 1] - measures[:, 0]).reshape(n_half, 3)
+
+    con_rows = summary[summary["Congruency"] == congruency_levels[0]]
+    effect_table = con_rows[["Subject", "ScaleType", "Bins"]].reset_index(drop = True)
+    effect_table["Accuracy Effect"] = effects[:, 0]
+    effect_table["Mean RT Effect"] = effects[:, 1]
+    effect_table["Median RT Effect"] = effects[:, 2]
+    return effect_table
+
+
+# The 2X2X5 design cell table: mean and standard error over subjects of every measure
+def design_table(summary):
+    measures = ["Accuracy", "Mean RT", "Median RT"]
+    values = summary[measures].to_numpy().reshape(-1, n_cells, len(measures))
+    n_subjects = np.sum(~np.isnan(values), axis = 0)
+
+    table = _cell_frame(["All"]).drop(columns = "Subject")
+    # with a single subject the standard errors are NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for i, measure in enumerate(measures):
+            table[measure] = np.nanmean(values[:, :, i], axis = 0)
+            table[measure + " SE"] = np.nanstd(values[:, :, i], axis = 0, ddof = 1)/np.sqrt(n_subjects[:, i])
+    return table
+
+
+## Adaptive deadline replay
+# The deadline of a trial follows from the accuracy of all earlier trials of the subject (update_deadline).
+# Deadlines are whole hundredths, so every trial is a transition table over those states
+# (one for a correct answer, one for an error). The deadline of every trial is the composition of the
+# tables before it, computed for all trials at once with a segmented parallel prefix scan (log2(n) steps)
+
+# transition tables of the staircase over the reachable deadline states (in hundredths),
+# the tables hold state indices: deadline = states[index]
+def _deadline_transitions(initial_cents):
+    lower = int(round(deadline_lower_limit*100))
+    upper = int(round(deadline_upper_limit*100))
+    down = int(round(deadline_step_correct*100))
+    up = int(round(deadline_step_error*100))
+    states = np.arange(min(lower - down, initial_cents), max(upper + up, initial_cents) + 1)
+    outside = (states < lower) | (states > upper)
+    clamped = np.clip(states, lower, upper)
+    after_correct = np.where(outside, clamped, states - down) - states[0]
+    after_error = np.where(outside, clamped, states + up) - states[0]
+    return states, after_correct, after_error
+
+
+# The response deadline in effect on every trial, reconstructed from the accuracy sequence of each subject
+# (trials in the order of the dataset). The deadline at the start of the first experimental block depends on the
+# practice trials, which are not in the dataset: initial_deadline (default the lower limit) is used instead.
+# After the first error at a long deadline the replay no longer depends on this starting value.
+# The plain staircase only: with an accuracy target (performance section of the config) the deadline also depends
+# on the practice trials and the rolling accuracy, the "Response Deadline" of the trial log has to be used instead
+def replay_deadlines(long_data, initial_deadline = deadline_lower_limit):
+    if design["performance"]["accuracy_target"] is not None:
+        raise ValueError("The deadlines of a config with a performance accuracy_target can't be replayed from the accuracies")
+    accurate = long_data["Accurate Response"].to_numpy() == 1
+    subject = long_data["Subject"].cat.codes.to_numpy()
+    n = len(accurate)
+    if n == 0:
+        return np.zeros(0)
+    initial_cents = int(round(initial_deadline*100))
+    states, after_correct, after_error = _deadline_transitions(initial_cents)
+    initial_state = initial_cents - states[0]
+
+    # tables[t] maps the deadline before trial t onto the deadline after it
+    # state indices in the smallest integer type that holds them (a fine or wide deadline grid has many states)
+    state_dtype = np.min_scalar_type(len(states) - 1)
+    tables = np.where(accurate[:, None], after_correct[None, :], after_error[None, :]).astype(state_dtype)
+
+    ## segmented inclusive scan: afterwards tables[t] maps the subject's first deadline onto the one after trial t
+    index = np.arange(n)
+    first_trial = np.concatenate([[True], subject[1:] != subject[:-1]])
+    segment_start = np.maximum.accumulate(np.where(first_trial, index, 0))
+    longest_segment = np.max(np.diff(np.append(np.nonzero(first_trial)[0], n)))
+    shift = 1
+    while shift < longest_segment:
+        # earlier trials first: table[t] after table[t - shift], within the same subject only
+        combined = np.take_along_axis(tables[shift:], tables[:-shift].astype(np.intp), axis = 1)
+        same_subject = (index[shift:] - shift >= segment_start[shift:])[:, None]
+        tables[shift:] = np.where(same_subject, combined, tables[shift:])
+        shift *= 2
+
+    deadline_state = np.full(n, initial_state)
+    later = ~first_trial
+    deadline_state[later] = tables[index[later] - 1, initial_state]
+    return states[deadline_state]/100
+
+
+# Copy of the dataset with the reconstructed "Response Deadline" of every trial and whether
+# its RT is censored by that deadline ("Censored": no response before the deadline)
+def add_deadlines(long_data, initial_deadline = deadline_lower_limit):
+    long_data = long_data.copy()
+    long_data["Response Deadline"] = replay_deadlines(long_data, initial_deadline)
+    long_data["Censored"] = (long_data["response"] == "N").to_numpy()
+    return long_data
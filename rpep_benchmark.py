@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+
+Benchmarks of the per trial critical path
+
+Runs the experiment script headless (see rpep_headless) in a temporary folder and times
+the functions called between two trials on the objects of that session: randomize() (once per block, on a full
+experimental block, with psychopy's TrialHandler when it is installed), create_reward_stimulus(), create_trial_stimulus(),
+performance_processing(), update_deadline() and the logging of a trial (addData, nextEntry and the trial log), plus a whole simulated session
+per trial. With the headless stand-ins this measures the overhead of the experiment code itself,
+not of psychopy. Every run is appended to a history file, so regressions show up over time,
+and the run fails (exit code 1) when the overhead of a trial is above the frame budget.
+
+Usage:
+    python rpep_benchmark.py                                   (budget 2 ms per trial, history in ~/.rpep/benchmarks.jsonl)
+    python rpep_benchmark.py --budget-ms 1 --history results/benchmarks.jsonl
+
+benchmark_trial_path(): time per call of the functions of the trial loop
+
+benchmark_session(): time per trial of a whole simulated session
+
+over_budget(): the measurements of a trial above the budget
+
+"""
+from __future__ import division, print_function
+import argparse, contextlib, io, json, os, platform, shutil, subprocess, sys, tempfile, time
+from datetime import datetime
+
+import rpep_headless
+from rpep_design import build_schedule, schedule_trial_lists
+
+
+# the history of the runs, outside the repository
+default_history = os.path.join(os.path.expanduser("~"), ".rpep", "benchmarks.jsonl")
+
+# the measurements that happen on every trial (and count against the budget)
+per_trial = ["create_reward_stimulus", "create_trial_stimulus", "performance_processing",
+             "update_deadline", "trial logging", "simulated session (per trial)"]
+
+
+# best time per call over the repeats (the least disturbed by the rest of the machine)
+def _time_per_call(function, number, repeat, reset = None):
+    best = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        for i in range(number):
+            function()
+        elapsed = (time.perf_counter() - start)/number
+        best = elapsed if best is None else min(best, elapsed)
+        if reset is not None:
+            reset()
+    return best
+
+
+# runs a headless session quietly, returns the globals of the script
+def _session_namespace(directory, participant_number = 1, testrun = 1):
+    namespace = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        rpep_headless.run_session(participant_number, directory, testrun = testrun, namespace = namespace)
+    return namespace
+
+
+# Time per call (seconds) of the functions of the trial loop, on the objects of a short headless session
+def benchmark_trial_path(directory, number = 1000, repeat = 5):
+    script = _session_namespace(directory)
+    data = script["data"]
+    trial = script["block_trial_lists"][1][0]
+    reward_size = script["create_reward_stimulus"](trial)[0]
+    results = {}
+
+    ## randomize() and iterating its trials on a full experimental block (the session above is a short testrun),
+    ## with psychopy's TrialHandler when psychopy is installed. It adds the block to the ExperimentHandler,
+    ## so it gets one of its own
+    session_lists, session_experiment = script["block_trial_lists"], script["thisExp"]
+    full_schedule = build_schedule(script["c_b"], testrun = 0, seed = script["seed"], design = script["design"])
+    script["block_trial_lists"] = schedule_trial_lists(full_schedule, design = script["design"])
+    try:
+        from psychopy import data as block_data
+    except ImportError:
+        block_data = data
+    script["data"] = block_data
+    script["thisExp"] = block_data.ExperimentHandler(dataFileName = os.path.join(directory, "randomize"),
+                                                     savePickle = False, saveWideText = False)
+    results["randomize (per block)"] = _time_per_call(lambda: list(script["randomize"](1)), max(1, number//10), repeat)
+    script["block_trial_lists"], script["thisExp"], script["data"] = session_lists, session_experiment, data
+
+    results["create_reward_stimulus"] = _time_per_call(lambda: script["create_reward_stimulus"](trial), number, repeat)
+    results["create_trial_stimulus"] = _time_per_call(lambda: script["create_trial_stimulus"](trial), number, repeat)
+
+    ## the running totals cost the same on every trial, at the start or the end of a session
+    results["performance_processing"] = _time_per_call(
+        lambda: script["performance_processing"](1, trial, .35, ['k'], reward_size, .5), number, repeat)
+    results["update_deadline"] = _time_per_call(lambda: script["update_deadline"](1, .5), number, repeat)
+
+    ## logging a trial: the data of the loop, the ExperimentHandler entry and the trial log (background writer)
+    from rpep_trial_log import TrialLog
+    trials = script["randomize"](1)
+    trial_log = TrialLog(os.path.join(directory, "benchmark_trials.jsonl"), first_block = 1, background = True)
+    record = dict((name, 0.5) for name in ["Accurate Response", "RT", "RT Timer", "RT Timer Flip", "Block",
+                                           "Response Deadline", "Reward Size", "Earned Reward", "Seed", "Frame Rate"])
+    record["response"] = 'k'
+
+    def log_trial():
+        for name in record:
+            trials.addData(name, record[name])
+        script["thisExp"].nextEntry()
+        logged = dict(record)
+        logged.update(trial)
+        trial_log.write(logged)
+    results["trial logging"] = _time_per_call(log_trial, number, repeat)
+    trial_log.close()
+    return results
+
+
+# Time per trial (seconds) of a whole headless session (every block, the trial loop and its logging)
+def benchmark_session(directory, participant_number = 2):
+    start = time.perf_counter()
+    script = _session_namespace(directory, participant_number, testrun = 0)
+    elapsed = time.perf_counter() - start
+    n_trials = int(sum(script["design"]["block_trials"]))
+    return {"simulated session (per trial)": elapsed/n_trials,
+            "simulated block": elapsed/n_trials*int(script["design"]["block_trials"][-1])}
+
+
+# The per trial measurements above the budget (seconds), as {name: seconds}, plus their total
+def over_budget(results, budget):
+    over = dict((name, results[name]) for name in per_trial if name in results and results[name] > budget)
+    trial_path = sum(results[name] for name in per_trial[:-1] if name in results)
+    if trial_path > budget:
+        over["trial path (total)"] = trial_path
+    return over
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr = subprocess.DEVNULL,
+                                       cwd = os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmarks of the per trial critical path of the experiment")
+    parser.add_argument("--budget-ms", type = float, default = 2.0, help = "maximum overhead of a trial (default: 2 ms)")
+    parser.add_argument("--number", type = int, default = 1000, help = "calls per repeat")
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--history", default = default_history, help = "file the results are appended to ('' for none, default: {0})".format(default_history))
+    arguments = parser.parse_args()
+    if arguments.history and os.path.dirname(arguments.history):
+        os.makedirs(os.path.dirname(arguments.history), exist_ok = True)
+
+    directory = tempfile.mkdtemp(prefix = "rpep_benchmark_")
+    try:
+        results = benchmark_trial_path(directory, arguments.number, arguments.repeat)
+        results.update(benchmark_session(directory))
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+    previous = None
+    if arguments.history and os.path.isfile(arguments.history):
+        with open(arguments.history) as history:
+            lines = [line for line in history if line.strip()]
+        if lines:
+            previous = json.loads(lines[-1])["results"]
+
+    print("{0:<32}{1:>12}{2:>10}".format("benchmark", "time (ms)", "change"))
+    for name in results:
+        change = ""
+        if previous and previous.get(name):
+            change = "{0:+.0f}%".format((results[name]/previous[name] - 1)*100)
+        print("{0:<32}{1:>12.4f}{2:>10}".format(name, results[name]*1000, change))
+
+    if arguments.history:
+        with open(arguments.history, 'a') as history:
+            history.write(json.dumps({"time": datetime.now().isoformat(timespec = 'seconds'), "commit": _git_commit(),
+                                      "python": platform.python_version(), "budget": arguments.budget_ms/1000,
+                                      "results": results}) + "\n")
+
+    over = over_budget(results, arguments.budget_ms/1000)
+    for name in over:
+        print("Over the budget of {0} ms per trial: {1} ({2:.4f} ms)".format(arguments.budget_ms, name, over[name]*1000))
+    sys.exit(1 if over else 0)
+
+
+if __name__ == '__main__':
+    main()
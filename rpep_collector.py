@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+"""
+
+Local collector of a multi-station lab
+
+With several stations running at once, directory_set() can only check the local disk,
+so two stations could take the same participant number. The collector is one small process
+the stations talk to over a socket: it hands out participant numbers together with their counterbalancing
+assignment (block order, schedule seed and key mapping), one request at a time (asyncio, so no two stations
+get the same number or assignment), receives the
+trial rows the stations stream during their sessions and appends them to a live merged dataset.
+The stations still write their own data files, the collector is optional. The assignment follows the
+participant number (rpep_design.counterbalance), or the next cell of an allocation table (rpep_allocation)
+when the collector is started with one. A prepared session (rpep_setup) brings its own assignment.
+
+Usage:
+    python rpep_collector.py --port 8765 --data DATA [--allocation allocation.npz --site Ghent]
+    python NL_final_RPEP.py --collector 192.168.1.10:8765 --station pc-03
+
+(or RPEP_COLLECTOR and RPEP_STATION instead of the arguments). Leaving the participant number empty
+in the dialog takes the next free number. Several simulated stations on one machine:
+    run_sessions([None]*8, directory = "sim", collector = "127.0.0.1:8765", workers = 8)   (rpep_headless)
+
+Protocol: one JSON object per line, every request gets one JSON reply line ({"ok": true, ...} or
+{"ok": false, "error": "..."}):
+    {"op": "claim", "station": s, "participant": "12" or "", "groups": g, "assignment": {...} or absent}
+                                                                              ->  "participant", "assignment"
+    {"op": "release", "station": s, "participant": 12}                       (an unused claim)
+    {"op": "rows", "station": s, "participant": 12, "rows": [...]}          ->  "received"
+    {"op": "finish", "station": s, "participant": 12}
+    {"op": "status"}                                                          ->  "participants"
+
+Collector: the state of the collector and its request handling
+
+serve(): runs a collector until it is stopped
+
+CollectorClient: the station side, claims a participant number and streams rows from a background thread
+
+collector_arguments(): the collector address and station name given to the experiment script
+
+"""
+from __future__ import print_function
+import argparse, json, os, platform, queue, re, socket, sys, threading
+
+from rpep_design import design, counterbalance, session_seed
+
+
+default_port = 8765
+subject_directory_pattern = re.compile(r'subject_(\d+)$')
+
+
+# converts values json doesn't know (numpy numbers) into plain python values
+def _json_value(value):
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+## The collector
+
+class Collector(object):
+    # data_directory: the DATA folder of the collector, the participant numbers already in it count as taken.
+    # The assignments are kept in collector_state.json, the streamed rows in collector_trials.jsonl.
+    # design: the design of the stations, allocation: an AllocationTable the assignments come from (None:
+    # rpep_design.counterbalance), site: the site of the allocations
+    def __init__(self, data_directory = "DATA", design = design, allocation = None, site = ""):
+        self.data_directory = data_directory
+        self.design = design
+        self.allocation = allocation
+        self.site = site
+        if allocation is not None:
+            allocation.check_design(design)
+        if not os.path.isdir(data_directory):
+            os.makedirs(data_directory)
+        self.state_file = os.path.join(data_directory, "collector_state.json")
+        self.merged_file = os.path.join(data_directory, "collector_trials.jsonl")
+
+        self.participants = {}
+        if os.path.isfile(self.state_file):
+            with open(self.state_file) as state_in:
+                self.participants = dict((int(number), entry) for number, entry in json.load(state_in).items())
+        for name in os.listdir(data_directory):
+            match = subject_directory_pattern.match(name)
+            if match and int(match.group(1)) not in self.participants:
+                self.participants[int(match.group(1))] = {"station": None, "rows": 0, "finished": True}
+        self._merged = open(self.merged_file, 'a')
+
+    def _save_state(self):
+        with open(self.state_file + ".tmp", 'w') as state_out:
+            json.dump(self.participants, state_out, indent = 1)
+        os.replace(self.state_file + ".tmp", self.state_file)
+
+    # Assigns a participant number to a station: the requested one if it is free (or an unfinished session of the
+    # same station, to resume it, with its assignment), the next free number when none is requested.
+    # groups: the counterbalancing groups of the station's design, assignment: the assignment of a prepared session
+    def claim(self, station, participant = "", groups = None, assignment = None):
+        if groups is not None and int(groups) != self.design["block_scales"].shape[0]:
+            return {"ok": False, "error": "The station has {0} counterbalancing groups, the collector {1} (another config)".format(
+                groups, self.design["block_scales"].shape[0])}
+        participant = str(participant).strip()
+        if participant == "":
+            number = max(self.participants) + 1 if self.participants else 1
+        elif participant.isdigit():
+            number = int(participant)
+            taken = self.participants.get(number)
+            if taken is not None and (taken["station"] != station or taken["finished"]):
+                return {"ok": False, "error": "Participant {0} is already taken".format(number)}
+        else:
+            return {"ok": False, "error": "Not a participant number: {0}".format(participant)}
+
+        entry = self.participants.setdefault(number, {"station": station, "rows": 0, "finished": False})
+        if entry.get("assignment") is None:
+            entry["assignment"] = assignment if assignment is not None else self._assignment(number)
+            self._save_state()
+        return {"ok": True, "participant": number, "assignment": entry["assignment"]}
+
+    # the counterbalancing assignment of a new participant: "c_b" (block order), "seed" and "key mapping"
+    # (1: the keys of the config swapped)
+    def _assignment(self, number):
+        if self.allocation is None:
+            return {"c_b": int(counterbalance(number, self.design)), "seed": session_seed(number), "key mapping": 0}
+        from rpep_allocation import allocation_seed
+        allocation = self.allocation.assign(number, self.site)
+        return {"c_b": allocation["block order"], "seed": allocation_seed(allocation, number, self.allocation),
+                "key mapping": allocation["key mapping"]}
+
+    # gives back a claim that wasn't used (no rows yet), e.g. a number the station's own checks refused
+    def release(self, station, participant):
+        number = int(participant)
+        entry = self.participants.get(number)
+        if entry is None or entry["station"] != station or entry["finished"] or entry["rows"]:
+            return {"ok": False, "error": "Participant {0} can't be released by {1}".format(participant, station)}
+        del self.participants[number]
+        if self.allocation is not None and self.allocation.lookup(number) is not None:
+            self.allocation.drop(number)
+        self._save_state()
+        return {"ok": True}
+
+    # appends streamed trial rows (tagged with participant and station) to the merged dataset
+    def add_rows(self, station, participant, rows):
+        entry = self.participants.get(int(participant))
+        if entry is None or entry["station"] != station:
+            return {"ok": False, "error": "Participant {0} wasn't claimed by {1}".format(participant, station)}
+        for row in rows:
+            row = dict(row, Participant = int(participant), Station = station)
+            self._merged.write(json.dumps(row, default = _json_value) + "\n")
+        self._merged.flush()
+        entry["rows"] += len(rows)
+        return {"ok": True, "received": len(rows)}
+
+    def finish(self, station, participant):
+        entry = self.participants.get(int(participant))
+        if entry is None or entry["station"] != station:
+            return {"ok": False, "error": "Participant {0} wasn't claimed by {1}".format(participant, station)}
+        entry["finished"] = True
+        self._save_state()
+        return {"ok": True}
+
+    # answers one request (see the protocol above)
+    def handle(self, request):
+        op = request.get("op")
+        try:
+            if op == "claim":
+                return self.claim(request["station"], request.get("participant", ""), request.get("groups"), request.get("assignment"))
+            if op == "release":
+                return self.release(request["station"], request["participant"])
+            if op == "rows":
+                return self.add_rows(request["station"], request["participant"], request["rows"])
+            if op == "finish":
+                return self.finish(request["station"], request["participant"])
+            if op == "status":
+                return {"ok": True, "participants": self.participants}
+        except (KeyError, TypeError, ValueError) as error:
+            return {"ok": False, "error": "Bad {0} request: {1}".format(op, error)}
+        return {"ok": False, "error": "Unknown request: {0}".format(op)}
+
+    # one station connection: requests are handled in order, between two awaits nothing else runs,
+    # which makes every claim atomic
+    async def connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    reply = self.handle(json.loads(line))
+                except ValueError:
+                    reply = {"ok": False, "error": "Not a JSON request"}
+                writer.write((json.dumps(reply) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self._save_state()
+        self._merged.close()
+
+
+# Runs a collector on host:port until it is stopped (ctrl+c). ready: called with the listening port,
+# design, allocation and site: see Collector
+def serve(host = "127.0.0.1", port = default_port, data_directory = "DATA", ready = None, design = design,
+          allocation = None, site = ""):
+    import asyncio
+    collector = Collector(data_directory, design, allocation, site)
+
+    async def main():
+        server = await asyncio.start_server(collector.connection, host, port, limit = 1 << 24)
+        if ready is not None:
+            ready(server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.close()
+
+
+## The stations
+
+class CollectorClient(object):
+    # address: "host:port" of the collector, station: the name of this station
+    # batch_size: maximum number of rows per request of the background thread
+    def __init__(self, address, station = None, timeout = 5.0, batch_size = 50):
+        host, port = address.rsplit(":", 1)
+        self.station = station or platform.node()
+        self.batch_size = batch_size
+        self.participant = None
+        self.error = None
+        self._socket = socket.create_connection((host, int(port)), timeout = timeout)
+        self._replies = self._socket.makefile('r')
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def request(self, message):
+        with self._lock:
+            self._socket.sendall((json.dumps(message, default = _json_value) + "\n").encode())
+            reply = self._replies.readline()
+        if not reply:
+            raise ConnectionError("The collector closed the connection")
+        return json.loads(reply)
+
+    # Claims a participant number ("" for the next free one) and returns its assignment: {"participant", "c_b", "seed",
+    # "key mapping"}, or None when the collector refuses it. groups: the counterbalancing groups of the station's design,
+    # assignment: the assignment of a prepared session (the collector records it instead of making one)
+    def claim(self, participant = "", groups = None, assignment = None):
+        message = {"op": "claim", "station": self.station, "participant": str(participant), "groups": groups}
+        if assignment is not None:
+            message["assignment"] = assignment
+        reply = self.request(message)
+        if not reply["ok"]:
+            self.error = reply["error"]
+            return None
+        self.participant = reply["participant"]
+        if self._thread is None:
+            self._thread = threading.Thread(target = self._send_rows, name = "collector", daemon = True)
+            self._thread.start()
+        return dict(reply["assignment"], participant = reply["participant"])
+
+    # Gives back the claimed number (before any row was streamed), e.g. when the station's own checks refuse it
+    def release(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        reply = self.request({"op": "release", "station": self.station, "participant": self.participant})
+        self.participant = None
+        if not reply["ok"]:
+            self.error = reply["error"]
+
+    # queues a trial row, it is sent by the background thread (never blocks the display loop)
+    def stream(self, row):
+        self._queue.put(dict(row))
+
+    # background thread: sends the queued rows in batches until close() queues None
+    def _send_rows(self):
+        done = False
+        while not done:
+            rows = [self._queue.get()]
+            while len(rows) < self.batch_size and not self._queue.empty():
+                rows.append(self._queue.get())
+            if rows[-1] is None:
+                rows.pop()
+                done = True
+            if rows and self.error is None:
+                try:
+                    reply = self.request({"op": "rows", "station": self.station, "participant": self.participant, "rows": rows})
+                    if not reply["ok"]:
+                        self.error = reply["error"]
+                except (OSError, ValueError) as error:
+                    # the rows are in the local data files anyway, the session goes on without the collector
+                    self.error = str(error)
+
+    # Sends the queued rows, marks the session as finished (finished = False keeps it open to resume) and disconnects
+    def close(self, finished = True):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            if finished and self.error is None:
+                try:
+                    self.request({"op": "finish", "station": self.station, "participant": self.participant})
+                except (OSError, ValueError) as error:
+                    self.error = str(error)
+        self._socket.close()
+
+
+# The collector address and station name given to the experiment script
+# (--collector HOST:PORT and --station NAME, or RPEP_COLLECTOR and RPEP_STATION); no address means no collector
+def collector_arguments(argv):
+    parser = argparse.ArgumentParser(add_help = False)
+    parser.add_argument("--collector", default = os.environ.get("RPEP_COLLECTOR"))
+    parser.add_argument("--station", default = os.environ.get("RPEP_STATION"))
+    arguments, unknown = parser.parse_known_args(argv[1:])
+    return arguments.collector, arguments.station
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Collector of the participant numbers and trial rows of a multi-station lab")
+    parser.add_argument("--host", default = "0.0.0.0", help = "address to listen on (default: all)")
+    parser.add_argument("--port", type = int, default = default_port)
+    parser.add_argument("--data", default = "DATA", help = "folder of the collector state and the merged trial rows")
+    parser.add_argument("--config", default = None, help = "experiment config of the stations (default: RPEP_CONFIG or rpep_config.json)")
+    parser.add_argument("--allocation", default = None, help = "allocation table the assignments come from (rpep_allocation)")
+    parser.add_argument("--site", default = "", help = "site of the allocations")
+    arguments = parser.parse_args()
+
+    collector_design = design
+    if arguments.config is not None:
+        from rpep_design import load_design
+        collector_design = load_design(arguments.config)
+    allocation = None
+    if arguments.allocation is not None:
+        from rpep_allocation import AllocationTable
+        allocation = AllocationTable(arguments.allocation)
+        try:
+            allocation.check_design(collector_design)
+        except ValueError as error:
+            print(error, file = sys.stderr)
+            sys.exit(1)
+
+    def ready(port):
+        print("Collector listening on port {0}, merged rows in {1}".format(port, os.path.join(arguments.data, "collector_trials.jsonl")))
+        sys.stdout.flush()
+    serve(arguments.host, arguments.port, arguments.data, ready, collector_design, allocation, arguments.site)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+"""
+
+Drift diffusion model fits of the long format dataset (data_long.csv)
+
+Every response is the first passage of a Wiener diffusion process (unit noise) between 0 (error)
+and the boundary separation a (correct response), starting half way, after a non-decision time t0.
+The drift rate varies per design cell (Congruency X ScaleType X Bins), a and t0 per subject.
+Non-responses ("N") are censored at their RT, the moment the deadline ran out: they contribute the
+probability that neither boundary was reached by then, instead of being dropped or counted as errors.
+A small fraction of contaminant responses (p_outlier, uniform over the response window) keeps
+anticipations from dominating the fit.
+
+The likelihood is evaluated for all trials of a subject at once. For a given a and t0 every cell has
+its own best drift, so the drifts of all cells are found together by one vectorised golden section
+search over the part of the density that depends on the drift (the series of the density are
+computed once per a and t0), and only a and t0 go through a Nelder-Mead simplex.
+Subjects are fitted over a process pool, and the fits can be cached per subject (its trials and the
+options) in a json file, so refitting after adding a subject only fits the new one.
+
+wiener_density(): first passage density at the upper (correct) or lower (error) boundary
+
+wiener_survival(): probability that neither boundary is reached before t
+
+subject_trials(): the trials of every subject as the arrays the fits use
+
+fit_subject(): maximum likelihood (or with a prior, maximum a posteriori) parameters of one subject
+
+fit_subjects(): per subject fits of the dataset
+
+fit_hierarchical(): fits with group distributions of the parameters (empirical Bayes), the subject
+                    estimates are shrunk toward the group
+
+"""
+from __future__ import division
+from concurrent.futures import ProcessPoolExecutor
+import hashlib, json, os
+import numpy as np
+import pandas
+
+from rpep_analysis import n_cells, cell_codes, _cell_frame
+from rpep_design import deadline_upper_limit
+
+
+# terms of the series of the densities (Navarro & Fuss, 2009): small time k = -n..n, large time k = 1..n
+n_small_terms = 10
+n_large_terms = 30
+n_survival_terms = 60
+_small_k = np.arange(-n_small_terms, n_small_terms + 1)
+_large_k = np.arange(1, n_large_terms + 1)
+_survival_k = np.arange(1, n_survival_terms + 1)
+
+# search ranges of the parameters
+boundary_range = (0.3, 5.0)
+t0_range = (0.0, 0.6)
+drift_range = (-10.0, 10.0)
+
+# responses can't come later than the longest deadline (the window of the contaminants)
+response_window = deadline_upper_limit
+
+golden_ratio = (np.sqrt(5) - 1)/2
+golden_iterations = 48
+
+fit_version = 1
+
+
+## Densities
+
+# first passage density at the lower boundary of a process without drift between 0 and 1,
+# starting at w (t in units of a squared): the small time series below 1, the large time series above
+def _standard_density(u, w):
+    u = np.asarray(u, dtype = np.float64)
+    density = np.zeros(u.shape)
+    small = (u > 0) & (u < 1)
+    large = u >= 1
+    if small.any():
+        small_u = u[small][:, None]
+        terms = w + 2*_small_k
+        density[small] = np.sum(terms*np.exp(-terms**2/(2*small_u)), axis = 1)/np.sqrt(2*np.pi*small_u[:, 0]**3)
+    if large.any():
+        large_u = u[large][:, None]
+        density[large] = np.pi*np.sum(_large_k*np.exp(-_large_k**2*np.pi**2*large_u/2)*np.sin(_large_k*np.pi*w), axis = 1)
+    return np.maximum(density, 0)
+
+
+# First passage density at time t (decision time, after t0) of a process with drift v between 0 and a,
+# starting at w*a: at the upper boundary (correct response) or the lower boundary (error)
+def wiener_density(t, v, a, w = .5, upper = True):
+    t = np.asarray(t, dtype = np.float64)
+    if upper:
+        v, w = -np.asarray(v), 1 - w
+    return np.exp(-v*a*w - v**2*t/2)*_standard_density(t/a**2, w)/a**2
+
+
+# Probability that a process with drift v between 0 and a, starting at w*a, hasn't reached
+# either boundary at time t (the likelihood of a non-response censored at t)
+def wiener_survival(t, v, a, w = .5):
+    t = np.asarray(t, dtype = np.float64)
+    v = np.asarray(v, dtype = np.float64)
+    rate = _survival_k*np.pi/a
+    terms = (np.sin(_survival_k*np.pi*w)*np.exp(-rate**2*np.maximum(t, 0)[..., None]/2)*rate
+             *(1 - (-1.0)**_survival_k*np.exp(v[..., None]*a))/(v[..., None]**2 + rate**2))
+    survival = 2/a*np.exp(-v*w*a - v**2*np.maximum(t, 0)/2)*np.sum(terms, axis = -1)
+    return np.where(t <= 0, 1.0, np.clip(survival, 0, 1))
+
+
+## Subjects
+
+# The trials of every subject as {"cell", "rt", "correct", "censored"} arrays, in a list of (subject, trials)
+def subject_trials(long_data):
+    subject = long_data["Subject"].cat.codes.to_numpy()
+    cells = cell_codes(long_data)
+    rt = long_data["RT"].to_numpy().astype(np.float64)
+    correct = long_data["Accurate Response"].to_numpy() == 1
+    censored = (long_data["response"] == "N").to_numpy()
+
+    order = np.argsort(subject, kind = 'stable')
+    bounds = np.searchsorted(subject[order], np.arange(len(long_data["Subject"].cat.categories) + 1))
+    trials = []
+    for i, name in enumerate(long_data["Subject"].cat.categories):
+        index = order[bounds[i]:bounds[i + 1]]
+        if len(index):
+            trials.append((name, {"cell": cells[index], "rt": rt[index],
+                                  "correct": correct[index], "censored": censored[index]}))
+    return trials
+
+
+# the likelihood of one subject, split in the parts that depend on a and t0 only and the part that depends on the drift
+class _SubjectLikelihood(object):
+    def __init__(self, trials, p_outlier, w):
+        responded = ~trials["censored"]
+        self.cell = trials["cell"][responded]
+        self.rt = trials["rt"][responded]
+        self.correct = trials["correct"][responded]
+        self.censored_cell = trials["cell"][~responded]
+        self.censored_rt = trials["rt"][~responded]
+        self.has_trials = np.bincount(trials["cell"], minlength = n_cells) > 0
+        self.p_outlier = p_outlier
+        self.w = w
+        # contaminants: either response, uniform over the response window (later ones are censored)
+        self.outlier_density = p_outlier/(2*response_window)
+        self.outlier_censored = p_outlier*np.clip(1 - self.censored_rt/response_window, 0, 1)
+
+    # sets a and t0: the series of the densities are computed here, once for every drift tried
+    def set_boundary(self, a, t0):
+        self.a, self.t0 = a, t0
+        decision_time = self.rt - t0
+        self.decision_time = np.maximum(decision_time, 0)
+        self.log_series = np.full(len(self.rt), -np.inf)
+        valid = decision_time > 0
+        u = decision_time[valid]/a**2
+        correct = self.correct[valid]
+        series = np.where(correct, _standard_density(u, 1 - self.w), _standard_density(u, self.w))/a**2
+        with np.errstate(divide = 'ignore'):
+            self.log_series[valid] = np.log(series)
+        # the drift enters the log density as v*direction - v**2*t/2
+        self.direction = np.where(self.correct, a*(1 - self.w), -a*self.w)
+        self.censored_time = self.censored_rt - t0
+
+    # log likelihood per design cell for the drifts of the cells
+    def cell_log_likelihood(self, drift):
+        v = drift[self.cell]
+        with np.errstate(over = 'ignore'):
+            density = np.exp(self.log_series + v*self.direction - v**2*self.decision_time/2)
+        log_likelihood = np.bincount(self.cell, weights = np.log((1 - self.p_outlier)*density + self.outlier_density),
+                                     minlength = n_cells)
+        if len(self.censored_cell):
+            survival = wiener_survival(self.censored_time, drift[self.censored_cell], self.a, self.w)
+            censored = np.log(np.maximum((1 - self.p_outlier)*survival + self.outlier_censored, 1e-300))
+            log_likelihood += np.bincount(self.censored_cell, weights = censored, minlength = n_cells)
+        return log_likelihood
+
+    # the best drift of every cell for the current a and t0 (golden section search on all cells at once),
+    # returns the drifts and the log posterior per cell
+    def best_drifts(self, drift_prior = None):
+        def objective(drift):
+            value = self.cell_log_likelihood(drift)
+            if drift_prior is not None:
+                value = value - (drift - drift_prior[0])**2/(2*drift_prior[1]**2)
+            return value
+
+        lower = np.full(n_cells, drift_range[0])
+        upper = np.full(n_cells, drift_range[1])
+        left = upper - golden_ratio*(upper - lower)
+        right = lower + golden_ratio*(upper - lower)
+        left_value, right_value = objective(left), objective(right)
+        for i in range(golden_iterations):
+            # maximum in [lower, right] where the left point is better, else in [left, upper]
+            keep_left = left_value > right_value
+            upper = np.where(keep_left, right, upper)
+            lower = np.where(keep_left, lower, left)
+            point = np.where(keep_left, upper - golden_ratio*(upper - lower), lower + golden_ratio*(upper - lower))
+            value = objective(point)
+            left, right, left_value, right_value = (np.where(keep_left, point, right), np.where(keep_left, left, point),
+                                                    np.where(keep_left, value, right_value), np.where(keep_left, left_value, value))
+        drift = (lower + upper)/2
+        return drift, objective(drift)
+
+
+# Minimises function from start with a Nelder-Mead simplex (the initial simplex steps along every parameter)
+def _nelder_mead(function, start, steps, tolerance = 1e-6, max_evaluations = 400):
+    points = [np.asarray(start, dtype = np.float64)]
+    for i, step in enumerate(steps):
+        point = points[0].copy()
+        point[i] += step
+        points.append(point)
+    values = [function(point) for point in points]
+    evaluations = len(points)
+
+    while evaluations < max_evaluations:
+        order = np.argsort(values)
+        points = [points[i] for i in order]
+        values = [values[i] for i in order]
+        if abs(values[-1] - values[0]) <= tolerance*(1 + abs(values[0])) and np.max(np.abs(points[-1] - points[0])) <= 1e-4:
+            break
+        centroid = np.mean(points[:-1], axis = 0)
+        reflected = centroid + (centroid - points[-1])
+        reflected_value = function(reflected)
+        evaluations += 1
+        if reflected_value < values[0]:
+            expanded = centroid + 2*(centroid - points[-1])
+            expanded_value = function(expanded)
+            evaluations += 1
+            if expanded_value < reflected_value:
+                points[-1], values[-1] = expanded, expanded_value
+            else:
+                points[-1], values[-1] = reflected, reflected_value
+        elif reflected_value < values[-2]:
+            points[-1], values[-1] = reflected, reflected_value
+        else:
+            contracted = centroid + .5*(points[-1] - centroid)
+            contracted_value = function(contracted)
+            evaluations += 1
+            if contracted_value < values[-1]:
+                points[-1], values[-1] = contracted, contracted_value
+            else:
+                # shrink toward the best point
+                for i in range(1, len(points)):
+                    points[i] = points[0] + .5*(points[i] - points[0])
+                    values[i] = function(points[i])
+                evaluations += len(points) - 1
+    best = int(np.argmin(values))
+    return points[best], values[best], evaluations
+
+
+# Maximum likelihood parameters of one subject (trials as from subject_trials()): a, t0 and the drift of every cell
+# (NaN for cells without trials). prior: the group distributions of fit_hierarchical() (maximum a posteriori).
+# start: (a, t0) to start the search from, a previous fit makes refitting fast
+def fit_subject(trials, prior = None, p_outlier = .02, w = .5, start = None):
+    likelihood = _SubjectLikelihood(trials, p_outlier, w)
+    drift_prior = None
+    if prior is not None:
+        drift_prior = (np.asarray(prior["drift"], dtype = np.float64), np.asarray(prior["drift_sd"], dtype = np.float64))
+    if start is None:
+        responded = likelihood.rt[likelihood.rt > .1]
+        start = (1.0, .8*np.percentile(responded, 5) if len(responded) else .2)
+
+    def negative_posterior(parameters):
+        a, t0 = parameters
+        if not (boundary_range[0] <= a <= boundary_range[1] and t0_range[0] <= t0 <= t0_range[1]):
+            return np.inf
+        likelihood.set_boundary(a, t0)
+        value = np.sum(likelihood.best_drifts(drift_prior)[1])
+        if prior is not None:
+            value -= (a - prior["a"])**2/(2*prior["a_sd"]**2) + (t0 - prior["t0"])**2/(2*prior["t0_sd"]**2)
+        return -value
+
+    (a, t0), value, evaluations = _nelder_mead(negative_posterior, start, (.2, .03))
+    likelihood.set_boundary(a, t0)
+    drift = likelihood.best_drifts(drift_prior)[0]
+    log_likelihood = float(np.sum(likelihood.cell_log_likelihood(drift)))
+    if prior is None:
+        drift[~likelihood.has_trials] = np.nan
+    return {"a": float(a), "t0": float(t0), "drift": drift,
+            "log_likelihood": log_likelihood, "n": len(trials["rt"]),
+            "censored": int(np.sum(trials["censored"])), "evaluations": evaluations}
+
+
+# one subject in a worker process
+def _fit_task(arguments):
+    trials, prior, p_outlier, start = arguments
+    return fit_subject(trials, prior, p_outlier, start = start)
+
+
+# cache key of a subject fit: its trials and the options of the fit
+def _fit_key(trials, prior, p_outlier):
+    sha = hashlib.sha1()
+    for name in ("cell", "rt", "correct", "censored"):
+        sha.update(np.ascontiguousarray(trials[name]).tobytes())
+    sha.update(json.dumps({"version": fit_version, "prior": prior, "p_outlier": p_outlier,
+                           "terms": [n_small_terms, n_large_terms, n_survival_terms]}, sort_keys = True).encode())
+    return sha.hexdigest()
+
+
+# Fits the subjects (in this process or over a process pool), taking the fits already in the cache file
+def _fit_all(subjects, prior, p_outlier, workers, cache_file, starts = None):
+    cache = {}
+    if cache_file is not None and os.path.isfile(cache_file):
+        with open(cache_file) as cache_in:
+            cache = json.load(cache_in)
+    keys = [_fit_key(trials, prior, p_outlier) for name, trials in subjects]
+    missing = [i for i, key in enumerate(keys) if key not in cache]
+    tasks = [(subjects[i][1], prior, p_outlier, None if starts is None else starts[i]) for i in missing]
+
+    if workers is None or workers > 1:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            results = list(pool.map(_fit_task, tasks))
+    else:
+        results = [_fit_task(task) for task in tasks]
+    for i, fit in zip(missing, results):
+        fit = dict(fit)
+        fit["drift"] = [None if np.isnan(v) else float(v) for v in fit["drift"]]
+        cache[keys[i]] = fit
+
+    if cache_file is not None and missing:
+        with open(cache_file + ".tmp", 'w') as cache_out:
+            json.dump(cache, cache_out)
+        os.replace(cache_file + ".tmp", cache_file)
+    fits = []
+    for key in keys:
+        fit = dict(cache[key])
+        fit["drift"] = np.array([np.nan if v is None else v for v in fit["drift"]])
+        fits.append(fit)
+    return fits
+
+
+# the fits as tables: one row per subject (a, t0, fit) and one per subject X design cell (drift)
+def _fit_tables(subjects, fits):
+    names = [name for name, trials in subjects]
+    subject_table = pandas.DataFrame({"Subject": pandas.Categorical(names, categories = names),
+                                      "a": [fit["a"] for fit in fits],
+                                      "t0": [fit["t0"] for fit in fits],
+                                      "Log Likelihood": [fit["log_likelihood"] for fit in fits],
+                                      "n": [fit["n"] for fit in fits],
+                                      "Censored": [fit["censored"] for fit in fits]})
+    drift_table = _cell_frame(names)
+    drift_table["Drift"] = np.concatenate([fit["drift"] for fit in fits])
+    return {"subjects": subject_table, "drifts": drift_table}
+
+
+# Per subject maximum likelihood fits of the dataset. Returns {"subjects": a, t0 and the log likelihood per subject,
+# "drifts": the drift per subject X Congruency X ScaleType X Bins}. workers: processes (None = all cpus).
+# cache_file: json file of earlier fits (e.g. "data_long.csv.ddm.json"), subjects whose trials didn't change aren't refitted
+def fit_subjects(long_data, p_outlier = .02, workers = 1, cache_file = None):
+    subjects = subject_trials(long_data)
+    return _fit_tables(subjects, _fit_all(subjects, None, p_outlier, workers, cache_file))
+
+
+# the group distributions of the parameters (mean and sd over subjects) from the subject fits
+def _group_prior(fits, minimum_sd = (.05, .01, .05)):
+    drift = np.array([fit["drift"] for fit in fits])
+    a = np.array([fit["a"] for fit in fits])
+    t0 = np.array([fit["t0"] for fit in fits])
+    drift_mean = np.nanmean(drift, axis = 0)
+    drift_sd = np.nanstd(drift, axis = 0, ddof = 1) if len(fits) > 1 else np.zeros(n_cells)
+    return {"a": float(a.mean()), "a_sd": float(max(a.std(ddof = 1) if len(fits) > 1 else 0, minimum_sd[0])),
+            "t0": float(t0.mean()), "t0_sd": float(max(t0.std(ddof = 1) if len(fits) > 1 else 0, minimum_sd[1])),
+            "drift": [round(float(v), 6) for v in np.nan_to_num(drift_mean)],
+            "drift_sd": [round(float(v), 6) for v in np.maximum(np.nan_to_num(drift_sd), minimum_sd[2])]}
+
+
+# Hierarchical fits (empirical Bayes): the subjects are fitted with normal group distributions of a, t0 and
+# the drift of every cell as priors, the group distributions are estimated from the subject fits, and both
+# are alternated for the given number of iterations (the subject fits start from their previous estimates).
+# Returns the tables of fit_subjects() plus "group": the group mean and sd of the drift per design cell
+# and "prior": the group distributions of the last iteration
+def fit_hierarchical(long_data, iterations = 5, p_outlier = .02, workers = 1, cache_file = None):
+    subjects = subject_trials(long_data)
+    fits = _fit_all(subjects, None, p_outlier, workers, cache_file)
+    prior = None
+    for i in range(iterations):
+        prior = _group_prior(fits)
+        starts = [(fit["a"], fit["t0"]) for fit in fits]
+        fits = _fit_all(subjects, prior, p_outlier, workers, cache_file, starts)
+
+    tables = _fit_tables(subjects, fits)
+    group = _cell_frame(["All"]).drop(columns = "Subject")
+    group["Drift"] = prior["drift"] if prior is not None else np.nan
+    group["Drift SD"] = prior["drift_sd"] if prior is not None else np.nan
+    tables["group"] = group
+    tables["prior"] = prior
+    return tables
@@ -0,0 +1,418 @@
+"""
+
+Design and trial schedule of the reward scale experiment
+
+The design of a variant of the experiment (bins, scale types, congruency conditions, blocks,
+keys, timing and deadline) is described in a config file, rpep_config.json by default
+(another file with the RPEP_CONFIG environment variable, .yaml/.yml files need PyYAML).
+The config is validated and compiled once into a design: level lists, per level arrays
+and a per block design matrix (the scale type of every block per counterbalancing group),
+which the experiment script, the setup stage and the analysis all read.
+
+Builds the complete trial schedule of a session (every block) in one pass with NumPy,
+instead of creating a factorial list per block at the start of every block.
+The schedule is a dictionary of equally long arrays (one entry per trial),
+factors are stored as small integer codes that index the level lists of the design.
+
+load_config(): reads a config file (json or yaml)
+
+compile_design(): validates a config and compiles it into a design (cached per config)
+
+load_design(): the compiled design of a config file
+
+counterbalance(): the counterbalancing group (scale type order) of a participant
+
+session_seed(): the seed of a session, derived from the participant number
+
+build_schedule(): creates the schedule of a whole session from a seed
+
+session_schedule(): the counterbalancing, seed and schedule of a participant
+
+reward_sizes(): the reward size of every trial given its bin and noise
+
+schedule_trial_lists(): converts the schedule into a list of trial dictionaries per block
+
+export_schedule(): writes the schedule to a csv file
+
+save_session(), load_session(): a precomputed session (schedule, design and participant info), see rpep_setup
+
+"""
+from __future__ import division
+import copy, csv, json, os
+import numpy as np
+
+
+default_config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rpep_config.json")
+
+# Noise of the reward size per bin: none (always the bin size), both directions, only down or only up
+noise_modes = ["none", "both", "down", "up"]
+scale_kinds = ["probabilistic", "deterministic"]
+sides = ["left", "right"]
+
+# The optional "performance" section of a config: the rolling accuracy window, whether the block feedback
+# shows the rolling and per scale type accuracy, and an accuracy target for the deadline (None: the plain staircase)
+default_performance = {"window": 20, "feedback": False, "accuracy_target": None}
+
+# Order of the columns in the schedule (and its csv export)
+schedule_columns = ["Block", "Trial", "Tag", "ScaleType", "Bins", "Congruency", "CorAns",
+                    "BinSize", "Reward Noise", "Reward Size", "Prob Outcome"]
+
+# compiled designs, per config (see compile_design)
+_compiled = {}
+
+
+## The design
+
+# Reads a config file: json, or yaml for .yaml/.yml files
+def load_config(filename):
+    with open(filename) as config_file:
+        if os.path.splitext(filename)[1].lower() in (".yaml", ".yml"):
+            import yaml
+            return yaml.safe_load(config_file)
+        return json.load(config_file)
+
+
+# every problem of a config, as a list of messages
+def _config_problems(config):
+    problems = []
+    required = ["n_blocks", "n_trial_rep", "n_practice_trials", "n_test_trials", "bins", "noise_sd",
+                "noise_upper_limit", "scale_types", "probabilistic_reward", "block_scales", "congruencies",
+                "keys", "timing", "deadline"]
+    missing = [name for name in required if name not in config]
+    if missing:
+        return ["Missing config entries: {0}".format(", ".join(missing))]
+
+    for name in ["n_blocks", "n_trial_rep", "n_practice_trials", "n_test_trials"]:
+        if not isinstance(config[name], int) or config[name] < 1:
+            problems.append("{0} should be a positive whole number".format(name))
+    if not problems and config["n_blocks"] < 2:
+        problems.append("n_blocks should include the practice block and at least one experimental block")
+
+    # the levels are checked further only when they are complete
+    level_problems = []
+    levels = [("bins", ["name", "size", "noise"]), ("scale_types", ["name", "kind", "announcement", "format"]),
+              ("congruencies", ["name", "condition", "side", "flanker"])]
+    for factor, fields in levels:
+        if not config[factor]:
+            level_problems.append("{0} should have at least one level".format(factor))
+        for level in config[factor]:
+            missing = [field for field in fields if field not in level]
+            if missing:
+                level_problems.append("{0} level {1} misses {2}".format(factor, level.get("name"), ", ".join(missing)))
+        names = [level.get("name") for level in config[factor]]
+        if len(set(names)) != len(names):
+            level_problems.append("the {0} names should be unique".format(factor))
+    if level_problems:
+        return problems + level_problems
+
+    for level in config["bins"]:
+        if level["noise"] not in noise_modes:
+            problems.append("the noise of bin {0} should be one of {1}".format(level["name"], ", ".join(noise_modes)))
+        if level["size"] - (config["noise_upper_limit"] if level["noise"] in ("both", "down") else 0) < 0:
+            problems.append("the reward of bin {0} can go below 0".format(level["name"]))
+    for level in config["scale_types"]:
+        if level["kind"] not in scale_kinds:
+            problems.append("the kind of scale type {0} should be one of {1}".format(level["name"], ", ".join(scale_kinds)))
+    for level in config["congruencies"]:
+        if level["side"] not in sides:
+            problems.append("the side of congruency {0} should be left or right".format(level["name"]))
+    if config["noise_upper_limit"] < 0 or config["noise_sd"] <= 0:
+        problems.append("noise_upper_limit should be at least 0 and noise_sd above 0")
+    if isinstance(config["probabilistic_reward"], bool) or not isinstance(config["probabilistic_reward"], int) or config["probabilistic_reward"] < 0:
+        problems.append("probabilistic_reward should be a whole number of at least 0")
+    # on probabilistic scale types the reward size is the chance (%) of the reward
+    if any(level["kind"] == "probabilistic" for level in config["scale_types"]):
+        for level in config["bins"]:
+            if level["size"] + (config["noise_upper_limit"] if level["noise"] in ("both", "up") else 0) > 100:
+                problems.append("the reward of bin {0} can go above 100, the chance of a probabilistic reward".format(level["name"]))
+
+    scale_names = [level["name"] for level in config["scale_types"]]
+    if config["block_scales"] != "alternate":
+        orders = config["block_scales"]
+        if not isinstance(orders, list) or not orders:
+            problems.append("block_scales should be 'alternate' or a list of scale type orders (one per counterbalancing group)")
+        else:
+            for order in orders:
+                if len(order) != int(config["n_blocks"]) - 1 or any(name not in scale_names for name in order):
+                    problems.append("every block_scales order should name a scale type for each of the {0} experimental blocks".format(config["n_blocks"] - 1))
+                    break
+
+    if set(config["keys"]) != set(sides):
+        problems.append("keys should have a left and a right key")
+    for phase in ["reward", "fixation", "feedback", "blank"]:
+        if not config["timing"].get(phase, 0) > 0:
+            problems.append("timing should give the {0} phase a duration above 0".format(phase))
+    deadline = config["deadline"]
+    missing = [name for name in ["initial", "lower", "upper", "step_correct", "step_error"] if name not in deadline]
+    if missing:
+        problems.append("deadline misses {0}".format(", ".join(missing)))
+    elif not 0 < deadline["lower"] <= deadline["upper"]:
+        problems.append("the deadline limits should be 0 < lower <= upper")
+
+    performance = config.get("performance", {})
+    unknown = [name for name in performance if name not in default_performance]
+    if unknown:
+        problems.append("performance has unknown entries: {0}".format(", ".join(unknown)))
+    if not isinstance(performance.get("window", 1), int) or performance.get("window", 1) < 1:
+        problems.append("the performance window should be a positive whole number")
+    if not isinstance(performance.get("feedback", False), bool):
+        problems.append("the performance feedback should be true or false")
+    target = performance.get("accuracy_target")
+    if target is not None and (isinstance(target, bool) or not isinstance(target, (int, float)) or not 0 < target <= 1):
+        problems.append("the performance accuracy_target should be null or an accuracy between 0 and 1")
+    return problems
+
+
+# Validates a config (raising a ValueError with every problem) and compiles it into a design:
+#   bins, bin_sizes, bin_noise     bin names, sizes and noise mode codes (index noise_modes)
+#   scale_types, scale_kind        scale type names and kind codes (index scale_kinds)
+#   congruencies, flankers         congruency names and flanker strings
+#   conditions, congruency_condition, correct_side
+#                                  the congruency conditions of the analysis (left and right merged),
+#                                  the condition code and correct side (0 left, 1 right) of every congruency
+#   block_scales                   per block design matrix: counterbalancing group X block, the scale type code
+#                                  of every block (-1 for the practice block, which mixes all scale types)
+#   block_trials                   number of trials of every block
+#   n_conditions, n_cells          bins X congruencies (schedule), conditions X scale types X bins (analysis)
+#   performance                    the performance section of the config, completed with default_performance
+# plus the keys, timing and deadline of the config. The same config gives the same (cached) design
+def compile_design(config):
+    key = json.dumps(config, sort_keys = True)
+    if key in _compiled:
+        return _compiled[key]
+    problems = _config_problems(config)
+    if problems:
+        raise ValueError("Invalid experiment config:\n" + "\n".join(problems))
+
+    scale_names = [level["name"] for level in config["scale_types"]]
+    conditions = []
+    for level in config["congruencies"]:
+        if level["condition"] not in conditions:
+            conditions.append(level["condition"])
+
+    n_blocks = config["n_blocks"]
+    if config["block_scales"] == "alternate":
+        # group g starts with scale type g on block 1 (and its scale type on the even blocks for 2 scale types)
+        groups = np.arange(len(scale_names))[:, None]
+        exp_scales = (np.arange(1, n_blocks)[None, :] - groups)%len(scale_names)
+    else:
+        exp_scales = np.array([[scale_names.index(name) for name in order] for order in config["block_scales"]])
+    block_scales = np.concatenate([np.full((exp_scales.shape[0], 1), -1), exp_scales], axis = 1).astype(np.int8)
+
+    n_conditions = len(config["bins"])*len(config["congruencies"])
+    design = {"config": copy.deepcopy(config),
+              "bins": [level["name"] for level in config["bins"]],
+              "bin_sizes": np.array([level["size"] for level in config["bins"]]),
+              "bin_noise": np.array([noise_modes.index(level["noise"]) for level in config["bins"]], dtype = np.int8),
+              "scale_types": scale_names,
+              "scale_kind": np.array([scale_kinds.index(level["kind"]) for level in config["scale_types"]], dtype = np.int8),
+              "congruencies": [level["name"] for level in config["congruencies"]],
+              "flankers": [level["flanker"] for level in config["congruencies"]],
+              "conditions": conditions,
+              "congruency_condition": np.array([conditions.index(level["condition"]) for level in config["congruencies"]], dtype = np.int8),
+              "correct_side": np.array([sides.index(level["side"]) for level in config["congruencies"]], dtype = np.int8),
+              "block_scales": block_scales,
+              "block_trials": np.array([config["n_practice_trials"]] + [config["n_trial_rep"]*n_conditions]*(n_blocks - 1)),
+              "n_blocks": n_blocks,
+              "n_trial_rep": config["n_trial_rep"],
+              "n_practice_trials": config["n_practice_trials"],
+              "n_test_trials": config["n_test_trials"],
+              "n_conditions": n_conditions,
+              "n_cells": len(conditions)*len(scale_names)*len(config["bins"]),
+              "noise_sd": config["noise_sd"],
+              "noise_upper_limit": config["noise_upper_limit"],
+              "probabilistic_reward": config["probabilistic_reward"],
+              "keys": (config["keys"]["left"], config["keys"]["right"]),
+              "timing": dict(config["timing"]),
+              "deadline": dict(config["deadline"]),
+              "performance": dict(default_performance, **config.get("performance", {}))}
+    _compiled[key] = design
+    return design
+
+
+# The compiled design of a config file (the default config when filename is None)
+def load_design(filename = None):
+    return compile_design(load_config(filename or default_config_file))
+
+
+# The design used by default: RPEP_CONFIG or rpep_config.json
+design = load_design(os.environ.get("RPEP_CONFIG") or None)
+
+# Factor levels of the default design (the codes in the schedule index these lists)
+bins = design["bins"]
+bin_sizes = design["bin_sizes"]
+scale_types = design["scale_types"]
+congruencies = design["congruencies"]
+
+# Session parameters of the default design
+n_blocks = design["n_blocks"]  # block 0 is a practice block
+n_trials = int(design["block_trials"][-1]) #per experimental block
+left_key, right_key = design["keys"]
+
+# Adaptive response deadline (staircase, see update_deadline in the experiment script):
+# -step_correct after a correct answer, +step_error after an error. A deadline that ends up outside
+# the limits is only clamped back to them on the next update
+initial_deadline = design["deadline"]["initial"]
+deadline_lower_limit = design["deadline"]["lower"]
+deadline_upper_limit = design["deadline"]["upper"]
+deadline_step_correct = design["deadline"]["step_correct"]
+deadline_step_error = design["deadline"]["step_error"]
+
+
+## The schedule
+
+# Counterbalancing group of a participant: the row of the block_scales design matrix.
+# With two groups the even participant numbers are group 1, the odd ones group 0
+def counterbalance(participant_number, design = design):
+    return (participant_number + 1)%design["block_scales"].shape[0]
+
+
+# Seed of the random generator of a session. It only depends on the participant number,
+# so every session (its order, noise and outcomes) can be replayed bit-for-bit
+def session_seed(participant_number):
+    return int(participant_number)
+
+
+# Draws reward noise in bulk: normal(0,noise_sd) truncated towards zero to whole numbers,
+# only keeping values within the noise limit (same distribution as the old rejection loop)
+def draw_reward_noise(rng, n, noise_upper_limit, noise_sd = 5):
+    noise = np.empty(0)
+    while noise.size < n:
+        missing = n - noise.size
+        draws = np.trunc(rng.normal(0, noise_sd, size = 2*missing + 16))
+        noise = np.concatenate([noise, draws[np.abs(draws) <= noise_upper_limit]])
+    return noise[:n].astype(np.int8)
+
+
+# Reward size of each trial: the bin size plus its noise, in the direction of the noise mode of the bin
+# (the default config: Bin_1 is always 0, Bin_5 can only go down, the others fluctuate around the bin)
+def reward_sizes(bin_codes, noise, design = design):
+    bin_codes = np.asarray(bin_codes)
+    noise = np.asarray(noise)
+    # one choice per noise mode (in the order of noise_modes)
+    signed_noise = np.choose(design["bin_noise"][bin_codes], [np.zeros_like(noise), noise, -np.abs(noise), np.abs(noise)])
+    sizes = design["bin_sizes"][bin_codes] + signed_noise
+    return sizes.astype(np.int16)
+
+
+# Creates the trial schedule of a whole session.
+# Block 0 is the practice block (all scale types), the scale type of the other blocks is the row
+# of the counterbalancing group (c_b) in the block_scales design matrix. Every block repeats all conditions
+# n_trial_rep times, each repetition in a new random order. With testrun = 1 every block is shortened to n_test_trials.
+def build_schedule(c_b, testrun = 0, seed = None, design = design):
+    rng = np.random.default_rng(seed)
+    n_blocks = design["n_blocks"]
+    n_congruencies = len(design["congruencies"])
+    n_conditions = design["n_conditions"]
+    n_practice_trials = design["n_practice_trials"]
+
+    ## practice block: a sample of all scale type X bin X congruency conditions
+    practice = np.argsort(rng.random(len(design["scale_types"])*n_conditions))[:n_practice_trials]
+    block_column = [np.zeros(n_practice_trials, dtype = np.int16)]
+    tag_column = [practice]
+    scale_column = [practice//n_conditions]
+
+    ## experimental blocks: every repetition is a random permutation of the conditions
+    n_exp_blocks = n_blocks - 1
+    if int(testrun) == 1:
+        order = np.argsort(rng.random((n_exp_blocks, n_conditions)), axis = 1)[:, :design["n_test_trials"]]
+    else:
+        order = np.argsort(rng.random((n_exp_blocks, design["n_trial_rep"], n_conditions)), axis = 2)
+        order = order.reshape(n_exp_blocks, design["n_trial_rep"]*n_conditions)
+    exp_blocks = np.arange(1, n_blocks)
+    exp_scales = design["block_scales"][c_b, 1:]
+
+    block_column.append(np.repeat(exp_blocks, order.shape[1]))
+    tag_column.append(order.ravel())
+    scale_column.append(np.repeat(exp_scales, order.shape[1]))
+
+    block = np.concatenate(block_column).astype(np.int16)
+    tag = np.concatenate(tag_column).astype(np.int16)
+    scale = np.concatenate(scale_column).astype(np.int8)
+    n = block.size
+
+    ## trial number within its block
+    block_starts = np.searchsorted(block, block)
+    trial = (np.arange(n) - block_starts).astype(np.int16)
+
+    ## conditions
+    bin_code = ((tag%n_conditions)//n_congruencies).astype(np.int8)
+    congruency = (tag%n_congruencies).astype(np.int8)
+
+    ## rewards: noise and the outcome of a probabilistic reward (only paid out on correct trials)
+    noise = draw_reward_noise(rng, n, design["noise_upper_limit"], design["noise_sd"])
+    reward_size = reward_sizes(bin_code, noise, design)
+    prob_outcome = rng.random(n) < reward_size/100
+
+    schedule = {"Block": block,
+                "Trial": trial,
+                "Tag": tag,
+                "ScaleType": scale,
+                "Bins": bin_code,
+                "Congruency": congruency,
+                "CorAns": np.array(design["keys"])[design["correct_side"][congruency]],
+                "BinSize": design["bin_sizes"][bin_code],
+                "Reward Noise": noise,
+                "Reward Size": reward_size,
+                "Prob Outcome": prob_outcome}
+    return schedule
+
+
+# Counterbalancing, seed and schedule of the session of a participant
+def session_schedule(participant_number, testrun = 0, design = design):
+    c_b = counterbalance(int(participant_number), design)
+    seed = session_seed(participant_number)
+    schedule = build_schedule(c_b, testrun = testrun, seed = seed, design = design)
+    return c_b, seed, schedule
+
+
+# Converts a schedule column into readable values (labels for the factor codes)
+def _column_values(schedule, column, design):
+    values = schedule[column]
+    if column == "ScaleType":
+        return [design["scale_types"][v] for v in values]
+    if column == "Bins":
+        return [design["bins"][v] for v in values]
+    if column == "Congruency":
+        return [design["congruencies"][v] for v in values]
+    return values.tolist()
+
+
+# Converts the schedule into one list of trial dictionaries per block (for the TrialHandler)
+def schedule_trial_lists(schedule, columns = ("Tag", "ScaleType", "Bins", "Congruency", "CorAns",
+                                               "BinSize", "Reward Noise", "Reward Size", "Prob Outcome"), design = design):
+    values = [_column_values(schedule, column, design) for column in columns]
+    rows = [dict(zip(columns, row)) for row in zip(*values)]
+
+    n_blocks = int(schedule["Block"].max()) + 1
+    block_ends = np.searchsorted(schedule["Block"], np.arange(n_blocks), side = 'right')
+    block_starts = np.concatenate([[0], block_ends[:-1]])
+    return [rows[start:end] for start, end in zip(block_starts, block_ends)]
+
+
+# Writes the schedule to a csv file (one row per trial)
+def export_schedule(schedule, filename, design = design):
+    values = [_column_values(schedule, column, design) for column in schedule_columns]
+    with open(filename, 'w') as schedule_file:
+        writer = csv.writer(schedule_file, lineterminator = '\n')
+        writer.writerow(schedule_columns)
+        writer.writerows(zip(*values))
+
+
+# Saves a precomputed session: the schedule columns as arrays and the participant info,
+# counterbalancing, seed and config as json (an uncompressed .npz, so loading it takes milliseconds)
+def save_session(filename, schedule, info, c_b, seed, resume = False, design = design):
+    session = {"info": info, "c_b": c_b, "seed": seed, "resume": resume, "config": design["config"]}
+    arrays = {column: np.asarray(schedule[column]) for column in schedule_columns}
+    with open(filename, 'wb') as session_file:
+        np.savez(session_file, session = np.array(json.dumps(session)), **arrays)
+
+
+# Loads a session saved by save_session(), as a dictionary with the schedule under "schedule"
+# and the design it was prepared with under "design"
+def load_session(filename):
+    with np.load(filename) as stored:
+        session = json.loads(str(stored["session"]))
+        session["schedule"] = {column: stored[column] for column in schedule_columns}
+    session["design"] = compile_design(session["config"])
+    return session
@@ -0,0 +1,108 @@
+"""
+
+Frame timing instrumentation
+
+Every flip of the trial loop is recorded with its phase (Reward, Fixation, Target, Feedback, Blank).
+Within a phase the interval between two flips should be one frame, any extra frames were dropped.
+On the first flip of a phase the delay relative to its intended (frame-locked) onset counts as dropped frames.
+At the end of every block the flips and a per phase summary are appended to csv files next to the data,
+so sessions can be flagged on timing quality automatically.
+
+FrameLog: records the flips of a block and writes the flips and the block summary
+
+flag_timing(): the blocks of a timing summary with too many dropped frames
+
+"""
+from __future__ import division
+import csv, os
+
+
+flip_columns = ["Block", "Phase", "Flip Time", "Interval", "Onset Error", "Dropped Frames"]
+summary_columns = ["Block", "Phase", "Flips", "Dropped Frames", "Dropped Rate",
+                   "Mean Interval", "Max Interval", "Max Onset Error"]
+
+
+# appends rows to a csv file, with a header when the file is new
+def _append_rows(filename, columns, rows):
+    new_file = not os.path.isfile(filename)
+    with open(filename, 'a') as csv_file:
+        writer = csv.writer(csv_file, lineterminator = '\n')
+        if new_file:
+            writer.writerow(columns)
+        writer.writerows(rows)
+
+
+class FrameLog(object):
+    # frame_duration: the measured duration of one frame
+    # flips_file, summary_file: csv files the flips and the block summaries are appended to
+    def __init__(self, frame_duration, flips_file, summary_file):
+        self.frame_duration = frame_duration
+        self.flips_file = flips_file
+        self.summary_file = summary_file
+        self.block = None
+        self._flips = []
+        self._last_flip = None
+        self._last_phase = None
+
+    def start_block(self, block):
+        self.block = block
+        self._flips = []
+        self._last_flip = None
+        self._last_phase = None
+
+    # records one flip, intended_onset only for the first flip of a phase
+    def add_flip(self, phase, flip_time, intended_onset = None):
+        interval = None
+        onset_error = None
+        dropped = 0
+        if self._last_flip is not None:
+            interval = flip_time - self._last_flip
+        if intended_onset is not None:
+            onset_error = flip_time - intended_onset
+            dropped = max(0, int(round(onset_error/self.frame_duration)))
+        elif interval is not None and phase == self._last_phase:
+            dropped = max(0, int(round(interval/self.frame_duration)) - 1)
+
+        self._flips.append([self.block, phase, flip_time, interval, onset_error, dropped])
+        self._last_flip = flip_time
+        self._last_phase = phase
+
+    # per phase summary of the flips of the current block (and a 'Total' row)
+    def block_summary(self):
+        phases = []
+        for flip in self._flips:
+            if flip[1] not in phases:
+                phases.append(flip[1])
+
+        rows = []
+        for phase in phases + ["Total"]:
+            flips = [flip for flip in self._flips if phase == "Total" or flip[1] == phase]
+            # only intervals between frames of the same phase (not the phase onsets) say something about the frame rate
+            intervals = [flip[3] for flip in flips if flip[3] is not None and flip[4] is None]
+            onset_errors = [abs(flip[4]) for flip in flips if flip[4] is not None]
+            dropped = sum(flip[5] for flip in flips)
+            rows.append([self.block, phase, len(flips), dropped,
+                         dropped/(len(flips) + dropped) if flips else 0,
+                         sum(intervals)/len(intervals) if intervals else None,
+                         max(intervals) if intervals else None,
+                         max(onset_errors) if onset_errors else None])
+        return rows
+
+    # writes the flips and the summary of the current block, returns the summary
+    def end_block(self):
+        summary = self.block_summary()
+        _append_rows(self.flips_file, flip_columns, self._flips)
+        _append_rows(self.summary_file, summary_columns, summary)
+        self._flips = []
+        return summary
+
+
+# Reads a timing summary file and returns the blocks (and phases) whose rate of dropped frames
+# is above max_dropped_rate, as a list of (block, phase, dropped rate). An empty list means the session is fine
+def flag_timing(summary_file, max_dropped_rate = .01):
+    flagged = []
+    with open(summary_file) as csv_file:
+        for row in csv.DictReader(csv_file):
+            if float(row["Dropped Rate"]) > max_dropped_rate:
+                flagged.append((int(row["Block"]), row["Phase"], float(row["Dropped Rate"])))
+    return flagged
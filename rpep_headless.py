@@ -0,0 +1,444 @@
+"""
+
+Headless simulation mode
+
+Runs the full experiment (NL_final_RPEP.py) without a display and without a participant:
+
+    python NL_final_RPEP.py --headless --participant 101 --model data_long.csv
+
+In headless mode the script imports the stand-ins below instead of the psychopy modules
+(data, visual, core, event, gui and hardware.keyboard). Time is simulated: every flip advances
+a virtual clock by one frame and a response advances it by its RT, so a session runs as fast
+as the CPU allows. The participant info comes from the command line (or run_session()), and
+the responses come from a synthetic responder that reads the screen like a participant:
+the flanker string gives the congruency and the correct key, the last reward shown gives the
+ScaleType and Bin. Its accuracy and (log-normal) RTs per design cell are a configurable model,
+for example fitted on data_long.csv with fit_responder_model().
+
+requested(): whether the script should run headless
+
+configure(): sets the participant info, responder model and frame rate of the next session
+
+fit_responder_model(): responder model (accuracy and log RT per design cell) fitted on long format data
+
+run_session(): runs one headless session of the script in a folder, returns the data file name
+
+run_sessions(): runs many headless sessions, optionally over a process pool
+
+"""
+from __future__ import division
+import argparse, csv, os, sys
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+import numpy as np
+
+from rpep_design import design
+
+
+script_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "NL_final_RPEP.py")
+
+# Design cells of the responder model: Congruency X ScaleType X Bins (as in rpep_analysis),
+# for the design in rpep_config.json or RPEP_CONFIG (see rpep_design)
+_cells_per_condition = design["n_cells"]//len(design["conditions"])
+# the texts of the flankers and of every reward size on screen
+_flanker_congruency = dict((flanker, code) for code, flanker in enumerate(design["flankers"]))
+_reward_texts = {}
+for _scale_code, _scale_type in enumerate(design["config"]["scale_types"]):
+    for _size in range(int(design["bin_sizes"].max()) + design["noise_upper_limit"] + 1):
+        _reward_texts[_scale_type["format"].format(_size)] = (_scale_code, _size)
+
+# Responder used when no model is given: accuracy and log-normal RT per congruency
+# (the first congruency condition, Con, is easier than the others)
+default_model = {"accuracy": np.repeat([.95] + [.85]*(len(design["conditions"]) - 1), _cells_per_condition),
+                 "log_rt_mean": np.repeat(np.log([.40] + [.45]*(len(design["conditions"]) - 1)), _cells_per_condition),
+                 "log_rt_sd": np.full(design["n_cells"], .15)}
+
+# Settings of the next session (see configure)
+_config = {"enabled": False,
+           "info": {},
+           "resume": True,
+           "frame_rate": 60.0,
+           "model": default_model,
+           "seed": None}
+
+# State of the running session: the virtual clock, what is on screen and the data to save
+_state = {"now": 0.0, "screen": [], "drawn": [], "reward": None, "experiments": [], "rng": None, "data_file": None}
+
+
+# Whether the script should run headless: --headless on the command line, RPEP_HEADLESS=1 or configure()
+def requested():
+    return _config["enabled"] or '--headless' in sys.argv or os.environ.get("RPEP_HEADLESS") == "1"
+
+
+# Settings of the next headless session. info: the participant info dialog ("Participant number", "testrun", ...),
+# resume: answer to the resume dialog, model: responder model (see fit_responder_model), seed: seed of the responder
+def configure(info = None, resume = True, frame_rate = 60.0, model = None, seed = None):
+    _config["enabled"] = True
+    _config["info"] = dict(info or {})
+    _config["resume"] = resume
+    _config["frame_rate"] = frame_rate
+    _config["model"] = model if model is not None else default_model
+    _config["seed"] = seed
+
+
+# Settings from the command line of the script (python NL_final_RPEP.py --headless ...)
+def _configure_from_argv(argv):
+    parser = argparse.ArgumentParser(description = "Headless session of the reward scale experiment")
+    parser.add_argument("--headless", action = 'store_true')
+    parser.add_argument("--participant", default = "1", help = "participant number")
+    parser.add_argument("--testrun", type = int, default = 0, choices = [0, 1])
+    parser.add_argument("--model", default = None, help = "long format dataset to fit the responder on")
+    parser.add_argument("--frame-rate", type = float, default = 60.0)
+    parser.add_argument("--seed", type = int, default = None, help = "seed of the responder (default: participant number)")
+    arguments, unknown = parser.parse_known_args(argv[1:])
+
+    model = None
+    if arguments.model:
+        from rpep_analysis import load_long
+        model = fit_responder_model(load_long(arguments.model))
+    configure(info = {"Name": "headless", "Participant number": arguments.participant, "testrun": arguments.testrun},
+              frame_rate = arguments.frame_rate, model = model, seed = arguments.seed)
+
+
+# Responder model fitted on long format data (see rpep_analysis.load_long): per design cell the accuracy
+# of the given responses and the mean and standard deviation of their log RT. Non-responses ('N') are left out,
+# the deadline of the simulated session censors the slow responses again
+def fit_responder_model(long_data):
+    from rpep_analysis import cell_codes, n_cells
+    responded = (long_data["response"] != "N").to_numpy()
+    cells = cell_codes(long_data)[responded]
+    accurate = long_data["Accurate Response"].to_numpy()[responded].astype(np.float64)
+    log_rt = np.log(np.maximum(long_data["RT"].to_numpy()[responded].astype(np.float64), 1e-3))
+
+    n = np.bincount(cells, minlength = n_cells)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        log_rt_mean = np.bincount(cells, weights = log_rt, minlength = n_cells)/n
+        log_rt_var = np.bincount(cells, weights = log_rt**2, minlength = n_cells)/n - log_rt_mean**2
+        accuracy = np.bincount(cells, weights = accurate, minlength = n_cells)/n
+    # empty cells fall back on the default responder
+    empty = n == 0
+    return {"accuracy": np.where(empty, default_model["accuracy"], accuracy),
+            "log_rt_mean": np.where(empty, default_model["log_rt_mean"], log_rt_mean),
+            "log_rt_sd": np.where(empty, default_model["log_rt_sd"], np.sqrt(np.maximum(log_rt_var, 0)))}
+
+
+## The synthetic responder
+
+# design cell of the flanker on screen, after the last reward shown; None if no flanker is on screen
+def _screen_cell(screen):
+    flankers = [text for text in screen if text in _flanker_congruency]
+    if not flankers:
+        return None, None
+    congruency = _flanker_congruency[flankers[0]]
+    condition = design["congruency_condition"][congruency]
+    left = design["correct_side"][congruency] == 0
+
+    scale_type, bin_code = 0, 0
+    if _state["reward"] is not None:
+        scale_type, size = _state["reward"]
+        bin_code = int(np.argmin(np.abs(design["bin_sizes"] - size)))
+    return (condition*len(design["scale_types"]) + scale_type)*len(design["bins"]) + bin_code, left
+
+
+# Response of the synthetic participant to the screen: (key, rt) or (None, None) for the instruction screens.
+# keys[0] is the left response key and keys[1] the right one
+def _respond(keys):
+    cell, left = _screen_cell(_state["screen"])
+    if cell is None:
+        return None, None
+    model = _config["model"]
+    # a prepared session (--session) has no participant dialog
+    _start_responder(str(_config["info"].get("Participant number", "")))
+    rng = _state["rng"]
+    correct = rng.random() < model["accuracy"][cell]
+    rt = float(np.exp(rng.normal(model["log_rt_mean"][cell], model["log_rt_sd"][cell])))
+    return keys[0 if left == correct else 1], rt
+
+
+## Stand-ins for the psychopy modules
+
+def _get_time():
+    return _state["now"]
+
+
+class Clock(object):
+    def __init__(self):
+        self._start = _state["now"]
+
+    def reset(self):
+        self._start = _state["now"]
+
+    def getTime(self):
+        return _state["now"] - self._start
+
+
+# quitting saves the data (as psychopy does) and stops the script
+def _quit():
+    for experiment in _state["experiments"]:
+        experiment.saveAsWideText(experiment.dataFileName + ".csv")
+    _state["experiments"] = []
+    raise SystemExit(0)
+
+
+class Window(object):
+    def __init__(self, fullscr = True, color = 'black', allowGUI = True, **kwargs):
+        self.fullscr = fullscr
+        self.mouseVisible = False
+        self._on_flip = []
+        _state["now"] = 0.0
+        _state["screen"] = []
+        _state["drawn"] = []
+        _state["reward"] = None
+
+    def getActualFrameRate(self, **kwargs):
+        return _config["frame_rate"]
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._on_flip.append((function, args, kwargs))
+
+    # one frame passes, what was drawn is now on screen
+    def flip(self):
+        _state["now"] += 1.0/_config["frame_rate"]
+        _state["screen"] = _state["drawn"]
+        _state["drawn"] = []
+        for text in _state["screen"]:
+            if text in _reward_texts:
+                _state["reward"] = _reward_texts[text]
+        for function, args, kwargs in self._on_flip:
+            function(*args, **kwargs)
+        self._on_flip = []
+        return _state["now"]
+
+    def close(self):
+        pass
+
+
+class TextStim(object):
+    def __init__(self, win, text = "", **kwargs):
+        self.win = win
+        self.text = text
+        for name in kwargs:
+            setattr(self, name, kwargs[name])
+
+    def draw(self):
+        _state["drawn"].append(self.text)
+
+
+class Dlg(object):
+    def __init__(self, title = "", **kwargs):
+        self.title = title
+        self.text = []
+        self.OK = True
+
+    def addText(self, text):
+        self.text.append(text)
+
+    # the resume dialog is answered from the settings, an error dialog would ask for new participant info
+    def show(self):
+        if self.title == "Error":
+            raise RuntimeError("Headless participant info was rejected: {0}".format(" ".join(self.text)))
+        self.OK = _config["resume"]
+        return self.OK
+
+
+# seeds the simulated participant once per session, with the configured seed or the participant number
+def _start_responder(participant_number):
+    if _state["rng"] is None:
+        seed = _config["seed"]
+        if seed is None and participant_number.isdigit():
+            seed = int(participant_number)
+        # a different random stream than the schedule of the session (seeded with the same number)
+        _state["rng"] = np.random.default_rng(None if seed is None else [seed, 1])
+
+
+class DlgFromDict(object):
+    def __init__(self, dictionary, title = "", show = True, **kwargs):
+        self.dictionary = dictionary
+        self.OK = True
+        if show:
+            self.show()
+
+    # fills in the participant info of the settings, the first option of every choice otherwise
+    def show(self):
+        for name in self.dictionary:
+            if name in _config["info"]:
+                self.dictionary[name] = _config["info"][name]
+            elif isinstance(self.dictionary[name], list):
+                self.dictionary[name] = self.dictionary[name][0]
+        self.dictionary["Participant number"] = str(self.dictionary["Participant number"])
+        _start_responder(self.dictionary["Participant number"])
+        return self.OK
+
+
+def _wait_keys(keyList = None, maxWait = float('inf'), **kwargs):
+    key, rt = _respond(keyList)
+    if key is None:
+        # an instruction screen
+        return ['space'] if keyList and 'space' in keyList else None
+    if rt >= maxWait:
+        _state["now"] += maxWait
+        return None
+    _state["now"] += rt
+    return [key]
+
+
+class _KeyPress(object):
+    def __init__(self, name, rt):
+        self.name = name
+        self.rt = rt
+        self.tDown = _state["now"]
+
+
+class Keyboard(object):
+    def __init__(self, **kwargs):
+        self.clock = Clock()
+
+    def clearEvents(self, eventType = None):
+        pass
+
+    def waitKeys(self, maxWait = float('inf'), keyList = None, waitRelease = True, **kwargs):
+        keys = _wait_keys(keyList = keyList, maxWait = maxWait)
+        if not keys:
+            return None
+        return [_KeyPress(keys[0], self.clock.getTime())]
+
+
+class TrialHandler(object):
+    def __init__(self, trialList, nReps = 1, method = 'random', **kwargs):
+        self.trialList = trialList
+        self.thisN = -1
+        self.thisTrial = None
+        self.finished = False
+        self._data = {}
+
+    def __iter__(self):
+        for trial in self.trialList:
+            self.thisN += 1
+            self.thisTrial = trial
+            self._data = {}
+            yield trial
+        self.finished = True
+
+    def addData(self, name, value):
+        self._data[name] = value
+
+
+class ExperimentHandler(object):
+    def __init__(self, dataFileName = "", **kwargs):
+        self.dataFileName = dataFileName
+        _state["data_file"] = dataFileName
+        self.entries = []
+        self._loops = []
+        self._data = {}
+        _state["experiments"].append(self)
+
+    def addLoop(self, loop):
+        self._loops.append(loop)
+
+    def addData(self, name, value):
+        self._data[name] = value
+
+    # the entry of the current trial: trial info and data of the running loops and the added data
+    def nextEntry(self):
+        entry = {}
+        for loop in self._loops:
+            if not loop.finished and loop.thisTrial is not None:
+                entry.update(loop.thisTrial)
+                entry.update(loop._data)
+        entry.update(self._data)
+        if entry:
+            self.entries.append(entry)
+        self._data = {}
+
+    def saveAsWideText(self, fileName, **kwargs):
+        if self._data:
+            self.nextEntry()
+        columns = []
+        for entry in self.entries:
+            for name in entry:
+                if name not in columns:
+                    columns.append(name)
+        with open(fileName, 'w') as data_file:
+            writer = csv.DictWriter(data_file, fieldnames = columns, lineterminator = '\n')
+            writer.writeheader()
+            writer.writerows(self.entries)
+
+
+data = SimpleNamespace(TrialHandler = TrialHandler, ExperimentHandler = ExperimentHandler)
+visual = SimpleNamespace(Window = Window, TextStim = TextStim)
+core = SimpleNamespace(Clock = Clock, getTime = _get_time, quit = _quit)
+event = SimpleNamespace(waitKeys = _wait_keys, clearEvents = lambda eventType = None: None,
+                        globalKeys = SimpleNamespace(add = lambda **kwargs: None))
+gui = SimpleNamespace(Dlg = Dlg, DlgFromDict = DlgFromDict)
+keyboard = SimpleNamespace(Keyboard = Keyboard)
+
+# started from the command line (or with RPEP_HEADLESS=1) instead of run_session()
+if requested() and not _config["enabled"]:
+    _configure_from_argv(sys.argv)
+
+
+## Running sessions
+
+# Runs one headless session of the experiment in a folder (its DATA folder is created when needed).
+# With a collector ("host:port", see rpep_collector) the session is a station of a multi-station lab,
+# participant_number None then takes the next free number of the collector.
+# namespace: a dictionary the script runs in, it keeps the functions and objects of the script afterwards.
+# Returns the name of the data file of the session (without .csv), None when the script stopped before creating one
+# (escape or a cancelled dialog)
+def run_session(participant_number, directory = ".", testrun = 0, model = None, frame_rate = 60.0, seed = None,
+                collector = None, station = None, namespace = None):
+    data_directory = os.path.join(directory, "DATA")
+    # simulated stations can share the folder
+    os.makedirs(data_directory, exist_ok = True)
+    if participant_number is None:
+        participant_number = ""
+    configure(info = {"Name": "headless", "Participant number": str(participant_number), "testrun": testrun},
+              resume = False, frame_rate = frame_rate, model = model, seed = seed)
+    _state["rng"] = None
+    _state["experiments"] = []
+    _state["data_file"] = None
+    argv = [script_file]
+    if collector is not None:
+        argv += ["--collector", collector, "--station", station or "station-{0}".format(os.getpid())]
+
+    # the script imports the rpep modules next to it, also after changing folder
+    script_directory = os.path.dirname(script_file)
+    if script_directory not in sys.path:
+        sys.path.insert(0, script_directory)
+    working_directory = os.getcwd()
+    script_argv = sys.argv
+    os.chdir(directory)
+    sys.argv = argv
+    if namespace is None:
+        namespace = {}
+    namespace.update({"__name__": "__main__", "__file__": script_file})
+    try:
+        with open(script_file) as script:
+            code = compile(script.read(), script_file, 'exec')
+        exec(code, namespace)
+    except SystemExit:
+        pass
+    finally:
+        # the data file of the session, relative to its folder
+        data_file = os.path.relpath(_state["data_file"]) if _state["data_file"] else None
+        os.chdir(working_directory)
+        sys.argv = script_argv
+    if data_file is None:
+        return None
+    return os.path.join(directory, data_file)
+
+
+def _run_session_arguments(arguments):
+    return run_session(*arguments)
+
+
+# Runs a headless session for every participant number, in this process or over a process pool.
+# With a collector every session is a simulated station (station-1, station-2, ...)
+def run_sessions(participant_numbers, directory = ".", testrun = 0, model = None, frame_rate = 60.0, workers = 1,
+                 collector = None):
+    arguments = [(number, directory, testrun, model, frame_rate, None, collector, "station-{0}".format(i + 1))
+                 for i, number in enumerate(participant_numbers)]
+    if workers is None or workers > 1:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            return list(pool.map(_run_session_arguments, arguments))
+    return [_run_session_arguments(argument) for argument in arguments]
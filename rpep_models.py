@@ -0,0 +1,409 @@
+"""
+
+Repeated measures ANOVA and mixed models of the long format dataset (data_long.csv)
+
+Every predictor of the Congruency X ScaleType X Bins design is constant within a design cell, so the trial
+level design matrix factors into the indicator of the cell of every trial (sparse, kept as the cell codes)
+times a small cell level design matrix (20 cells X 20 columns for the full factorial model), and the
+subject random effects into the indicator of the subject of every trial. The models are fitted on
+per subject X cell sufficient statistics (counts, sums), so every product with the design matrix is a
+product with the 20 X 20 matrix, whatever the number of trials. The cell level design matrices are cached
+per factor coding and shared by all models.
+
+rm_anova(): repeated measures ANOVA of the cell means (Greenhouse-Geisser corrected)
+
+fit_accuracy_glmm(): logistic mixed model of Accurate Response (random subject intercepts, Laplace approximation)
+
+fit_rt_lmm(): linear mixed model of log RT of the correct responses (random subject intercepts, REML), i.e. log-normal RT
+
+fit_subject_models(): per subject logistic and log RT regressions (over a process pool), for two stage analyses
+
+fit_models(): all of the above; with the previous fits as start, a refit after adding subjects is warm started
+
+"""
+from __future__ import division
+from concurrent.futures import ProcessPoolExecutor
+import itertools, math
+import numpy as np
+import pandas
+
+from rpep_analysis import congruency_levels, scale_levels, bin_levels, n_cells, subject_cell_codes
+
+
+factor_levels = [("Congruency", congruency_levels), ("ScaleType", scale_levels), ("Bins", bin_levels)]
+
+golden_ratio = (np.sqrt(5) - 1)/2
+
+
+## Distributions (two-sided normal, chi-squared and F p-values)
+
+# regularised upper incomplete gamma function Q(a, x)
+def _gamma_q(a, x):
+    if x <= 0:
+        return 1.0
+    if x < a + 1:
+        term = total = 1/a
+        for n in range(1, 500):
+            term *= x/(a + n)
+            total += term
+            if abs(term) < abs(total)*1e-15:
+                break
+        return max(0.0, 1 - total*math.exp(-x + a*math.log(x) - math.lgamma(a)))
+    # continued fraction (Lentz)
+    b = x + 1 - a
+    c = 1/1e-300
+    d = 1/b
+    h = d
+    for i in range(1, 500):
+        an = -i*(i - a)
+        b += 2
+        d = an*d + b
+        d = 1e-300 if abs(d) < 1e-300 else d
+        c = b + an/c
+        c = 1e-300 if abs(c) < 1e-300 else c
+        d = 1/d
+        h *= d*c
+        if abs(d*c - 1) < 1e-15:
+            break
+    return math.exp(-x + a*math.log(x) - math.lgamma(a))*h
+
+
+# regularised incomplete beta function I_x(a, b)
+def _beta_i(a, b, x):
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    if x > (a + 1)/(a + b + 2):
+        return 1 - _beta_i(b, a, 1 - x)
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a*math.log(x) + b*math.log(1 - x))/a
+    # continued fraction (Lentz)
+    c, d = 1.0, 1 - (a + b)*x/(a + 1)
+    d = 1/(1e-300 if abs(d) < 1e-300 else d)
+    h = d
+    for m in range(1, 500):
+        for numerator in (m*(b - m)*x/((a + 2*m - 1)*(a + 2*m)), -(a + m)*(a + b + m)*x/((a + 2*m)*(a + 2*m + 1))):
+            d = 1 + numerator*d
+            d = 1/(1e-300 if abs(d) < 1e-300 else d)
+            c = 1 + numerator/c
+            c = 1e-300 if abs(c) < 1e-300 else c
+            h *= d*c
+        if abs(d*c - 1) < 1e-15:
+            break
+    return front*h
+
+
+def normal_p(z):
+    return math.erfc(abs(z)/math.sqrt(2))
+
+
+def chi2_p(statistic, df):
+    return _gamma_q(df/2, statistic/2)
+
+
+def f_p(statistic, df1, df2):
+    if not statistic > 0:
+        return 1.0
+    return _beta_i(df2/2, df1/2, df2/(df2 + df1*statistic))
+
+
+## Cell level design matrices
+
+_design_matrices = {}
+
+
+# factor coding of k levels: "effect" (sum to zero, the last level is -1) or "treatment" (the first level is the reference)
+def _coding(k, coding):
+    if coding == "effect":
+        return np.vstack([np.eye(k - 1), -np.ones((1, k - 1))])
+    if coding == "treatment":
+        return np.eye(k)[:, 1:]
+    raise ValueError("Unknown factor coding: {0}".format(coding))
+
+
+# The cell level design matrix of the full factorial model: {"X": n_cells X n_columns, "columns": their names,
+# "terms": {term: column slice}}. Cached per coding, the cells are ordered as in rpep_analysis.cell_codes
+def design_matrix(coding = "effect"):
+    key = (coding, tuple(tuple(levels) for name, levels in factor_levels))
+    if key in _design_matrices:
+        return _design_matrices[key]
+    blocks, columns, terms = [], [], {}
+    for included in itertools.product([False, True], repeat = len(factor_levels)):
+        matrix = np.ones((1, 1))
+        names = [""]
+        for (factor, levels), use in zip(factor_levels, included):
+            if use:
+                part = _coding(len(levels), coding)
+                part_names = ["{0}[{1}]".format(factor, level) for level in (levels[:-1] if coding == "effect" else levels[1:])]
+            else:
+                part = np.ones((len(levels), 1))
+                part_names = [""]
+            matrix = np.kron(matrix, part)
+            names = [":".join(name for name in (a, b) if name) for a in names for b in part_names]
+        term = " X ".join(factor for (factor, levels), use in zip(factor_levels, included) if use) or "Intercept"
+        terms[term] = slice(len(columns), len(columns) + matrix.shape[1])
+        blocks.append(matrix)
+        columns += [name or "Intercept" for name in names]
+    # terms ordered by their order (main effects before interactions)
+    order = sorted(terms, key = lambda term: (term != "Intercept", term.count(" X "), list(terms).index(term)))
+    X = np.hstack([blocks[list(terms).index(term)] for term in order])
+    columns_ordered, slices, start = [], {}, 0
+    for term in order:
+        width = terms[term].stop - terms[term].start
+        columns_ordered += columns[terms[term]]
+        slices[term] = slice(start, start + width)
+        start += width
+    _design_matrices[key] = {"X": X, "columns": columns_ordered, "terms": slices}
+    return _design_matrices[key]
+
+
+# Per subject X design cell sufficient statistics of the models (n_subjects X n_cells arrays): trials, correct responses,
+# summed RT of the correct responses, and the count, sum and sum of squares of their log RT
+def model_data(long_data):
+    groups, n_subjects = subject_cell_codes(long_data)
+    n_groups = n_subjects*n_cells
+    accurate = long_data["Accurate Response"].to_numpy() == 1
+    rt = long_data["RT"].to_numpy().astype(np.float64)
+    log_rt = np.log(np.maximum(rt, 1e-3))
+
+    data = {"n": np.bincount(groups, minlength = n_groups),
+            "correct": np.bincount(groups, weights = accurate, minlength = n_groups),
+            "rt_raw_sum": np.bincount(groups[accurate], weights = rt[accurate], minlength = n_groups),
+            "rt_n": np.bincount(groups[accurate], minlength = n_groups),
+            "rt_sum": np.bincount(groups[accurate], weights = log_rt[accurate], minlength = n_groups),
+            "rt_squares": np.bincount(groups[accurate], weights = log_rt[accurate]**2, minlength = n_groups)}
+    for name in data:
+        data[name] = data[name].reshape(n_subjects, n_cells).astype(np.float64)
+    data["subjects"] = list(long_data["Subject"].cat.categories)
+    return data
+
+
+# the coefficients table and the Wald tests of the terms of a fit
+def _coefficient_tables(beta, covariance, matrix):
+    se = np.sqrt(np.diag(covariance))
+    coefficients = pandas.DataFrame({"Column": matrix["columns"], "Estimate": beta, "SE": se, "z": beta/se,
+                                     "p": [normal_p(z) for z in beta/se]})
+    rows = []
+    for term, columns in matrix["terms"].items():
+        if term == "Intercept":
+            continue
+        estimate = beta[columns]
+        statistic = float(estimate.dot(np.linalg.solve(covariance[columns, columns], estimate)))
+        df = columns.stop - columns.start
+        rows.append({"Term": term, "Chi2": statistic, "df": df, "p": chi2_p(statistic, df)})
+    return coefficients, pandas.DataFrame(rows)
+
+
+# maximum of a function of one variable in [lower, upper] (golden section search), returns (x, value)
+def _golden_maximum(function, lower, upper, tolerance = 1e-4):
+    left = upper - golden_ratio*(upper - lower)
+    right = lower + golden_ratio*(upper - lower)
+    left_value, right_value = function(left), function(right)
+    while upper - lower > tolerance:
+        if left_value > right_value:
+            upper, right, right_value = right, left, left_value
+            left = upper - golden_ratio*(upper - lower)
+            left_value = function(left)
+        else:
+            lower, left, left_value = left, right, right_value
+            right = lower + golden_ratio*(upper - lower)
+            right_value = function(right)
+    x = (lower + upper)/2
+    return x, function(x)
+
+
+## Repeated measures ANOVA
+
+# Repeated measures ANOVA of the cell means per subject ("Mean RT" of the correct responses or "Accuracy"),
+# with the Greenhouse-Geisser corrected p-values. Subjects missing a cell are left out
+def rm_anova(long_data, measure = "Mean RT", data = None):
+    if data is None:
+        data = model_data(long_data)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        if measure == "Mean RT":
+            means = data["rt_raw_sum"]/data["rt_n"]
+        elif measure == "Accuracy":
+            means = data["correct"]/data["n"]
+        else:
+            raise ValueError("Unknown measure: {0}".format(measure))
+    means = means[~np.isnan(means).any(axis = 1)]
+    n = len(means)
+    matrix = design_matrix("effect")
+    rows = []
+    for term, columns in matrix["terms"].items():
+        if term == "Intercept":
+            continue
+        # orthonormal contrasts of the term: the subjects' scores on them
+        basis = np.linalg.qr(matrix["X"][:, columns])[0]
+        scores = means.dot(basis)
+        k = basis.shape[1]
+        mean_scores = scores.mean(axis = 0)
+        deviations = scores - mean_scores
+        ss_effect = n*np.sum(mean_scores**2)
+        ss_error = np.sum(deviations**2)
+        df1, df2 = k, (n - 1)*k
+        F = (ss_effect/df1)/(ss_error/df2)
+        covariance = deviations.T.dot(deviations)/(n - 1)
+        epsilon = min(1.0, np.trace(covariance)**2/(k*np.sum(covariance**2)))
+        rows.append({"Effect": term, "df1": df1, "df2": df2, "F": F, "p": f_p(F, df1, df2),
+                     "GG epsilon": epsilon, "p GG": f_p(F, df1*epsilon, df2*epsilon)})
+    return pandas.DataFrame(rows)
+
+
+## Logistic mixed model of accuracy
+
+# joint mode of the fixed effects and the subject intercepts for a subject sd (penalised Newton), warm started
+def _logistic_mode(data, X, sd, beta, b, iterations = 50):
+    N, Y = data["n"], data["correct"]
+
+    def objective(beta, b):
+        eta = X.dot(beta)[None, :] + b[:, None]
+        return np.sum(Y*eta - N*np.logaddexp(0, eta)) - np.sum(b**2)/(2*sd**2)
+
+    value = objective(beta, b)
+    for i in range(iterations):
+        eta = X.dot(beta)[None, :] + b[:, None]
+        p = 1/(1 + np.exp(-eta))
+        residual = Y - N*p
+        W = N*p*(1 - p)
+        gradient_beta = X.T.dot(residual.sum(axis = 0))
+        gradient_b = residual.sum(axis = 1) - b/sd**2
+        h_bb = W.sum(axis = 1) + 1/sd**2
+        h_betab = X.T.dot(W.T)
+        # Schur complement of the (diagonal) subject block
+        schur = X.T.dot(W.sum(axis = 0)[:, None]*X) - (h_betab/h_bb).dot(h_betab.T)
+        step_beta = np.linalg.solve(schur, gradient_beta - h_betab.dot(gradient_b/h_bb))
+        step_b = (gradient_b - h_betab.T.dot(step_beta))/h_bb
+        scale = 1.0
+        while True:
+            new_value = objective(beta + scale*step_beta, b + scale*step_b)
+            if new_value >= value - 1e-10 or scale < 1e-4:
+                break
+            scale /= 2
+        beta, b = beta + scale*step_beta, b + scale*step_b
+        converged = abs(new_value - value) < 1e-9*(1 + abs(value))
+        value = new_value
+        if converged:
+            break
+    return beta, b, value, h_bb, schur
+
+
+# Logistic mixed model of Accurate Response: the full factorial Congruency X ScaleType X Bins fixed effects
+# and a random intercept per subject, fitted by the Laplace approximation (the subject sd by golden section).
+# start: a previous fit, its estimates (and those of its subjects) start the refit
+def fit_accuracy_glmm(long_data, coding = "effect", start = None, data = None):
+    if data is None:
+        data = model_data(long_data)
+    X = design_matrix(coding)["X"]
+    n_subjects = len(data["subjects"])
+    state = {"beta": np.zeros(X.shape[1]), "b": np.zeros(n_subjects)}
+    log_sd_range = (-4.0, 2.0)
+    if start is not None:
+        state["beta"] = np.array(start["beta"])
+        previous = dict(zip(start["subjects"], start["b"]))
+        state["b"] = np.array([previous.get(subject, 0.0) for subject in data["subjects"]])
+        log_sd_range = (np.log(start["subject_sd"]) - 1, np.log(start["subject_sd"]) + 1)
+
+    def log_likelihood(log_sd):
+        sd = np.exp(log_sd)
+        beta, b, value, h_bb, schur = _logistic_mode(data, X, sd, state["beta"], state["b"])
+        state["beta"], state["b"] = beta, b
+        return value - .5*np.sum(np.log(sd**2*h_bb))
+
+    log_sd, value = _golden_maximum(log_likelihood, *log_sd_range)
+    sd = float(np.exp(log_sd))
+    beta, b, mode_value, h_bb, schur = _logistic_mode(data, X, sd, state["beta"], state["b"])
+    coefficients, terms = _coefficient_tables(beta, np.linalg.inv(schur), design_matrix(coding))
+    return {"coefficients": coefficients, "terms": terms, "subject_sd": sd, "deviance": -2*value,
+            "beta": beta, "b": b, "subjects": list(data["subjects"]), "coding": coding}
+
+
+## Linear mixed model of log RT
+
+# REML fit of the log RT model for a ratio of the subject and residual variance: (criterion, beta, sigma2, A)
+def _rt_reml(data, X, ratio):
+    m, s, q = data["rt_n"], data["rt_sum"], data["rt_squares"]
+    n_subject = m.sum(axis = 1)
+    S, Q = s.sum(axis = 1), q.sum(axis = 1)
+    w = ratio/(1 + n_subject*ratio)
+    Xm = m.dot(X)
+    A = X.T.dot(m.sum(axis = 0)[:, None]*X) - (Xm*w[:, None]).T.dot(Xm)
+    c = X.T.dot(s.sum(axis = 0)) - Xm.T.dot(w*S)
+    beta = np.linalg.solve(A, c)
+    rss = np.sum(Q - w*S**2) - beta.dot(c)
+    n, p = m.sum(), X.shape[1]
+    sigma2 = rss/(n - p)
+    criterion = (n - p)*np.log(sigma2) + np.sum(np.log(1 + n_subject*ratio)) + np.linalg.slogdet(A)[1]
+    return criterion, beta, sigma2, A
+
+
+# Linear mixed model of the log RT of the correct responses (a log-normal RT model): the full factorial fixed effects
+# and a random intercept per subject, fitted by REML (the variance ratio by golden section).
+# start: a previous fit, the search starts around its variance ratio
+def fit_rt_lmm(long_data, coding = "effect", start = None, data = None):
+    if data is None:
+        data = model_data(long_data)
+    X = design_matrix(coding)["X"]
+    log_ratio_range = (-12.0, 4.0)
+    if start is not None:
+        log_ratio = np.log(start["subject_sd"]**2/start["sigma"]**2)
+        log_ratio_range = (log_ratio - 1, log_ratio + 1)
+    log_ratio, value = _golden_maximum(lambda log_ratio: -_rt_reml(data, X, np.exp(log_ratio))[0], *log_ratio_range)
+    criterion, beta, sigma2, A = _rt_reml(data, X, np.exp(log_ratio))
+    coefficients, terms = _coefficient_tables(beta, sigma2*np.linalg.inv(A), design_matrix(coding))
+    return {"coefficients": coefficients, "terms": terms, "sigma": float(np.sqrt(sigma2)),
+            "subject_sd": float(np.sqrt(np.exp(log_ratio)*sigma2)), "reml_criterion": float(criterion),
+            "beta": beta, "subjects": list(data["subjects"]), "coding": coding}
+
+
+## Per subject models
+
+# logistic regression (ridge stabilised, a subject may be always correct in a cell) and log RT regression of one subject
+def _subject_fit(arguments):
+    n, correct, rt_n, rt_sum, X, ridge = arguments
+    beta = np.zeros(X.shape[1])
+    for i in range(50):
+        p = 1/(1 + np.exp(-X.dot(beta)))
+        hessian = X.T.dot((n*p*(1 - p))[:, None]*X) + ridge*np.eye(X.shape[1])
+        step = np.linalg.solve(hessian, X.T.dot(correct - n*p) - ridge*beta)
+        beta += step
+        if np.max(np.abs(step)) < 1e-8:
+            break
+    # cells without correct responses don't count for the RT regression
+    rt_beta = np.linalg.lstsq(np.sqrt(rt_n)[:, None]*X, np.where(rt_n > 0, rt_sum/np.maximum(rt_n, 1), 0)*np.sqrt(rt_n), rcond = None)[0]
+    return beta, rt_beta
+
+
+# Per subject regressions (first stage of a two stage analysis): logistic regression of Accurate Response and
+# regression of log RT of the correct responses, on the same design matrix, over a process pool (None = all cpus).
+# Returns one table per model: a row per subject, a column per coefficient
+def fit_subject_models(long_data, coding = "effect", workers = 1, ridge = 1e-2, data = None):
+    if data is None:
+        data = model_data(long_data)
+    matrix = design_matrix(coding)
+    tasks = [(data["n"][i], data["correct"][i], data["rt_n"][i], data["rt_sum"][i], matrix["X"], ridge)
+             for i in range(len(data["subjects"]))]
+    if workers is None or workers > 1:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            results = list(pool.map(_subject_fit, tasks))
+    else:
+        results = [_subject_fit(task) for task in tasks]
+    tables = {}
+    for name, index in (("accuracy", 0), ("log RT", 1)):
+        table = pandas.DataFrame([result[index] for result in results], columns = matrix["columns"])
+        table.insert(0, "Subject", data["subjects"])
+        tables[name] = table
+    return tables
+
+
+# Every standard model of the dataset: the repeated measures ANOVAs of mean RT and accuracy, the accuracy GLMM,
+# the log RT LMM and the per subject regressions. previous: the result of an earlier call (e.g. before subjects
+# were added), whose mixed model estimates start the refits
+def fit_models(long_data, coding = "effect", previous = None, workers = 1):
+    data = model_data(long_data)
+    previous = previous or {}
+    return {"rm_anova RT": rm_anova(long_data, "Mean RT", data),
+            "rm_anova accuracy": rm_anova(long_data, "Accuracy", data),
+            "accuracy glmm": fit_accuracy_glmm(long_data, coding, previous.get("accuracy glmm"), data),
+            "rt lmm": fit_rt_lmm(long_data, coding, previous.get("rt lmm"), data),
+            "subject models": fit_subject_models(long_data, coding, workers, data = data)}
@@ -0,0 +1,266 @@
+"""
+
+Online data-quality monitor for the experimenter
+
+During a session the experimenter only sees the participant screen. The monitor receives every trial row
+from the trial loop (put() never blocks: a full queue drops the row and counts it), and a thread of its own
+keeps per block X ScaleType: the accuracy, the timeout (non-response) rate, RT quantiles and the congruency
+effect (mean RT of the correct responses, the other congruency conditions minus the first one). The RT
+quantiles come from a sketch of constant size (a histogram over log-spaced bins), whatever the length of the session.
+Alerts are raised when the participant stops responding, or keeps timing out at the lower limit of the deadline.
+
+The statistics are shown in the terminal (printed every few seconds and at the end of every block) and/or on
+a local web page (http://127.0.0.1:PORT/, /stats gives them as json):
+
+    python NL_final_RPEP.py --monitor                       (terminal)
+    python NL_final_RPEP.py --monitor-port 8000             (web page)
+
+(or RPEP_MONITOR=1 and RPEP_MONITOR_PORT).
+
+RTSketch: constant memory RT distribution with quantiles
+
+Monitor: the monitor, fed by put() from the trial loop
+
+monitor_arguments(): the monitor settings given to the experiment script
+
+"""
+from __future__ import division, print_function
+import argparse, json, os, sys, threading, time
+from collections import deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import numpy as np
+
+from rpep_design import design
+
+
+# A distribution of RTs in a fixed number of log-spaced bins between lowest and highest (seconds):
+# the quantiles are exact to within the width of a bin (about 2 % of the RT with the defaults)
+class RTSketch(object):
+    def __init__(self, lowest = .01, highest = 10.0, n_bins = 360):
+        self.edges = np.geomspace(lowest, highest, n_bins + 1)
+        self.counts = np.zeros(n_bins + 2, dtype = np.int64)
+        self.n = 0
+
+    def add(self, rt):
+        # bin 0 and the last bin hold the RTs below and above the range
+        self.counts[np.searchsorted(self.edges, rt, side = 'right')] += 1
+        self.n += 1
+
+    # the q quantile (0-1), interpolated within its bin; None without RTs
+    def quantile(self, q):
+        if self.n == 0:
+            return None
+        cumulative = np.cumsum(self.counts)
+        target = q*self.n
+        index = int(np.searchsorted(cumulative, max(target, 1e-9)))
+        if index == 0:
+            return float(self.edges[0])
+        if index >= len(self.edges):
+            return float(self.edges[-1])
+        below = cumulative[index - 1]
+        fraction = (target - below)/self.counts[index]
+        return float(self.edges[index - 1]*(self.edges[index]/self.edges[index - 1])**fraction)
+
+
+# the statistics of one block X ScaleType
+class _GroupStats(object):
+    def __init__(self):
+        self.n = 0
+        self.correct = 0
+        self.timeouts = 0
+        self.sketch = RTSketch()
+        # per congruency condition: correct responses and their summed RT
+        self.condition_n = np.zeros(len(design["conditions"]), dtype = np.int64)
+        self.condition_rt = np.zeros(len(design["conditions"]))
+
+    def add(self, accurate, rt, responded, condition):
+        self.n += 1
+        self.correct += accurate
+        if not responded:
+            self.timeouts += 1
+            return
+        self.sketch.add(rt)
+        if accurate:
+            self.condition_n[condition] += 1
+            self.condition_rt[condition] += rt
+
+    def summary(self):
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            mean_rt = self.condition_rt/self.condition_n
+        effect = None
+        if self.condition_n[0] and self.condition_n[1:].sum():
+            effect = float(self.condition_rt[1:].sum()/self.condition_n[1:].sum() - mean_rt[0])
+        return {"n": self.n,
+                "accuracy": self.correct/self.n if self.n else None,
+                "timeout rate": self.timeouts/self.n if self.n else None,
+                "RT q10": self.sketch.quantile(.1),
+                "RT median": self.sketch.quantile(.5),
+                "RT q90": self.sketch.quantile(.9),
+                "congruency effect": effect}
+
+
+class Monitor(object):
+    # terminal: stream the statistics are printed on (None: no terminal view), every interval seconds
+    # port: port of the local web page (None: no web page), max_queue: rows waiting for the monitor thread
+    # window: trials of the alerts, design: the design of the session
+    def __init__(self, terminal = sys.stderr, port = None, interval = 5.0, max_queue = 10000, window = 10, design = design):
+        self.terminal = terminal
+        self.interval = interval
+        self.window = window
+        self.design = design
+        self.dropped = 0
+        self.groups = {}
+        self.alerts = []
+        self._condition = dict((congruency, int(condition)) for congruency, condition in zip(design["congruencies"], design["congruency_condition"]))
+        self._condition.update((condition, i) for i, condition in enumerate(design["conditions"]))
+        self._recent = deque(maxlen = window)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize = max_queue)
+        self._last_render = time.time()
+        self._server = None
+        if port is not None:
+            self._start_web(port)
+        self._thread = threading.Thread(target = self._run, name = "monitor", daemon = True)
+        self._thread.start()
+
+    # hands a trial row over to the monitor thread, never waits (a full queue drops the row)
+    def put(self, row):
+        try:
+            self._queue.put_nowait(dict(row))
+        except queue.Full:
+            self.dropped += 1
+
+    # marks the end of a block: the terminal view is printed
+    def end_block(self, block):
+        try:
+            self._queue.put_nowait(("block_end", block))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            if isinstance(entry, tuple):
+                self._render()
+                continue
+            with self._lock:
+                self._add(entry)
+            if time.time() - self._last_render >= self.interval:
+                self._render()
+
+    def _add(self, row):
+        response = str(row.get("response", ""))
+        rt = float(row.get("RT", 0))
+        deadline = row.get("Response Deadline")
+        responded = response[:1] not in ("N", "")
+        key = (int(row.get("Block", 0)), str(row.get("ScaleType", "")))
+        group = self.groups.setdefault(key, _GroupStats())
+        group.add(int(row.get("Accurate Response", 0)), rt, responded, self._condition.get(str(row.get("Congruency")), 0))
+
+        ## alerts over the last trials
+        self._recent.append((responded, deadline))
+        if len(self._recent) == self.window:
+            timeouts = sum(1 for responded, deadline in self._recent if not responded)
+            at_floor = all(deadline is not None and deadline <= self.design["deadline"]["lower"] + 1e-9
+                           for responded, deadline in self._recent)
+            if timeouts == self.window:
+                self._alert(key[0], "no response on the last {0} trials".format(self.window))
+            elif timeouts >= self.window/2 and at_floor:
+                self._alert(key[0], "{0} of the last {1} trials timed out at the deadline floor ({2} s)".format(
+                    timeouts, self.window, self.design["deadline"]["lower"]))
+
+    # an alert is raised once per block and message
+    def _alert(self, block, message):
+        alert = {"block": block, "message": message, "time": time.strftime("%H:%M:%S")}
+        if not any(earlier["block"] == block and earlier["message"] == message for earlier in self.alerts):
+            self.alerts.append(alert)
+            if self.terminal is not None:
+                print("MONITOR ALERT (block {0}): {1}".format(block, message), file = self.terminal)
+
+    # The statistics so far: one row per block X ScaleType, the alerts and the dropped rows
+    def snapshot(self):
+        with self._lock:
+            rows = [dict(self.groups[key].summary(), block = key[0], scale_type = key[1]) for key in sorted(self.groups)]
+            return {"groups": rows, "alerts": list(self.alerts), "dropped": self.dropped}
+
+    def _render(self):
+        self._last_render = time.time()
+        if self.terminal is None:
+            return
+        snapshot = self.snapshot()
+        lines = ["{0:>5} {1:>8} {2:>5} {3:>8} {4:>8} {5:>7} {6:>7} {7:>7} {8:>10}".format(
+            "block", "scale", "n", "accuracy", "timeouts", "RT q10", "median", "RT q90", "congruency")]
+        for row in snapshot["groups"]:
+            lines.append("{0:>5} {1:>8} {2:>5} {3:>8} {4:>8} {5:>7} {6:>7} {7:>7} {8:>10}".format(
+                row["block"], row["scale_type"], row["n"], _format(row["accuracy"], "{0:.0%}"), _format(row["timeout rate"], "{0:.0%}"),
+                _format(row["RT q10"]), _format(row["RT median"]), _format(row["RT q90"]), _format(row["congruency effect"], "{0:+.3f}")))
+        if snapshot["dropped"]:
+            lines.append("({0} rows dropped)".format(snapshot["dropped"]))
+        print("\n".join(lines), file = self.terminal)
+        self.terminal.flush()
+
+    def _start_web(self, port):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        monitor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                snapshot = monitor.snapshot()
+                if self.path.startswith("/stats"):
+                    body, content_type = json.dumps(snapshot).encode(), "application/json"
+                else:
+                    body, content_type = _html(snapshot).encode(), "text/html; charset=utf-8"
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # no request log on the terminal of the experiment
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target = self._server.serve_forever, name = "monitor web", daemon = True).start()
+
+    # processes what is still queued, prints the last statistics and stops the web page
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._render()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _format(value, form = "{0:.3f}"):
+    return "-" if value is None else form.format(value)
+
+
+# the web page of a snapshot (reloads itself every 2 seconds)
+def _html(snapshot):
+    columns = ["block", "scale_type", "n", "accuracy", "timeout rate", "RT q10", "RT median", "RT q90", "congruency effect"]
+    rows = "".join("<tr>" + "".join("<td>{0}</td>".format(_format(row[name]) if isinstance(row[name], float) or row[name] is None else row[name])
+                                    for name in columns) + "</tr>" for row in snapshot["groups"])
+    alerts = "".join("<li>{0} block {1}: {2}</li>".format(alert["time"], alert["block"], alert["message"]) for alert in snapshot["alerts"])
+    return ("<html><head><meta http-equiv='refresh' content='2'><title>RPEP monitor</title></head><body>"
+            "<h2>Alerts</h2><ul>{0}</ul><h2>Per block X ScaleType</h2><table border='1'><tr>{1}</tr>{2}</table>"
+            "</body></html>").format(alerts or "<li>none</li>", "".join("<th>{0}</th>".format(name) for name in columns), rows)
+
+
+# The monitor settings given to the experiment script: (terminal view, web page port)
+# (--monitor and --monitor-port PORT, or RPEP_MONITOR=1 and RPEP_MONITOR_PORT); neither means no monitor
+def monitor_arguments(argv):
+    parser = argparse.ArgumentParser(add_help = False)
+    parser.add_argument("--monitor", action = 'store_true', default = os.environ.get("RPEP_MONITOR") == "1")
+    parser.add_argument("--monitor-port", type = int, default = os.environ.get("RPEP_MONITOR_PORT"))
+    arguments, unknown = parser.parse_known_args(argv[1:])
+    return arguments.monitor, arguments.monitor_port
@@ -0,0 +1,72 @@
+"""
+
+Running performance statistics of a session
+
+Replaces the lists of all accuracies and earned rewards that were summed again on every trial:
+the totals are updated in O(1) per trial, whatever the length of the session.
+Besides the totals it keeps the accuracy over the last trials (a rolling window) and
+tallies per ScaleType X Bins condition, for the feedback screens and the adaptive deadline
+(both opt-in with the "performance" section of the config, see rpep_design).
+
+RunningStats: the running totals, rolling accuracy and per condition tallies of a session
+
+"""
+from __future__ import division
+from collections import deque
+import numpy as np
+
+
+class RunningStats(object):
+    # window: number of trials of the rolling accuracy
+    # n_scale_types, n_bins: the tallies are indexed by the ScaleType and Bins codes of the design
+    def __init__(self, window = 20, n_scale_types = 2, n_bins = 5):
+        self.window = window
+        self.n = 0
+        self.correct = 0
+        self.total_reward = 0
+        self._recent = deque(maxlen = window)
+        self._recent_correct = 0
+        # per ScaleType X Bins code: trials, correct trials and earned reward
+        self.counts = np.zeros((n_scale_types, n_bins), dtype = np.int64)
+        self.correct_counts = np.zeros((n_scale_types, n_bins), dtype = np.int64)
+        self.rewards = np.zeros((n_scale_types, n_bins))
+
+    # adds the outcome of one (experimental) trial, scale_type and bin_code: its codes in the design
+    # (a trial without them only counts for the totals and the rolling accuracy)
+    def add(self, accuracy, earned_reward, scale_type = None, bin_code = None):
+        accuracy = int(accuracy)
+        self.n += 1
+        self.correct += accuracy
+        self.total_reward += earned_reward
+
+        if len(self._recent) == self.window:
+            self._recent_correct -= self._recent[0]
+        self._recent.append(accuracy)
+        self._recent_correct += accuracy
+
+        if scale_type is not None and bin_code is not None:
+            self.counts[scale_type, bin_code] += 1
+            self.correct_counts[scale_type, bin_code] += accuracy
+            self.rewards[scale_type, bin_code] += earned_reward
+
+    # accuracy of all trials so far as a percentage (rounded to one decimal, as on the feedback screens)
+    def accuracy_percent(self):
+        if self.n == 0:
+            return 0
+        return round(self.correct/self.n*100, 1)
+
+    # accuracy (0-1) of the last window trials, None before the first trial
+    def rolling_accuracy(self):
+        if not self._recent:
+            return None
+        return self._recent_correct/len(self._recent)
+
+    # trials, accuracy (None without trials) and total reward of one ScaleType X Bins condition,
+    # or of all bins of a scale type (bin_code None)
+    def condition(self, scale_type, bin_code = None):
+        columns = slice(None) if bin_code is None else bin_code
+        n = int(np.sum(self.counts[scale_type, columns]))
+        correct = int(np.sum(self.correct_counts[scale_type, columns]))
+        return {"n": n,
+                "accuracy": correct/n if n else None,
+                "reward": float(np.sum(self.rewards[scale_type, columns]))}
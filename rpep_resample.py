@@ -0,0 +1,181 @@
+"""
+
+Bootstrap confidence intervals and permutation tests over subjects
+
+The long format dataset is first reduced to per subject X design cell sums and counts
+(a small n_subjects X 20 array). Every effect is a contrast over the 20 design cells,
+so each subject contributes one value per effect and a resample is a mean over a row of
+an index (bootstrap) or sign (permutation) matrix. Resamples are generated in chunks with
+their own seed, spawned from one session seed, so the result is the same for any number
+of worker processes.
+
+subject_cell_sums(): number of trials, correct trials and summed RT per subject X design cell
+
+subject_cell_means(): accuracy or mean RT per subject X design cell
+
+effect_contrasts(): the contrast weights of the Congruency X ScaleType X Bins effects
+
+bootstrap(): bootstrap confidence intervals of the effects (resampling subjects)
+
+permutation_test(): sign-flip permutation test of the effects (within subjects)
+
+"""
+from __future__ import division
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas
+
+from rpep_analysis import (congruency_levels, scale_levels, bin_levels, n_cells,
+                           subject_cell_codes)
+
+
+# Number of trials, correct trials and summed RT of the correct trials per subject X design cell,
+# as arrays of n_subjects X 20 (cells ordered as in rpep_analysis.cell_codes)
+def subject_cell_sums(long_data):
+    groups, n_subjects = subject_cell_codes(long_data)
+    n_groups = n_subjects*n_cells
+    accurate = long_data["Accurate Response"].to_numpy().astype(np.float64)
+    rt = long_data["RT"].to_numpy().astype(np.float64)
+
+    sums = {"n": np.bincount(groups, minlength = n_groups),
+            "correct": np.bincount(groups, weights = accurate, minlength = n_groups),
+            "rt_sum": np.bincount(groups, weights = rt*accurate, minlength = n_groups)}
+    for name in sums:
+        sums[name] = sums[name].reshape(n_subjects, n_cells)
+    sums["subjects"] = list(long_data["Subject"].cat.categories)
+    return sums
+
+
+# Accuracy or mean RT (of the correct trials) per subject X design cell
+def subject_cell_means(sums, measure = "Mean RT"):
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        if measure == "Accuracy":
+            return sums["correct"]/sums["n"]
+        elif measure == "Mean RT":
+            return sums["rt_sum"]/sums["correct"]
+    raise ValueError("Unknown measure: {0}".format(measure))
+
+
+# Contrast weights over the design cells, as {effect name: weights}.
+# Congruency effects are Incon - Con, ScaleType effects Prob - Det,
+# Bin effects are linear trends over the bins. With more than two congruency conditions or
+# scale types there is one effect per level against the first one (named after the levels)
+def effect_contrasts():
+    n_congruency, n_scale, n_bins = len(congruency_levels), len(scale_levels), len(bin_levels)
+    congruency = {"Congruency": np.array([-1.0, 1.0])}
+    if n_congruency != 2:
+        congruency = dict(("Congruency ({0} - {1})".format(level, congruency_levels[0]), np.eye(n_congruency)[i] - np.eye(n_congruency)[0])
+                          for i, level in enumerate(congruency_levels) if i > 0)
+    scale = {"ScaleType": np.array([1.0, -1.0])}
+    if n_scale != 2:
+        scale = dict(("ScaleType ({0} - {1})".format(scale_levels[0], level), np.eye(n_scale)[0] - np.eye(n_scale)[i])
+                     for i, level in enumerate(scale_levels) if i > 0)
+    bin_trend = np.arange(n_bins) - (n_bins - 1)/2
+    if n_bins > 1:
+        bin_trend = bin_trend/np.sum(np.abs(bin_trend))*2
+    average_congruency = np.full(n_congruency, 1/n_congruency)
+    average_scale = np.full(n_scale, 1/n_scale)
+    average_bins = np.full(n_bins, 1/n_bins)
+
+    # the cells are ordered Congruency X ScaleType X Bins
+    def weights(congruency_weights, scale_weights, bin_weights):
+        return np.einsum('i,j,k->ijk', congruency_weights, scale_weights, bin_weights).ravel()
+
+    contrasts = {}
+    for name, congruency_weights in congruency.items():
+        contrasts[name] = weights(congruency_weights, average_scale, average_bins)
+    for name, scale_weights in scale.items():
+        contrasts[name] = weights(average_congruency, scale_weights, average_bins)
+    contrasts["Bins (linear)"] = weights(average_congruency, average_scale, bin_trend)
+    for congruency_name, congruency_weights in congruency.items():
+        for scale_name, scale_weights in scale.items():
+            contrasts["{0} X {1}".format(congruency_name, scale_name)] = weights(congruency_weights, scale_weights, average_bins)
+    for name, congruency_weights in congruency.items():
+        contrasts[name + " X Bins (linear)"] = weights(congruency_weights, average_scale, bin_trend)
+    for congruency_name, congruency_weights in congruency.items():
+        for scale_name, scale_weights in scale.items():
+            contrasts["{0} X {1} X Bins (linear)".format(congruency_name, scale_name)] = weights(congruency_weights, scale_weights, bin_trend)
+
+    # the congruency effect within every ScaleType X Bins cell
+    for name, congruency_weights in congruency.items():
+        for j, scale_type in enumerate(scale_levels):
+            for k, bin_name in enumerate(bin_levels):
+                contrasts["{0} | {1} {2}".format(name, scale_type, bin_name)] = weights(congruency_weights, np.eye(n_scale)[j], np.eye(n_bins)[k])
+    return contrasts
+
+
+# one chunk of bootstrap resamples: means over subjects drawn with replacement
+def _bootstrap_chunk(arguments):
+    subject_values, n_resamples, seed_sequence = arguments
+    rng = np.random.default_rng(seed_sequence)
+    n_subjects = subject_values.shape[0]
+    index = rng.integers(0, n_subjects, size = (n_resamples, n_subjects))
+    return subject_values[index].mean(axis = 1)
+
+
+# one chunk of permutations: under the null hypothesis the sign of every subject's effect is exchangeable
+def _permutation_chunk(arguments):
+    subject_values, n_resamples, seed_sequence = arguments
+    rng = np.random.default_rng(seed_sequence)
+    n_subjects = subject_values.shape[0]
+    signs = rng.integers(0, 2, size = (n_resamples, n_subjects))*2 - 1
+    return np.einsum('rs,se->re', signs, subject_values)/n_subjects
+
+
+# Runs the chunks (with their own seeds) in order, in this process or over a process pool
+def _run_chunks(chunk_function, subject_values, n_resamples, seed, chunk_size, workers):
+    n_chunks = int(np.ceil(n_resamples/chunk_size))
+    seed_sequences = np.random.SeedSequence(seed).spawn(n_chunks)
+    sizes = [min(chunk_size, n_resamples - i*chunk_size) for i in range(n_chunks)]
+    chunks = [(subject_values, size, seed_sequence) for size, seed_sequence in zip(sizes, seed_sequences)]
+
+    if workers is None or workers > 1:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            results = list(pool.map(chunk_function, chunks))
+    else:
+        results = [chunk_function(chunk) for chunk in chunks]
+    return np.concatenate(results)
+
+
+# Contrast value of every subject for every effect (n_subjects X n_effects)
+def _subject_effects(long_data, measure, contrasts):
+    sums = subject_cell_sums(long_data)
+    means = subject_cell_means(sums, measure)
+    # subjects missing a cell can't contribute to the contrasts
+    complete = ~np.isnan(means).any(axis = 1)
+    weights = np.array(list(contrasts.values()))
+    return means[complete].dot(weights.T)
+
+
+# Bootstrap confidence intervals of the effects, resampling subjects with replacement.
+# The same seed gives the same intervals for any number of workers (None = all cpus)
+def bootstrap(long_data, measure = "Mean RT", n_resamples = 10000, confidence = .95,
+              seed = 0, workers = 1, chunk_size = 1000, contrasts = None):
+    if contrasts is None:
+        contrasts = effect_contrasts()
+    subject_values = _subject_effects(long_data, measure, contrasts)
+    resamples = _run_chunks(_bootstrap_chunk, subject_values, n_resamples, seed, chunk_size, workers)
+
+    alpha = (1 - confidence)/2
+    return pandas.DataFrame({"Effect": list(contrasts),
+                             "Estimate": subject_values.mean(axis = 0),
+                             "SE": resamples.std(axis = 0, ddof = 1),
+                             "CI Lower": np.quantile(resamples, alpha, axis = 0),
+                             "CI Upper": np.quantile(resamples, 1 - alpha, axis = 0)})
+
+
+# Two-sided sign-flip permutation test of the effects (H0: effect is 0 within subjects).
+# The same seed gives the same p-values for any number of workers (None = all cpus)
+def permutation_test(long_data, measure = "Mean RT", n_resamples = 10000,
+                     seed = 0, workers = 1, chunk_size = 1000, contrasts = None):
+    if contrasts is None:
+        contrasts = effect_contrasts()
+    subject_values = _subject_effects(long_data, measure, contrasts)
+    observed = subject_values.mean(axis = 0)
+    permuted = _run_chunks(_permutation_chunk, subject_values, n_resamples, seed, chunk_size, workers)
+
+    # the observed data count as one of the permutations
+    extreme = np.sum(np.abs(permuted) >= np.abs(observed) - 1e-12, axis = 0)
+    return pandas.DataFrame({"Effect": list(contrasts),
+                             "Estimate": observed,
+                             "p": (extreme + 1)/(n_resamples + 1)})
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+
+Setup stage of a session
+
+Checks the participant info, precomputes the trial schedule of the whole session and saves it
+next to the (future) data file, before the lab PC has to load psychopy and open a window.
+The experiment script started with --session then skips the participant dialog and the
+schedule computation, and doesn't import the gui module at all.
+
+Usage:
+    python rpep_setup.py --participant 12 --name Jan --gender Male
+    python NL_final_RPEP.py --session DATA/subject_12/subject_12_data_session.npz
+
+The session runs the design of the config it was prepared with (--config, default rpep_config.json).
+With an allocation table (--allocation, see rpep_allocation) the block order, key mapping and schedule
+come from the participant's allocation instead of the parity of the participant number.
+A participant number that already has a data file is refused. A session that crashed
+(see rpep_trial_log) is only prepared again with --resume.
+
+subject_file_base(): the data file name (without extension) of a participant
+
+check_participant(): the problems with the participant info and the completed blocks of an earlier session
+
+prepare_session(): checks the info and saves the session (schedule and info)
+
+session_argument(): the session file given to the experiment script
+
+"""
+from __future__ import print_function
+import argparse, os, sys
+
+from rpep_design import design, load_design, session_schedule, build_schedule, save_session, export_schedule
+from rpep_trial_log import read_completed_blocks
+
+
+session_suffix = "_session.npz"
+genders = ["Female", "Male", "Other"]
+
+
+# Data file name (without .csv) of a participant, as created by directory_set() in the experiment script
+def subject_file_base(participant_number, directory = "."):
+    subject = "subject_{0}".format(participant_number)
+    return os.path.join(directory, "DATA", subject, subject + "_data")
+
+
+# Checks the participant info. Returns a list of problems (empty when the info is fine)
+# and the completed blocks of an earlier session of this participant (see read_completed_blocks)
+def check_participant(info, directory = ".", design = design):
+    problems = []
+    completed_blocks = {}
+    participant_number = str(info.get("Participant number", ""))
+    if not participant_number.isdigit():
+        problems.append("The participant number should be a whole number, not '{0}'".format(participant_number))
+    else:
+        filename = subject_file_base(participant_number, directory)
+        completed_blocks = read_completed_blocks(filename + "_trials.jsonl")
+        if os.path.isfile(filename + ".csv"):
+            problems.append("Participant {0} already has a data file: {1}.csv".format(participant_number, filename))
+        elif completed_blocks and max(completed_blocks) >= design["n_blocks"] - 1:
+            problems.append("Participant {0} already completed every block".format(participant_number))
+    if info.get("Gender") not in genders:
+        problems.append("The gender should be one of {0}".format(", ".join(genders)))
+    if str(info.get("testrun")) not in ("0", "1"):
+        problems.append("testrun should be 0 or 1")
+    return problems, completed_blocks
+
+
+# Checks the participant info and saves the session schedule (<data file>_session.npz, plus its csv export).
+# A participant with completed blocks is only resumed with resume = True. allocation: an AllocationTable
+# (rpep_allocation), the participant is allocated at site (a resumed session keeps its allocation).
+# Raises a ValueError with every problem, returns the name of the session file
+def prepare_session(info, directory = ".", resume = False, design = design, allocation = None, site = ""):
+    problems, completed_blocks = check_participant(info, directory, design)
+    if completed_blocks and not resume and not problems:
+        problems.append("Participant {0} completed block {1} of an earlier session, use --resume to continue it".format(
+            info["Participant number"], max(completed_blocks)))
+    if problems:
+        raise ValueError("\n".join(problems))
+
+    info = {"Name": info.get("Name", ""), "Participant number": str(info["Participant number"]),
+            "Gender": info["Gender"], "testrun": int(info["testrun"])}
+    filename = subject_file_base(info["Participant number"], directory)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+
+    if allocation is not None:
+        from rpep_allocation import allocated_session
+        # a table of another config is refused before anything is allocated
+        allocation.check_design(design)
+        participant_allocation = allocation.assign(info["Participant number"], site)
+        design, c_b, seed = allocated_session(participant_allocation, info["Participant number"], allocation, design)
+        schedule = build_schedule(c_b, testrun = info["testrun"], seed = seed, design = design)
+    else:
+        c_b, seed, schedule = session_schedule(info["Participant number"], testrun = info["testrun"], design = design)
+    save_session(filename + session_suffix, schedule, info, c_b, seed, resume = bool(completed_blocks), design = design)
+    export_schedule(schedule, filename + "_schedule.csv", design)
+    return filename + session_suffix
+
+
+# The session file given to the experiment script (--session FILE), or None
+def session_argument(argv):
+    parser = argparse.ArgumentParser(add_help = False)
+    parser.add_argument("--session", default = None)
+    arguments, unknown = parser.parse_known_args(argv[1:])
+    return arguments.session
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Prepares the session of a participant of the reward scale experiment")
+    parser.add_argument("--participant", required = True, help = "participant number")
+    parser.add_argument("--name", default = "")
+    parser.add_argument("--gender", default = "Female", help = "one of " + ", ".join(genders))
+    parser.add_argument("--testrun", type = int, default = 0)
+    parser.add_argument("--resume", action = 'store_true', help = "continue a session that crashed after its last completed block")
+    parser.add_argument("--directory", default = ".", help = "folder of the experiment (with the DATA folder)")
+    parser.add_argument("--config", default = None, help = "experiment config (default: RPEP_CONFIG or rpep_config.json)")
+    parser.add_argument("--allocation", default = None, help = "allocation table (see rpep_allocation), default: by participant number")
+    parser.add_argument("--site", default = "", help = "site of the participant in the allocation table")
+    arguments = parser.parse_args()
+
+    info = {"Name": arguments.name, "Participant number": arguments.participant,
+            "Gender": arguments.gender, "testrun": arguments.testrun}
+    try:
+        session_design = load_design(arguments.config) if arguments.config else design
+        allocation = None
+        if arguments.allocation:
+            from rpep_allocation import AllocationTable
+            allocation = AllocationTable(arguments.allocation)
+        session_file = prepare_session(info, arguments.directory, resume = arguments.resume, design = session_design,
+                                       allocation = allocation, site = arguments.site)
+    except ValueError as error:
+        print(error, file = sys.stderr)
+        sys.exit(1)
+    print("Session prepared: {0}".format(session_file))
+    print("Start it with: python NL_final_RPEP.py --session {0}".format(os.path.relpath(session_file, arguments.directory)))
+
+
+if __name__ == '__main__':
+    main()
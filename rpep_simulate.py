@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+
+Vectorised synthetic sessions for power analysis and design search
+
+Simulates whole sessions of many synthetic subjects at once, without running the experiment script:
+the schedules are the ones the real sessions would get (build_schedule, with the counterbalancing and
+seed of every participant number), the responses come from a responder model per design cell
+(as in rpep_headless, plus variability between subjects and an optional effect of the reward size on the RT),
+and the deadline staircase (update_deadline) and reward rules (create_reward_stimulus and
+performance_processing) of the script are applied to all subjects together, trial by trial.
+The sessions convert into the long format of data_long.csv, so they go straight into rpep_analysis
+and rpep_resample. Every simulated experiment has its own seed (spawned from one seed), so a power
+analysis gives the same result for any number of worker processes.
+
+Usage:
+    python rpep_simulate.py --subjects 20 28 40 --experiments 1000 --workers 8 --output power.csv
+    python rpep_simulate.py --subjects 28 --sweep designs.json --workers 8     (designs.json: {name: config changes})
+
+simulate_sessions(): sessions of synthetic subjects as arrays (subjects X trials)
+
+long_format(): the experimental trials of simulated sessions in the long format of data_long.csv
+
+power_analysis(): the power of the effects for a number of subjects, over many simulated experiments
+
+design_sweep(): the power of variants of the design (changes to the experiment config)
+
+"""
+from __future__ import division, print_function
+import argparse, copy, json
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas
+
+from rpep_design import design, compile_design, counterbalance, session_seed, build_schedule
+import rpep_headless
+
+
+# Responder of the simulations: the headless responder (accuracy and log-normal RT per design cell) plus
+# subject_log_rt_sd: sd of the subjects' overall log RT, subject_logit_sd: sd of their overall accuracy (logit),
+# subject_cell_sd: sd of their log RT per design cell (subjects differ in their effects),
+# reward_slope: change of the log RT per 100 reward points, per congruency condition X scale type
+default_model = dict(rpep_headless.default_model,
+                     subject_log_rt_sd = .08,
+                     subject_logit_sd = .5,
+                     subject_cell_sd = .03,
+                     reward_slope = np.zeros((len(design["conditions"]), len(design["scale_types"]))))
+
+
+# the model filled up with the defaults (a model of rpep_headless.fit_responder_model has no subject variability)
+def _full_model(model, design):
+    full = dict(default_model)
+    full["reward_slope"] = np.zeros((len(design["conditions"]), len(design["scale_types"])))
+    full.update(model or {})
+    return full
+
+
+# Simulates the sessions of synthetic subjects (participant numbers first_participant, first_participant + 1, ...).
+# Returns {name: subjects X trials array} with the columns of the schedule plus "RT", "Responded",
+# "Accurate Response", "Earned Reward" and "Response Deadline", and "Participant" (the numbers).
+# The schedule and counterbalancing of every subject are those of its participant number, seed: the responses
+def simulate_sessions(n_subjects, design = design, model = None, seed = None, first_participant = 1):
+    if design["performance"]["accuracy_target"] is not None:
+        raise ValueError("The simulated staircase is the plain one, without the performance accuracy_target of the config")
+    model = _full_model(model, design)
+    rng = np.random.default_rng(seed)
+    participants = np.arange(first_participant, first_participant + n_subjects)
+    schedules = [build_schedule(counterbalance(int(number), design), seed = session_seed(number), design = design)
+                 for number in participants]
+    sessions = dict((name, np.stack([schedule[name] for schedule in schedules])) for name in schedules[0])
+    sessions["Participant"] = participants
+    n_trials = sessions["Block"].shape[1]
+    rows = np.arange(n_subjects)[:, None]
+
+    ## responses of the responder: accuracy and log RT per design cell, shifted per subject
+    condition = design["congruency_condition"][sessions["Congruency"]]
+    scale = sessions["ScaleType"]
+    cells = (condition*len(design["scale_types"]) + scale)*len(design["bins"]) + sessions["Bins"]
+    log_rt = (np.asarray(model["log_rt_mean"])[cells]
+              + rng.normal(0, model["subject_log_rt_sd"], (n_subjects, 1))
+              + rng.normal(0, model["subject_cell_sd"], (n_subjects, design["n_cells"]))[rows, cells]
+              + np.asarray(model["reward_slope"])[condition, scale]*(sessions["Reward Size"] - 50)/100
+              + np.asarray(model["log_rt_sd"])[cells]*rng.standard_normal((n_subjects, n_trials)))
+    rt = np.exp(log_rt)
+    accuracy = np.clip(np.asarray(model["accuracy"], dtype = np.float64), 1e-6, 1 - 1e-6)
+    logit = np.log(accuracy/(1 - accuracy))[cells] + rng.normal(0, model["subject_logit_sd"], (n_subjects, 1))
+    correct = rng.random((n_subjects, n_trials)) < 1/(1 + np.exp(-logit))
+
+    ## the deadline staircase, for all subjects at once (a response at or after the deadline is a non-response)
+    deadline_settings = design["deadline"]
+    deadline = np.full(n_subjects, deadline_settings["initial"])
+    deadlines = np.empty((n_subjects, n_trials))
+    responded = np.empty((n_subjects, n_trials), dtype = bool)
+    for t in range(n_trials):
+        deadlines[:, t] = deadline
+        responded[:, t] = rt[:, t] < deadline
+        accurate = correct[:, t] & responded[:, t]
+        inside = (deadline_settings["lower"] <= deadline) & (deadline <= deadline_settings["upper"])
+        deadline = np.where(inside, np.where(accurate, deadline - deadline_settings["step_correct"], deadline + deadline_settings["step_error"]),
+                            np.clip(deadline, deadline_settings["lower"], deadline_settings["upper"]))
+        # whole hundredths, as update_deadline rounds them (float steps drift past the limits otherwise)
+        deadline = np.round(deadline, 2)
+    accurate = correct & responded
+
+    ## rewards: the reward size on deterministic blocks, the drawn outcome on probabilistic ones
+    probabilistic = design["scale_kind"][scale] == 0
+    earned = np.where(probabilistic, design["probabilistic_reward"]*sessions["Prob Outcome"], sessions["Reward Size"])
+
+    # a non-response is logged at the deadline
+    sessions["RT"] = np.where(responded, rt, deadlines)
+    sessions["Responded"] = responded
+    sessions["Accurate Response"] = accurate.astype(np.int8)
+    sessions["Earned Reward"] = np.where(accurate, earned, 0)
+    sessions["Response Deadline"] = deadlines
+    return sessions
+
+
+# The experimental trials of simulated sessions in the long format of data_long.csv (see rpep_analysis.load_long).
+# The factor levels of the design have to be the ones of the analysis (rpep_analysis)
+def long_format(sessions, design = design):
+    from rpep_analysis import long_dtypes, congruency_levels, scale_levels, bin_levels, response_levels
+    if (list(design["conditions"]), list(design["scale_types"]), list(design["bins"])) != (congruency_levels, scale_levels, bin_levels):
+        raise ValueError("The factor levels of the simulated design differ from the ones of the analysis (see RPEP_CONFIG)")
+    experimental = sessions["Block"] > 0
+    subject = np.broadcast_to(np.arange(len(sessions["Participant"]))[:, None], experimental.shape)[experimental]
+    subjects = ["Subj_{0}".format(number) for number in sessions["Participant"]]
+
+    # the response key of every trial: the correct key on correct trials, the other key on errors, N without response
+    correct_side = design["correct_side"][sessions["Congruency"]]
+    side = np.where(sessions["Accurate Response"] == 1, correct_side, 1 - correct_side)
+    response = np.where(sessions["Responded"], side, 2)[experimental]
+
+    long_data = pandas.DataFrame({
+        "Accurate Response": sessions["Accurate Response"][experimental].astype(np.int8),
+        "BinSize": sessions["BinSize"][experimental].astype(np.int16),
+        "Bins": pandas.Categorical.from_codes(sessions["Bins"][experimental], categories = bin_levels),
+        "Congruency": pandas.Categorical.from_codes(design["congruency_condition"][sessions["Congruency"][experimental]], categories = congruency_levels),
+        "RT": sessions["RT"][experimental],
+        "Reward Size": sessions["Reward Size"][experimental].astype(np.int16),
+        "ScaleType": pandas.Categorical.from_codes(sessions["ScaleType"][experimental], categories = scale_levels),
+        "Subject": pandas.Categorical.from_codes(subject, categories = subjects),
+        "response": pandas.Categorical.from_codes(response, categories = response_levels)})
+    return long_data[list(long_dtypes)]
+
+
+## Power
+
+# the effects of a power analysis when none are given: the main effects and interactions of rpep_resample
+def _default_effects():
+    from rpep_resample import effect_contrasts
+    return [name for name in effect_contrasts() if " | " not in name]
+
+
+# simulated experiments of one task: the p-values (sign-flip permutation test) and estimates of the effects
+def _experiment_chunk(arguments):
+    from rpep_resample import effect_contrasts, permutation_test
+    design, model, n_subjects, measure, effects, n_permutations, seed_sequences = arguments
+    contrasts = dict((name, weights) for name, weights in effect_contrasts().items() if name in effects)
+    p_values, estimates = [], []
+    for seed_sequence in seed_sequences:
+        simulation_seed, test_seed = seed_sequence.spawn(2)
+        sessions = simulate_sessions(n_subjects, design, model, seed = simulation_seed)
+        test = permutation_test(long_format(sessions, design), measure, n_permutations,
+                                seed = int(test_seed.generate_state(1)[0]), contrasts = contrasts)
+        p_values.append(test["p"].to_numpy())
+        estimates.append(test["Estimate"].to_numpy())
+    return np.array(p_values), np.array(estimates)
+
+
+# Power of the effects (names of rpep_resample.effect_contrasts, default the main effects and interactions)
+# with n_subjects subjects: the fraction of n_experiments simulated experiments in which the permutation test
+# of the effect is significant at alpha. The experiments run in chunks over a process pool (None = all cpus),
+# the same seed gives the same power for any number of workers
+def power_analysis(n_subjects, n_experiments = 1000, design = design, model = None, measure = "Mean RT", effects = None,
+                   alpha = .05, n_permutations = 1000, seed = 0, workers = 1, chunk_size = 10):
+    if effects is None:
+        effects = _default_effects()
+    seed_sequences = np.random.SeedSequence(seed).spawn(n_experiments)
+    chunks = [(design, model, n_subjects, measure, effects, n_permutations, seed_sequences[i:i + chunk_size])
+              for i in range(0, n_experiments, chunk_size)]
+    if workers is None or workers > 1:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            results = list(pool.map(_experiment_chunk, chunks))
+    else:
+        results = [_experiment_chunk(chunk) for chunk in chunks]
+    p_values = np.concatenate([result[0] for result in results])
+    estimates = np.concatenate([result[1] for result in results])
+
+    # the order of the contrasts of the test
+    from rpep_resample import effect_contrasts
+    names = [name for name in effect_contrasts() if name in effects]
+    return pandas.DataFrame({"Effect": names,
+                             "Subjects": n_subjects,
+                             "Power": np.mean(p_values < alpha, axis = 0),
+                             "Mean Estimate": estimates.mean(axis = 0),
+                             "Experiments": n_experiments})
+
+
+# Power of variants of the design: variants is {name: changes of the experiment config} (e.g. {"n_trial_rep": 5}
+# or other "bins"), every variant for every number of subjects. Returns one table with a "Design" column
+def design_sweep(variants, subjects = (28,), n_experiments = 1000, model = None, measure = "Mean RT", effects = None,
+                 alpha = .05, n_permutations = 1000, seed = 0, workers = 1):
+    tables = []
+    for name, changes in variants.items():
+        config = copy.deepcopy(design["config"])
+        config.update(changes)
+        variant = compile_design(config)
+        for n_subjects in subjects:
+            table = power_analysis(n_subjects, n_experiments, variant, model, measure, effects, alpha, n_permutations, seed, workers)
+            table.insert(0, "Design", name)
+            tables.append(table)
+    return pandas.concat(tables, ignore_index = True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Power of the effects of the design, from simulated experiments")
+    parser.add_argument("--subjects", type = int, nargs = '+', default = [28], help = "numbers of subjects")
+    parser.add_argument("--experiments", type = int, default = 1000, help = "simulated experiments per number of subjects")
+    parser.add_argument("--model", default = None, help = "long format dataset to fit the responder on (default: the headless responder)")
+    parser.add_argument("--measure", default = "Mean RT", choices = ["Mean RT", "Accuracy"])
+    parser.add_argument("--sweep", default = None, help = "json file of design variants: {name: config changes}")
+    parser.add_argument("--permutations", type = int, default = 1000)
+    parser.add_argument("--alpha", type = float, default = .05)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--workers", type = int, default = 1, help = "worker processes (0 = all cpus)")
+    parser.add_argument("--output", default = None, help = "csv file of the power table")
+    arguments = parser.parse_args()
+
+    model = None
+    if arguments.model:
+        from rpep_analysis import load_long
+        model = rpep_headless.fit_responder_model(load_long(arguments.model))
+    variants = {"default": {}}
+    if arguments.sweep:
+        with open(arguments.sweep) as sweep_in:
+            variants = json.load(sweep_in)
+    table = design_sweep(variants, arguments.subjects, arguments.experiments, model, arguments.measure,
+                         alpha = arguments.alpha, n_permutations = arguments.permutations, seed = arguments.seed,
+                         workers = arguments.workers or None)
+    print(table.to_string(index = False))
+    if arguments.output:
+        table.to_csv(arguments.output, index = False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""
+
+Streaming, crash-safe trial log
+
+Every trial is appended to a JSON Lines file (one JSON object per line) as soon as it is done,
+instead of only being saved by the ExperimentHandler at the end of the experiment.
+Lines are flushed immediately and synced to disk every few trials and at the end of
+every block, so a crash loses at most the trials since the last sync.
+Besides trial rows the log contains markers:
+    {"event": "session_start", "first_block": b}   a (resumed) session starts at block b
+    {"event": "block_end", "block": b}             block b was completed
+    {"event": "writer", ...}                        backpressure of the background writer during block b
+
+With background = True the display thread only puts the rows on a bounded queue, a writer thread
+encodes them and writes them in batches (flushing and syncing as above). When the queue is full
+the display thread waits for the writer (backpressure), which is counted in writer_stats.
+Closing the log (also at exit, after core.quit()) writes everything that is still queued.
+With a store (rpep_trial_store.TrialStore) every row is also appended to it, by the writer thread in background
+mode, and the store is saved to store_file at the end of every block.
+
+TrialLog: appends trial rows and markers to the log
+
+read_completed_blocks(): the rows of the completed blocks in a log, to resume a session
+
+"""
+import atexit, json, os, threading, time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# converts values json doesn't know (numpy numbers) into plain python values
+def _json_value(value):
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+class TrialLog(object):
+    # filename: the JSON Lines file (appended to if it exists)
+    # fsync_every: number of trials between syncs to disk, fsync_interval: maximum seconds between syncs
+    # background: write from a writer thread, with a queue of at most max_queue rows
+    # store: a TrialStore the rows are appended to, saved to store_file (.npz) at the end of every block
+    def __init__(self, filename, first_block = 0, fsync_every = 10, fsync_interval = 5.0,
+                 background = False, max_queue = 1000, store = None, store_file = None):
+        self.filename = filename
+        self.store = store
+        self.store_file = store_file
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.background = background
+        # a line that was cut off by a crash is closed first, so it can't swallow the next entry
+        cut_off = False
+        if os.path.isfile(filename) and os.path.getsize(filename) > 0:
+            with open(filename, 'rb') as log:
+                log.seek(-1, os.SEEK_END)
+                cut_off = log.read(1) != b"\n"
+        self._file = open(filename, 'a')
+        if cut_off:
+            self._file.write("\n")
+        self._unsynced = 0
+        self._last_sync = time.time()
+        self._write_line({"event": "session_start", "first_block": first_block})
+        self.sync()
+
+        self.writer_stats = {"rows": 0, "batches": 0, "max_queue": 0, "waits": 0, "wait_time": 0.0, "max_batch_time": 0.0}
+        self._error = None
+        if background:
+            self._queue = queue.Queue(maxsize = max_queue)
+            self._thread = threading.Thread(target = self._writer, name = "trial log", daemon = True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _write_line(self, entry):
+        self._file.write(json.dumps(entry, default = _json_value) + "\n")
+        self._file.flush()
+
+    # forces everything written so far onto the disk
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def _write_row(self, row):
+        self._write_line(row)
+        if self.store is not None:
+            self.store.append(row)
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every or time.time() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    # writer thread: takes everything that is queued and writes it as one batch.
+    # An entry None stops the thread, ("writer", block) writes the writer_stats of a block
+    def _writer(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            start = time.time()
+            try:
+                for entry in batch:
+                    if entry is None:
+                        running = False
+                    elif isinstance(entry, tuple):
+                        self._write_line(dict(self.writer_stats, event = "writer", block = entry[1]))
+                    elif "event" in entry:
+                        self._write_line(entry)
+                    else:
+                        self._write_row(entry)
+                        self.writer_stats["rows"] += 1
+            except Exception as error:
+                # raised again on the display thread (see _put and end_block), the thread keeps draining the queue
+                self._error = error
+                running = running and not any(entry is None for entry in batch)
+            finally:
+                self.writer_stats["batches"] += 1
+                self.writer_stats["max_batch_time"] = max(self.writer_stats["max_batch_time"], time.time() - start)
+                for entry in batch:
+                    self._queue.task_done()
+
+    # puts an entry on the queue of the writer, waiting for the writer when the queue is full
+    def _put(self, entry):
+        if self._error is not None:
+            raise self._error
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            start = time.time()
+            self._queue.put(entry)
+            self.writer_stats["waits"] += 1
+            self.writer_stats["wait_time"] += time.time() - start
+        self.writer_stats["max_queue"] = max(self.writer_stats["max_queue"], self._queue.qsize())
+
+    # appends one trial row (a dictionary of column: value)
+    def write(self, row):
+        if self.background:
+            # a copy, the caller may reuse its dictionary
+            self._put(dict(row))
+        else:
+            self._write_row(row)
+
+    # marks a block as completed (a session can be resumed after it). The background writer
+    # is drained first, so the block is on disk when this returns (between blocks, not between trials)
+    def end_block(self, block):
+        if self.background:
+            self._put(("writer", block))
+            self._put({"event": "block_end", "block": block})
+            self._queue.join()
+            self.sync()
+            if self._error is not None:
+                raise self._error
+        else:
+            self._write_line({"event": "block_end", "block": block})
+            self.sync()
+        if self.store is not None and self.store_file is not None:
+            self.store.save(self.store_file)
+
+    def close(self):
+        if self.background and self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            # a closed log (its store and queue) isn't kept alive until exit, e.g. over many headless sessions
+            atexit.unregister(self.close)
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+
+# Reads a trial log and returns the rows of its completed blocks as {block: [rows]}.
+# A session that (re)starts at block b replaces the blocks from b onwards of earlier sessions,
+# rows of blocks without an end marker and a half written last line are ignored
+def read_completed_blocks(filename):
+    completed = {}
+    if not os.path.isfile(filename):
+        return completed
+
+    open_rows = {}
+    with open(filename) as log:
+        for line in log:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the line that was being written during the crash
+                continue
+            event = entry.get("event")
+            if event == "session_start":
+                open_rows = {}
+                for block in [block for block in completed if block >= entry["first_block"]]:
+                    del completed[block]
+            elif event == "block_end":
+                completed[entry["block"]] = open_rows.pop(entry["block"], [])
+            elif event is None:
+                open_rows.setdefault(entry.get("Block"), []).append(entry)
+    return completed
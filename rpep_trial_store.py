@@ -0,0 +1,192 @@
+"""
+
+Compact column store of trials
+
+A trial kept as a dictionary costs hundreds of bytes (the keys and the strings of every value are repeated).
+A TrialStore keeps one preallocated numpy array per column instead (struct of arrays): the factors as small
+integer codes into their levels (Bins, Congruency, ScaleType and response as int8, Subject as int32), the RT and
+the rewards as float32, so a trial takes about 30 bytes. The arrays grow by doubling when the capacity is reached.
+
+The store is filled from the rows of a running session (the trial log can append its rows to a store,
+see rpep_trial_log), from the long format dataset (rpep_analysis.load_store) or from other stores
+(TrialStore.concatenate, for datasets merged over sites), and exports the long format of data_long.csv.
+
+TrialStore: the columns of the trials, with append(), to_frame(), to_csv(), save() and load()
+
+"""
+from __future__ import division
+import numpy as np
+
+from rpep_design import design
+
+
+# the columns of the long format dataset (in its order), followed by the extra columns of a running session
+long_columns = ["Accurate Response", "BinSize", "Bins", "Congruency", "RT", "Reward Size", "ScaleType", "Subject", "response"]
+store_dtypes = {"Accurate Response": np.int8,
+                "BinSize": np.int16,
+                "Bins": np.int8,
+                "Congruency": np.int8,
+                "RT": np.float32,
+                "Reward Size": np.float32,
+                "ScaleType": np.int8,
+                "Subject": np.int32,
+                "response": np.int8,
+                "Block": np.int16,
+                "Earned Reward": np.float32,
+                "Response Deadline": np.float32}
+factor_columns = ["Bins", "Congruency", "ScaleType", "Subject", "response"]
+
+# the long format writes these integer columns as floats (0.0, 80.0)
+_float_columns = ["Accurate Response", "BinSize", "Reward Size"]
+
+
+class TrialStore(object):
+    # capacity: number of trials allocated up front (e.g. the trials of a session)
+    # subject: the Subject of rows without one (a running session), levels: the factor levels (default: the design)
+    def __init__(self, capacity = 1024, subject = None, design = design):
+        self.levels = {"Bins": list(design["bins"]),
+                       "Congruency": list(design["conditions"]),
+                       "ScaleType": list(design["scale_types"]),
+                       "Subject": [],
+                       "response": list(design["keys"]) + ['N']}
+        self._codes = dict((name, dict((level, code) for code, level in enumerate(levels))) for name, levels in self.levels.items())
+        # the congruencies of the script (L_Con, R_Incon, ...) belong to a congruency condition
+        for congruency, condition in zip(design["congruencies"], design["congruency_condition"]):
+            self._codes["Congruency"].setdefault(congruency, int(condition))
+        self.subject = subject
+        self.n = 0
+        self.columns = dict((name, np.zeros(max(int(capacity), 1), dtype = dtype)) for name, dtype in store_dtypes.items())
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def capacity(self):
+        return len(self.columns["RT"])
+
+    # bytes of the arrays (the allocated capacity)
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+    # makes room for n more trials, doubling the capacity
+    def _reserve(self, n):
+        if self.n + n <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < self.n + n:
+            capacity *= 2
+        for name, column in self.columns.items():
+            grown = np.zeros(capacity, dtype = column.dtype)
+            grown[:self.n] = column[:self.n]
+            self.columns[name] = grown
+
+    # code of a factor level, new subjects are added to the levels
+    def code(self, name, level):
+        level = str(level)
+        if name == "response":
+            # 'None' (no response) is logged as N, keys by their first character
+            level = level[:1]
+        codes = self._codes[name]
+        if level not in codes:
+            if name != "Subject":
+                raise ValueError("Unknown {0}: {1}".format(name, level))
+            codes[level] = len(self.levels[name])
+            self.levels[name].append(level)
+        return codes[level]
+
+    # Appends one trial: a row of a running session (the trial log) or of the long format, as {column: value}.
+    # Columns the row doesn't have are 0 (Subject: the subject of the store)
+    def append(self, row):
+        self._reserve(1)
+        i = self.n
+        for name, column in self.columns.items():
+            if name in factor_columns:
+                value = row.get(name, self.subject if name == "Subject" else None)
+                if value is not None:
+                    column[i] = self.code(name, value)
+            elif row.get(name) is not None:
+                column[i] = row[name]
+        self.n += 1
+
+    # Appends many trials as {column: array}, factors as codes into levels ({column: levels} of these codes)
+    def extend(self, arrays, levels = None):
+        n = len(next(iter(arrays.values())))
+        self._reserve(n)
+        for name, values in arrays.items():
+            if name not in self.columns:
+                continue
+            values = np.asarray(values)
+            if name in factor_columns and levels is not None and name in levels:
+                remap = np.array([self.code(name, level) for level in levels[name]], dtype = store_dtypes[name])
+                values = remap[values] if len(remap) else values
+            self.columns[name][self.n:self.n + n] = values
+        self.n += n
+
+    # the filled part of a column (a view)
+    def column(self, name):
+        return self.columns[name][:self.n]
+
+    # The trials as a DataFrame with categorical factors, as rpep_analysis.load_long returns them.
+    # experimental_only: leave out the practice block (Block 0) of the rows of a running session
+    def to_frame(self, columns = long_columns, experimental_only = False):
+        # pandas only for analysis, the experiment script doesn't load it
+        import pandas
+        keep = slice(None)
+        if experimental_only:
+            keep = self.column("Block") > 0
+        frame = {}
+        for name in columns:
+            values = self.column(name)[keep]
+            if name in factor_columns:
+                frame[name] = pandas.Categorical.from_codes(values, categories = self.levels[name])
+            else:
+                frame[name] = values
+        return pandas.DataFrame(frame)
+
+    # Writes the trials in the long format of data_long.csv
+    def to_csv(self, filename, experimental_only = False):
+        frame = self.to_frame(long_columns, experimental_only)
+        for name in _float_columns:
+            frame[name] = frame[name].astype(np.float64)
+        frame.to_csv(filename, index = False)
+
+    # Saves the store as a compressed .npz file (the filled part of the columns and the factor levels)
+    def save(self, filename):
+        arrays = dict(("column_" + name, self.column(name)) for name in self.columns)
+        arrays.update(("levels_" + name, np.array(levels, dtype = str)) for name, levels in self.levels.items())
+        np.savez_compressed(filename, **arrays)
+
+    # Loads a store saved with save()
+    @classmethod
+    def load(cls, filename, design = design):
+        with np.load(filename) as saved:
+            arrays = dict((name[len("column_"):], saved[name]) for name in saved.files if name.startswith("column_"))
+            levels = dict((name[len("levels_"):], list(saved[name])) for name in saved.files if name.startswith("levels_"))
+        store = cls(capacity = len(arrays["RT"]), design = design)
+        store.extend(arrays, levels)
+        return store
+
+    # A store from a DataFrame of the long format (e.g. rpep_analysis.load_long)
+    @classmethod
+    def from_frame(cls, long_data, design = design):
+        import pandas
+        store = cls(capacity = len(long_data), design = design)
+        arrays, levels = {}, {}
+        for name in long_data.columns:
+            column = long_data[name]
+            if isinstance(column.dtype, pandas.CategoricalDtype):
+                arrays[name] = column.cat.codes.to_numpy()
+                levels[name] = [str(level) for level in column.cat.categories]
+            else:
+                arrays[name] = column.to_numpy()
+        store.extend(arrays, levels)
+        return store
+
+    # One store of the trials of several stores (e.g. datasets of several sites), the subject levels are merged
+    @classmethod
+    def concatenate(cls, stores, design = design):
+        store = cls(capacity = sum(len(part) for part in stores), design = design)
+        for part in stores:
+            store.extend(dict((name, part.column(name)) for name in part.columns), part.levels)
+        return store
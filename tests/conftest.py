@@ -0,0 +1,4 @@
+import os, sys
+
+# the rpep modules live in the folder above the tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas
+
+from rpep_analysis import replay_deadlines, deadline_lower_limit
+from rpep_design import design
+
+
+# update_deadline of the experiment script, one trial at a time
+def _loop_deadlines(subjects, accurate, initial_deadline):
+    deadline_settings = design["deadline"]
+    deadlines = []
+    previous_subject = None
+    for subject, accuracy in zip(subjects, accurate):
+        if subject != previous_subject:
+            deadline = initial_deadline
+            previous_subject = subject
+        deadlines.append(deadline)
+        if deadline_settings["lower"] <= deadline <= deadline_settings["upper"]:
+            deadline += -deadline_settings["step_correct"] if accuracy == 1 else deadline_settings["step_error"]
+        else:
+            deadline = min(max(deadline, deadline_settings["lower"]), deadline_settings["upper"])
+        deadline = round(deadline, 2)
+    return np.array(deadlines)
+
+
+# the prefix scan replay gives the deadlines of a trial by trial replay, for subjects of different lengths
+def test_replay_deadlines_matches_loop():
+    rng = np.random.default_rng(11)
+    lengths = [1, 2, 37, 300, 513]
+    subjects = np.repeat(["Subj_{0}".format(i + 1) for i in range(len(lengths))], lengths)
+    accurate = (rng.random(len(subjects)) < .75).astype(np.int8)
+    long_data = pandas.DataFrame({"Subject": pandas.Categorical(subjects, categories = ["Subj_{0}".format(i + 1) for i in range(len(lengths))]),
+                                  "Accurate Response": accurate})
+    for initial_deadline in (deadline_lower_limit, .6, .9):
+        expected = _loop_deadlines(subjects, accurate, initial_deadline)
+        assert np.allclose(replay_deadlines(long_data, initial_deadline), expected)
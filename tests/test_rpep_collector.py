@@ -0,0 +1,53 @@
+import threading
+
+from rpep_collector import CollectorClient, serve
+
+
+def _start_collector(directory):
+    started = threading.Event()
+    address = {}
+
+    def ready(port):
+        address["port"] = port
+        started.set()
+    threading.Thread(target = serve, args = ("127.0.0.1", 0, str(directory), ready), daemon = True).start()
+    assert started.wait(10)
+    return "127.0.0.1:{0}".format(address["port"])
+
+
+# stations claiming at the same time never get the same number, and their assignments follow the numbers
+def test_concurrent_claims_are_unique(tmp_path):
+    address = _start_collector(tmp_path)
+    n_stations, claims_per_station = 8, 5
+    assignments = []
+    lock = threading.Lock()
+
+    def station(i):
+        for claim in range(claims_per_station):
+            # a new connection per claim: a station claims one number per session
+            claimed = CollectorClient(address, "station-{0}".format(i)).claim("", groups = 2)
+            with lock:
+                assignments.append(claimed)
+
+    threads = [threading.Thread(target = station, args = (i,)) for i in range(n_stations)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    numbers = [assignment["participant"] for assignment in assignments]
+    assert sorted(numbers) == list(range(1, n_stations*claims_per_station + 1))
+    assert all(assignment["c_b"] == (assignment["participant"] + 1)%2 for assignment in assignments)
+
+
+# a number taken by one station is refused to another, and free again once released
+def test_taken_and_released(tmp_path):
+    address = _start_collector(tmp_path)
+    first = CollectorClient(address, "a")
+    second = CollectorClient(address, "b")
+    assert first.claim("12", groups = 2)["participant"] == 12
+    assert second.claim("12", groups = 2) is None
+    first.release()
+    assert second.claim("12", groups = 2)["participant"] == 12
+    # a station with another config (number of groups) is refused
+    assert CollectorClient(address, "c").claim("", groups = 3) is None
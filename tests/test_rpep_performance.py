@@ -0,0 +1,34 @@
+import numpy as np
+
+from rpep_performance import RunningStats
+
+
+# the rolling accuracy and the per condition tallies match a recount of all trials so far
+def test_window_and_tallies_match_recount():
+    rng = np.random.default_rng(7)
+    stats = RunningStats(window = 15, n_scale_types = 2, n_bins = 5)
+    trials = []
+    for i in range(300):
+        trial = (int(rng.random() < .8), int(rng.integers(0, 101)), int(rng.integers(0, 2)), int(rng.integers(0, 5)))
+        stats.add(*trial)
+        trials.append(trial)
+
+        recent = [accuracy for accuracy, reward, scale, bin_code in trials[-15:]]
+        assert stats.rolling_accuracy() == sum(recent)/len(recent)
+        assert stats.total_reward == sum(reward for accuracy, reward, scale, bin_code in trials)
+        assert stats.accuracy_percent() == round(sum(trial[0] for trial in trials)/len(trials)*100, 1)
+
+    for scale in range(2):
+        for bin_code in list(range(5)) + [None]:
+            matching = [trial for trial in trials if trial[2] == scale and (bin_code is None or trial[3] == bin_code)]
+            condition = stats.condition(scale, bin_code)
+            assert condition["n"] == len(matching)
+            assert condition["accuracy"] == sum(trial[0] for trial in matching)/len(matching)
+            assert condition["reward"] == sum(trial[1] for trial in matching)
+
+
+def test_empty_stats():
+    stats = RunningStats()
+    assert stats.rolling_accuracy() is None
+    assert stats.accuracy_percent() == 0
+    assert stats.condition(0, 0) == {"n": 0, "accuracy": None, "reward": 0.0}
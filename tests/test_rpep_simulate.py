@@ -0,0 +1,18 @@
+import contextlib, io
+
+import rpep_headless
+from rpep_design import design
+from rpep_simulate import simulate_sessions
+
+
+# the simulated deadlines follow update_deadline of the experiment script, trial by trial
+def test_deadlines_follow_update_deadline(tmp_path):
+    script = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        rpep_headless.run_session(1, str(tmp_path), testrun = 1, namespace = script)
+    sessions = simulate_sessions(4, seed = 3)
+    for subject in range(4):
+        deadline = design["deadline"]["initial"]
+        for t in range(sessions["Block"].shape[1]):
+            assert sessions["Response Deadline"][subject, t] == deadline, (subject, t)
+            deadline = script["update_deadline"](sessions["Accurate Response"][subject, t], deadline)
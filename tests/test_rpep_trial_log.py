@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from rpep_trial_log import TrialLog, read_completed_blocks
+
+
+def _rows(block, n):
+    return [{"Block": block, "Trial": trial, "RT": .4} for trial in range(n)]
+
+
+# a crash in the middle of a block keeps the completed blocks, a resumed session adds its blocks
+@pytest.mark.parametrize("background", [False, True])
+def test_crash_and_resume(tmp_path, background):
+    filename = str(tmp_path/"subject_1_data_trials.jsonl")
+    log = TrialLog(filename, background = background)
+    for block in (0, 1):
+        for row in _rows(block, 3):
+            log.write(row)
+        log.end_block(block)
+    for row in _rows(2, 2):
+        log.write(row)
+    log.close()
+    # the crash: block 2 has no end marker and its last line was cut off
+    with open(filename, 'a') as cut_off:
+        cut_off.write(json.dumps(_rows(2, 3)[-1])[:10])
+
+    completed = read_completed_blocks(filename)
+    assert sorted(completed) == [0, 1]
+    assert completed[1] == _rows(1, 3)
+
+    log = TrialLog(filename, first_block = 2, background = background)
+    for row in _rows(2, 4):
+        log.write(row)
+    log.end_block(2)
+    log.close()
+    completed = read_completed_blocks(filename)
+    assert sorted(completed) == [0, 1, 2]
+    assert completed[2] == _rows(2, 4)
+
+
+# a session restarted at an earlier block replaces that block and the ones after it
+def test_restart_replaces_later_blocks(tmp_path):
+    filename = str(tmp_path/"trials.jsonl")
+    log = TrialLog(filename)
+    for block in (0, 1, 2):
+        for row in _rows(block, 2):
+            log.write(row)
+        log.end_block(block)
+    log.close()
+
+    log = TrialLog(filename, first_block = 1)
+    for row in _rows(1, 5):
+        log.write(row)
+    log.end_block(1)
+    log.close()
+    completed = read_completed_blocks(filename)
+    assert sorted(completed) == [0, 1]
+    assert len(completed[1]) == 5
+
+
+def test_missing_log():
+    assert read_completed_blocks("no_such_log.jsonl") == {}
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas
+
+from rpep_analysis import read_long_csv
+from rpep_simulate import long_format, simulate_sessions
+from rpep_trial_store import TrialStore
+
+
+# the long format survives a round trip through a store and its csv export
+def test_to_csv_round_trip(tmp_path):
+    long_data = long_format(simulate_sessions(3, seed = 5))
+    store = TrialStore.from_frame(long_data)
+    filename = str(tmp_path/"data_long.csv")
+    store.to_csv(filename)
+    read_back = read_long_csv(filename)
+
+    assert list(read_back.columns) == list(long_data.columns)
+    for name in long_data.columns:
+        if isinstance(long_data[name].dtype, pandas.CategoricalDtype):
+            assert list(read_back[name].astype(str)) == list(long_data[name].astype(str)), name
+        else:
+            assert np.allclose(read_back[name].to_numpy(dtype = float), long_data[name].to_numpy(dtype = float), atol = 1e-6), name
+
+
+# save and load keep the columns and the factor levels
+def test_save_load(tmp_path):
+    store = TrialStore(capacity = 2, subject = "Subj_9")
+    for block in range(5):
+        store.append({"Block": 200 + block, "RT": .5, "ScaleType": "Det", "Bins": "Bin_3", "Congruency": "L_Incon", "response": "k"})
+    filename = str(tmp_path/"trials.npz")
+    store.save(filename)
+    loaded = TrialStore.load(filename)
+    assert len(loaded) == 5
+    assert loaded.column("Block").tolist() == [200, 201, 202, 203, 204]
+    frame = loaded.to_frame()
+    assert set(frame["Subject"]) == {"Subj_9"} and set(frame["Congruency"]) == {"Incon"}